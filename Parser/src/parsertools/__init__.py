@@ -21,6 +21,10 @@ class ParsertoolsException(Exception):
 class NoPrefixError(ParsertoolsException):
     pass
 
+class BudgetExceededError(ParsertoolsException):
+    '''Raised when a parse exceeds one of the limits of its ParseBudget (see base.py).'''
+    pass
+
 print('parsertools version {}, build {}'.format(open(versionfilepath).read().strip(), buildno))
 
 
@@ -4,17 +4,132 @@ Created on 3 mrt. 2016
 @author: jeroenbruijning
 '''
 from pyparsing import *
-from parsertools import ParsertoolsException
+from parsertools import ParsertoolsException, BudgetExceededError
+from collections import OrderedDict
+from contextlib import ExitStack
+from array import array
+from operator import attrgetter
+import hashlib
+import re
+import sys
+import threading
+import time
+
+# The slot names of each ParseStruct subclass, see ParseStruct._getSlotNames()
+_slotNames = {}
 
 class ParseStruct:
     '''Parent class for all ParseStruct subclasses. These subclasses will typically correspond to productions in a given grammar,
-    e.g. an EBNF grammar.'''
+    e.g. an EBNF grammar.
+    
+    The attributes of the instances are kept in slots rather than in a per instance __dict__, as a parse tree typically consists of thousands of
+    small objects. Subclasses that add attributes should declare them in __slots__ too (the subclasses generated for the elements of a grammar
+    declare an empty __slots__). Internally, attributes are set with object.__setattr__(), as __setattr__() does not allow it.
+    The rendering of an element (see __str__()) and its digest (see getDigest()) are cached in its _string and _digest slots, which are None when
+    they are not known (yet), and the index of its child elements by label (see getValuesForLabel()) in its _labelIndex slot. The top element of a
+    tree keeps an index of all elements of the tree by class (see searchElements()) in its _typeIndex slot. Code that changes the items of an element
+    must do so with setItems() or updateWith(), which drop the cached values of the element and of its ancestors.'''
+    
+    __slots__ = ('_items', '_label', '_parent', '_string', '_digest', '_labelIndex', '_typeIndex')
+    
+    _parser = None
+    
+    @classmethod
+    def _getSlotNames(cls):
+        '''Returns a tuple with the names of the slots declared by the class and its bases.'''
+        try:
+            return _slotNames[cls]
+        except KeyError:
+            names = []
+            for c in reversed(cls.__mro__):
+                slots = c.__dict__.get('__slots__', ())
+                for name in ((slots,) if isinstance(slots, str) else slots):
+                    if name not in names:
+                        names.append(name)
+            return _slotNames.setdefault(cls, tuple(names))
     
     @classmethod
     def getPattern(cls):
         return cls._pattern
     
-    def __init__(self, expr):
+    @classmethod
+    def _parseString(cls, expr, parseAll=True, budget=None):
+        '''Parses expr with the _pattern of the class and returns the resulting ParseResults object.
+        If the Parser object that generated the class has selected the recursive descent backend (see rdengine.py), that backend does the parsing.
+        Otherwise, if the Parser has a memo cache (see MemoCache below), the parse is memoized. If a budget is given (see ParseBudget below), the parse
+        is stopped with a BudgetExceededError when it exceeds one of the limits of the budget. Input that is nested too deeply for pyparsing to parse
+        within the recursion limit of Python is parsed again with the stack variant of the recursive descent backend, within the same budget.'''
+        parser = cls._parser
+        if parser and parser.engine is not None:
+            return parser.engine.parseString(cls.getPattern(), expr, parseAll=parseAll, budget=budget)
+        with cls._parserContext(budget):
+            try:
+                result = cls.getPattern().parseString(expr, parseAll=parseAll)
+            except RecursionError:
+                if not parser:
+                    raise
+                return parser.getEngine('stack').parseString(cls.getPattern(), expr, parseAll=parseAll, budget=budget)
+        cls._repairParentPointers(result)
+        return result
+    
+    @classmethod
+    def _parsePrefix(cls, expr, budget=None):
+        '''Parses the longest prefix of expr that matches the _pattern of the class, as _parseString() does, and returns the resulting ParseResults
+        object together with the rest of expr (with tabs expanded, as pyparsing does before parsing). This allows a caller to parse what follows the prefix
+        with another pattern.'''
+        pattern = cls.getPattern()
+        if not pattern.keepTabs:
+            expr = expr.expandtabs()
+        parser = cls._parser
+        if parser and parser.engine is not None:
+            result, loc = parser.engine.parsePrefix(pattern, expr, budget=budget)
+            return result, expr[loc:]
+        with cls._parserContext(budget):
+            ParserElement.resetCache()
+            pattern.streamline()
+            try:
+                loc, result = pattern._parse(expr, 0)
+            except RecursionError:
+                if not parser:
+                    raise
+                result, loc = parser.getEngine('stack').parsePrefix(pattern, expr, budget=budget)
+                return result, expr[loc:]
+        cls._repairParentPointers(result)
+        return result, expr[loc:]
+    
+    @classmethod
+    def _parserContext(cls, budget=None):
+        '''Returns a context manager that activates the memo cache of the Parser object that generated the class, if it has one,
+        and the budget, if given. These apply to the pattern of the class, which is tracked for them at first use (see _trackPatterns() below).'''
+        stack = ExitStack()
+        parser = cls._parser
+        if (parser and parser.memo is not None) or budget is not None:
+            _trackPatterns(cls.getPattern())
+        if parser and parser.memo is not None:
+            stack.enter_context(parser.memo)
+        if budget is not None:
+            # last, so that the budget is charged for memoized attempts too
+            stack.enter_context(budget)
+        return stack
+    
+    @classmethod
+    def _repairParentPointers(cls, parseresults):
+        '''The parent pointers of the elements are set by the parse actions (see parseStructFunc() below), as each element is built. A memoized
+        (packrat) parse can however reuse an element that was built for an alternative that was discarded afterwards, and that alternative may have
+        been the last to set its parent pointer. So after such a parse, the parent pointers of the ParseStruct objects in parseresults are set again
+        by walking their trees.'''
+        parser = cls._parser
+        if (parser and parser.memo is not None) or ParserElement._packratEnabled:
+            for e in parseresults:
+                if isinstance(e, ParseStruct):
+                    e.createParentPointers()
+    
+    @classmethod
+    def _getInternTable(cls):
+        '''Returns the InternTable (see below) of the Parser object that generated the class, or None if it does not intern strings.'''
+        return getattr(cls._parser, 'internTable', None)
+    
+    def __init__(self, expr, budget=None):
         '''A ParseStruct object contains a _pattern attribute, that corresponds to a pyparsing _pattern.
         It can be initialized wih either a valid string for the subclass concerned,
         using its own _pattern attribute to parse it, or it can be initialized with an explicit "None" as argument. This latter option is only
@@ -27,35 +142,53 @@ class ParseStruct:
         This nested list is the basic internal structure for the class.
         The other attibutes: _label and _parent_, are context dependent and will be set by a containing higher level ParseStruct, if that exists.'''
         
-        self.__dict__['_items'] = None
-        self.__dict__['_label'] = None
-        self.__dict__['_parent'] = None
+        object.__setattr__(self, '_items', None)
+        object.__setattr__(self, '_label', None)
+        object.__setattr__(self, '_parent', None)
+        object.__setattr__(self, '_string', None)
+        object.__setattr__(self, '_digest', None)
+        object.__setattr__(self, '_labelIndex', None)
+        object.__setattr__(self, '_typeIndex', None)
         
         if not expr is None:
             assert isinstance(expr, str), type(expr)
-            other = self.__getPattern().parseString(expr, parseAll=True)[0]
-            for attr in other.__dict__:
-                self.__dict__[attr] = other.__dict__[attr]
-            self.createParentPointers()
+            other = self._parseString(expr, budget=budget)[0]
+            self._setAttributes(other._getAttributes())
+            # an index by class of the tree of other would contain other rather than self
+            object.__setattr__(self, '_typeIndex', None)
+            # the parse actions set the parent pointers within the tree, only those of the items taken over from other must be set here
+            self.createParentPointers(recursive=False)
                 
     def __eq__(self, other):
         '''Compares the instances for equality of:
         - class
-        - string representation.
+        - structure, i.e. the classes and strings of the elements below, as summarized by their digests (see getDigest()).
         This means that the labels, parent pointers etc. are not taken into account. This is because
-        these are a form of annotation and/or context, separate from the parse tree in terms of resolved production rules.'''
+        these are a form of annotation and/or context, separate from the parse tree in terms of resolved production rules.
+        For trees produced by the parser, this is the same as comparing their string representations, as parsing a string with the pattern of a
+        class always gives the same structure.'''
         
-        return self.__class__ == other.__class__ and str(self) == str(other)
+        if isinstance(other, FlatElement):
+            return NotImplemented
+        return self.__class__ == other.__class__ and (self is other or self.getDigest() == other.getDigest())
     
     def __ne__(self, other):
         return not self == other
     
+    def __hash__(self):
+        '''Consistent with __eq__(), so that elements (e.g. the FILTERs or triple patterns of a query log) can be deduplicated in sets and dicts.
+        As the hash changes when an element is changed (e.g. by updateWith()), elements must not be changed while they are used as keys.'''
+        return hash(self.getDigest())
+    
     def __getattr__(self, att):
         '''Retrieves the unique, direct subelement having a label equal to the argument, if it exists.
         Raises an exception if zero, or more than one values exist for that label.'''
         
-        if att in self.getLabels():
-            values = self.getValuesForLabel(att)
+        if att[:1] == '_' and (att.startswith('__') or att in self._getSlotNames()):
+            # an unset slot, or e.g. a lookup of __dict__ by copy or pickle: not a label, and self.getLabels() could recurse back here
+            raise AttributeError(att)
+        values = self.__getLabelIndex().get(att)
+        if values:
             if len(values) == 1:
                 return values[0] 
         else:
@@ -66,22 +199,105 @@ class ParseStruct:
         
         raise AttributeError('Direct setting of attributes not allowed. To change an element e, try e.updateWith() instead.')
     
+    def _getAttributes(self):
+        '''Returns a dict with the attributes of the instance that are set, from its slots and, for a subclass without __slots__, its __dict__.'''
+        attributes = dict(self.__dict__) if self.__class__.__dictoffset__ else {}
+        for name in self._getSlotNames():
+            try:
+                attributes[name] = object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+        return attributes
+    
+    def _setAttributes(self, attributes):
+        '''Sets the attributes in the dict attributes, as returned by _getAttributes().'''
+        for (name, value) in attributes.items():
+            object.__setattr__(self, name, value)
+    
     def __repr__(self):
         return self.__class__.__name__ + '("' + str(self) + '")'
     
     def __str__(self):
         '''Generates a string corresponding to the object. Except for possible whitespace variation, 
-        this is identical to the string that was used to create the object.'''
+        this is identical to the string that was used to create the object.
+        The string is cached, together with those of all elements below, so that e.g. comparing elements (see __eq__()) does not render them again.'''
         
-        result = []
-        for t in self._items:
-            if isinstance(t, str):
-                result.append(t) 
+        string = self._string
+        if string is None:
+            string = self.__render()
+        return string
+    
+    def __render(self):
+        '''Returns the string of the object, see __str__(), and caches it for the object and for all elements below it. Elements with a cached
+        string are not rendered again. The tree is walked with an explicit stack rather than by recursion, as are the other walkers below, so that deeply
+        nested trees do not exceed the recursion limit.'''
+        
+        stack = [(self, iter(self._items), [])]
+        while True:
+            element, items, result = stack[-1]
+            for t in items:
+                if isinstance(t, str):
+                    result.append(t)
+                else:
+                    assert isinstance(t, ParseStruct), '__str__: found value {} of type {} instead of ParseStruct instance'.format(t, type(t))
+                    if t._string is not None:
+                        result.append(t._string)
+                        continue
+                    stack.append((t, iter(t._items), []))
+                    break
             else:
-                assert isinstance(t, ParseStruct), '__str__: found value {} of type {} instead of ParseStruct instance'.format(t, type(t))
-                result.append(str(t))
-        return ' '.join([r for r in result if r != ''])
+                stack.pop()
+                string = ' '.join([r for r in result if r != ''])
+                object.__setattr__(element, '_string', string)
+                if not stack:
+                    return string
+                stack[-1][2].append(string)
 
+    def getDigest(self):
+        '''Returns a structural (Merkle) hash of the element, as 16 bytes: a BLAKE2 hash of the name of its class, its strings and the digests of
+        its child elements, in order. Empty strings, which do not show in the rendering, are left out, and so are labels, parent pointers and further
+        attributes, as in __eq__(). Equal digests therefore mean equal elements (barring a hash collision, at a chance of about 2**-128 per pair).
+        The digest is cached, together with those of all elements below, and dropped when the element changes, as is the string (see __str__()).'''
+        
+        digest = self._digest
+        if digest is None:
+            digest = self.__computeDigest()
+        return digest
+    
+    def __computeDigest(self):
+        '''Computes and caches the digests of the element and of all elements below it that have none, see getDigest().'''
+        
+        def start(element):
+            h = hashlib.blake2b(element.__class__.__name__.encode(), digest_size=16)
+            return (element, iter(element._items), h)
+        
+        stack = [start(self)]
+        while True:
+            element, items, h = stack[-1]
+            for t in items:
+                if isinstance(t, str):
+                    if t:
+                        # with its length, so that e.g. the strings "a b" and "c" differ from "a" and "b c"
+                        t = t.encode('utf-8', 'surrogatepass')
+                        h.update(b'S%d:' % len(t))
+                        h.update(t)
+                else:
+                    assert isinstance(t, ParseStruct), 'getDigest: found value {} of type {} instead of ParseStruct instance'.format(t, type(t))
+                    if t._digest is not None:
+                        h.update(b'E')
+                        h.update(t._digest)
+                        continue
+                    stack.append(start(t))
+                    break
+            else:
+                stack.pop()
+                digest = h.digest()
+                object.__setattr__(element, '_digest', digest)
+                if not stack:
+                    return digest
+                stack[-1][2].update(b'E')
+                stack[-1][2].update(digest)
+    
     def __getPattern(self):
         '''Returns the _pattern used to parse expressions for this class.'''
         return self.__class__.getPattern()
@@ -91,81 +307,236 @@ class ParseStruct:
         at any depth of recursion.
         If labeledOnly is True, then in addition label may not be None.'''
         
-        def flattenElement(p):
-            result = []
-            if isinstance(p, ParseStruct):
-                result.extend(p.__getElements(labeledOnly=labeledOnly))
-            else:
-                assert isinstance(p, str), type(p)
-            return result
-        
-        def flattenList(l):
-            result = []
-            for p in l:
-                result.extend(flattenElement(p))
-            return result
-        
         result = []
-        if self.getLabel() or not labeledOnly:
-                result.append(self)
-        result.extend(flattenList(self.getItems()))
+        stack = [self]
+        while stack:
+            e = stack.pop()
+            if e.getLabel() or not labeledOnly:
+                result.append(e)
+            stack.extend(reversed([p for p in e.getItems() if isinstance(p, ParseStruct)]))
         return result  
     
     def createParentPointers(self, recursive=True):
-        for i in self.getItems():
-            if isinstance(i, ParseStruct):
-                i.__dict__['_parent'] = self
-                if recursive:
-                    i.createParentPointers()
+        stack = [self]
+        while stack:
+            e = stack.pop()
+            for i in e.getItems():
+                if isinstance(i, ParseStruct):
+                    object.__setattr__(i, '_parent', e)
+                    if recursive:
+                        stack.append(i)
 
     def copy(self):
         '''Returns a deep copy of itself.'''
-        result = self._pattern.parseString(str(self))[0]
+        result = self._parseString(str(self), parseAll=False)[0]
         assert result == self
         return result
     
+    def _clone(self, parent=None):
+        '''Returns a copy of itself with new ParseStruct objects throughout, without parsing. All other attributes (label, prefixes etc.)
+        are copied as they are, and the parent pointers point into the copy. Unlike copy(), the result is a copy of the complete tree,
+        context included.'''
+        setattr_ = object.__setattr__
+        # per class, the names of the slots other than _items and the indexes (which refer to the elements of the original), and a function that
+        # returns their values as a tuple, which copies them faster than _getAttributes()
+        slots = {}
+        copies = []
+        # (items to copy, list that receives their copies, parent of the copies) triples; the lists are the _items of the copies made
+        stack = [((self,), copies, parent)]
+        while stack:
+            originals, items, parent = stack.pop()
+            for i in originals:
+                if isinstance(i, ParseStruct):
+                    cls = i.__class__
+                    try:
+                        names, values = slots[cls]
+                    except KeyError:
+                        names = tuple(name for name in cls._getSlotNames() if name not in ('_items', '_labelIndex', '_typeIndex'))
+                        names, values = slots.setdefault(cls, (names, attrgetter(*names)))
+                    c = object.__new__(cls)
+                    try:
+                        for (name, value) in zip(names, values(i)):
+                            setattr_(c, name, value)
+                    except AttributeError:
+                        # not all slots are set
+                        c._setAttributes(i._getAttributes())
+                    else:
+                        if cls.__dictoffset__:
+                            c.__dict__.update(i.__dict__)
+                    children = []
+                    setattr_(c, '_items', children)
+                    setattr_(c, '_parent', parent)
+                    setattr_(c, '_labelIndex', None)
+                    setattr_(c, '_typeIndex', None)
+                    stack.append((i._items, children, c))
+                    items.append(c)
+                else:
+                    items.append(i)
+        return copies[0]
+
     def setItems(self, items):
-        self.__dict__['_items'] = items
+        object.__setattr__(self, '_items', items)
+        object.__setattr__(self, '_labelIndex', None)
+        self._dropCached()
+    
+    def _dropCached(self):
+        '''Drops the cached strings (see __str__()) and digests (see getDigest()) of the element and its ancestors, and the index by class of the
+        top element (see searchElements()), after a change of its items.'''
+        e = self
+        while e is not None:
+            object.__setattr__(e, '_string', None)
+            object.__setattr__(e, '_digest', None)
+            object.__setattr__(e, '_typeIndex', None)
+            e = e._parent
     
     def searchElements(self, *, label=None, element_type = None, value = None, labeledOnly=False):
         '''Returns a list of all elements with the specified search _pattern. If labeledOnly is True,
         only elements with label not None are considered for inclusion. Otherwise (the default case) all elements are considered.
-        Keyword arguments label, element_type, value are used as a wildcard if None. All must be matched for an element to be included in the result.'''
+        Keyword arguments label, element_type, value are used as a wildcard if None. All must be matched for an element to be included in the result.
+        A value is parsed once for each class of element that is considered, and compared with the elements of that class by their digest (see getDigest()).
+        When searching from the top element of a tree for an element_type, only the elements of that class are considered, as found in an index of
+        the tree by class. The index is built by the first such search, and kept until an element of the tree changes.'''
         
         result = []
+        parsed = {}
         
-        for e in [self] + self.__getElements(labeledOnly=labeledOnly):
+        if element_type and self._parent is None:
+            elements = self.__getTypeIndex().get(element_type, [])
+        else:
+            elements = self.__getElements(labeledOnly=labeledOnly)
+        for e in [self] + elements:
 #             print('DEBUG: e.name =', e.getLabel())
 
-            if labeledOnly and not e.getLabel():
-                continue
-            if label and label != e.getLabel():
-                continue
-            if element_type and element_type != e.__class__:
-                continue
-            if value:
+            if e.__matches(label, element_type, value, labeledOnly, parsed):
+                result.append(e)
+        return result    
+    
+    def __matches(self, label, element_type, value, labeledOnly, parsed):
+        '''True if the element matches the search arguments of searchElements() and iterSearch(). Parsed is a dict from each class to the value as
+        parsed with the _pattern of that class (None if it does not parse), filled on first use, and shared by all elements of a search.'''
+        if labeledOnly and not self.getLabel():
+            return False
+        if label and label != self.getLabel():
+            return False
+        if element_type and element_type != self.__class__:
+            return False
+        if value:
+            try:
+                e1 = parsed[self.__class__]
+            except KeyError:
                 try:
-                    e1 = e._pattern.parseString(value)[0]
-                    if e != e1:
-                        continue
+                    e1 = self._parseString(value, parseAll=False)[0]
                 except ParseException:
-                    continue
-            result.append(e)
-        return result    
+                    e1 = None
+                parsed[self.__class__] = e1
+            if e1 is None or self != e1:
+                return False
+        return True
+    
+    def iterSearch(self, *, label=None, element_type=None, value=None, labeledOnly=False, prune=None, limit=None, order='pre'):
+        '''Generator version of searchElements(), with the same search arguments. It yields the matching elements of the tree below the element
+        (included) as they are found, each once, so that a caller that only needs the first few (e.g. to check whether a query has a SERVICE clause)
+        does not walk the rest of the tree. Further arguments:
+        - prune: a function of an element. If it returns True, the elements below that element are skipped (the element itself is not);
+        - limit: the maximum number of elements to yield;
+        - order: "pre" (the default) yields elements before the elements below them, in the order of searchElements(), "post" after them.
+        When searching from the top element for an element_type in preorder without pruning, the index of the tree by class is used if it has
+        been built (see searchElements()); it is not built for this, as that would take a walk of the whole tree.'''
+        
+        if order not in ('pre', 'post'):
+            raise ParsertoolsException('Unknown order "{}", expected "pre" or "post"'.format(order))
+        if limit is not None and limit <= 0:
+            return
+        found = 0
+        parsed = {}
+        if element_type and self._parent is None and self._typeIndex is not None and order == 'pre' and prune is None:
+            for e in self._typeIndex.get(element_type, []):
+                if e.__matches(label, element_type, value, labeledOnly, parsed):
+                    yield e
+                    found += 1
+                    if found == limit:
+                        return
+            return
+        # (element, iterator over its children or None when they are still to be listed) pairs
+        stack = [(self, None)]
+        while stack:
+            e, children = stack[-1]
+            if children is None:
+                if order == 'pre' and e.__matches(label, element_type, value, labeledOnly, parsed):
+                    yield e
+                    found += 1
+                    if found == limit:
+                        return
+                children = iter(() if prune and prune(e) else [i for i in e._items if isinstance(i, ParseStruct)])
+                stack[-1] = (e, children)
+            child = next(children, None)
+            if child is not None:
+                stack.append((child, None))
+                continue
+            stack.pop()
+            if order == 'post' and e.__matches(label, element_type, value, labeledOnly, parsed):
+                yield e
+                found += 1
+                if found == limit:
+                    return
+
+    def select(self, selector):
+        '''Returns a list of the elements selected by selector relative to the element, in preorder. The selector is a string in the selector
+        language (see Selector), which is compiled on first use, or a Selector.'''
+        return Selector.compile(selector).select(self)
 
-    def updateWith(self, new_content):
-        '''Replaces the items attribute with the items attribute of a freshly parsed new_content, which must be a string.
-        The parsing is done with the _pattern of the element being updated.
-        This is the core function to change elements in place.'''
+    def iterSelect(self, selector):
+        '''Generator version of select(). The elements are yielded as they are found in a single walk of the tree.'''
+        return Selector.compile(selector).iterSelect(self)
+
+    def __getTypeIndex(self):
+        '''Returns a dict from each class to the list of the elements of that class in the tree below the element (included), in preorder. The dict
+        is built on first use and kept in the top element, until setItems() drops it.'''
+        index = self._typeIndex
+        if index is None:
+            index = {}
+            for e in self.__getElements(labeledOnly=False):
+                index.setdefault(e.__class__, []).append(e)
+            object.__setattr__(self, '_typeIndex', index)
+        return index
+    
+    def updateWith(self, new_content, *, validate=False):
+        '''Replaces the items attribute with the items attribute of new_content. This is the core function to change elements in place.
+        new_content is either a string, which is parsed with the _pattern of the element being updated, or an element. The items of a ParseStruct
+        element of the same class are spliced in without parsing: they are taken from a copy of it (see _clone()), so that new_content and the
+        tree it is part of are not changed. A FlatElement of the same class is converted with toParseStruct(), and an element of another class is
+        rendered and parsed as a string.
+        With validate=True, the element is checked to be equal to the result of reparsing its rendering afterwards (see isValid()). If it is not,
+        the update is undone and a ParsertoolsException is raised. The check takes another parse, and is not done by default, so that e.g.
+        expandIris() changes all iris of a tree in time linear in their number.
+        After the new items are in place (and again after an update is undone), _itemsReplaced() is called, so that a subclass can attach information
+        about their context to them.'''
         
-        assert isinstance(new_content, str), 'UpdateFrom function needs a string'
-        try:
-            other = self._pattern.parseString(new_content, parseAll=True)[0]
-        except ParseException:
-            raise ParsertoolsException('{} is not a valid string for {} element'.format(new_content, self.__class__.__name__))        
-        self.__dict__['_items'] = other.__dict__['_items']
+        if isinstance(new_content, FlatElement) and new_content.getType() == self.__class__:
+            other = new_content.toParseStruct()
+        elif isinstance(new_content, ParseStruct) and new_content.__class__ == self.__class__:
+            other = new_content._clone()
+        else:
+            if isinstance(new_content, (ParseStruct, FlatElement)):
+                new_content = str(new_content)
+            assert isinstance(new_content, str), 'updateWith needs a string or an element, got {}'.format(type(new_content))
+            try:
+                other = self._parseString(new_content)[0]
+            except ParseException:
+                raise ParsertoolsException('{} is not a valid string for {} element'.format(new_content, self.__class__.__name__))        
+        items = self._items
+        self.setItems(other._items)
         self.createParentPointers(recursive=False)
-        assert self.isValid()
+        self._itemsReplaced()
+        if validate and not self.isValid():
+            self.setItems(items)
+            self.createParentPointers(recursive=False)
+            self._itemsReplaced()
+            raise ParsertoolsException('{} is not a valid {} element'.format(other, self.__class__.__name__))
+    
+    def _itemsReplaced(self):
+        '''Called by updateWith() after it replaced the items of the element. Does nothing here.'''
+        pass
     
     def check(self, *, report = False, render=False, dump=False):
         '''Runs various checks. Returns True if all checks pass, else False. Optionally prints a report with the check results, renders, and/or dumps itself.'''
@@ -190,7 +561,7 @@ class ParseStruct:
 
     def hasLabel(self, k):
         '''True if k present as label of a direct descendant.'''
-        return k in self.getLabels()
+        return bool(k) and k in self.__getLabelIndex()
      
     def getLabels(self):
         '''Returns list of all labels from direct descendants.'''
@@ -198,7 +569,19 @@ class ParseStruct:
     
     def getValuesForLabel(self, k):
         '''Returns list of all direct descendants with k as label.'''
-        return [i for i in self.getItems() if isinstance(i, ParseStruct) and i._label == k]
+        return list(self.__getLabelIndex().get(k, ()))
+    
+    def __getLabelIndex(self):
+        '''Returns a dict from each label (None included) of the direct descendants to the list of those with that label, in order. The dict is
+        built on first use and kept until the items change, so that repeated lookups by label (e.g. elt.prefix) do not scan the items.'''
+        index = self._labelIndex
+        if index is None:
+            index = {}
+            for i in self._items:
+                if isinstance(i, ParseStruct):
+                    index.setdefault(i._label, []).append(i)
+            object.__setattr__(self, '_labelIndex', index)
+        return index
     
     def getChildren(self):
         '''Returns a list of all its non-string child elements.'''
@@ -235,24 +618,20 @@ class ParseStruct:
         
     def dump(self, indent='', step='|  '):
         '''Returns a dump of the object, with rich information'''
-        result = ''
-        def dumpString(s, indent, step):
-            return indent + s + '\n'
-        
-        def dumpItems(items, indent, step):
-            result = ''
-            for i in items:
-                if isinstance(i, str):
-                    result += dumpString(i, indent+step, step)
-                else:
-                    assert isinstance(i, ParseStruct) 
-                    result += i.dump(indent+step, step)
-            return result       
-       
-        result += indent + ('> '+ self.getLabel() + ':\n' + indent if self.getLabel() else '') + '[' + self.__class__.__name__ + '] ' + '/' + self.__str__() + '/' + '\n'
-        result += dumpItems(self._items, indent, step)
+        # caches the strings of all elements
+        str(self)
+        result = []
+        stack = [(self, indent)]
+        while stack:
+            i, indent = stack.pop()
+            if isinstance(i, str):
+                result.append(indent + i + '\n')
+            else:
+                assert isinstance(i, ParseStruct) 
+                result.append(indent + ('> '+ i.getLabel() + ':\n' + indent if i.getLabel() else '') + '[' + i.__class__.__name__ + '] ' + '/' + i._string + '/' + '\n')
+                stack.extend((t, indent + step) for t in reversed(i._items))
         
-        return result
+        return ''.join(result)
     
     def render(self):
         print(self.__str__())
@@ -261,7 +640,7 @@ class ParseStruct:
         '''Returns True if the rendered expression can be parsed again to an element of the same class.
         This should normally be the case.'''
         try:
-            self.__getPattern().parseString(self.__str__(), parseAll=True)
+            self._parseString(self.__str__())
             return True
         except ParseException:
             return False
@@ -269,41 +648,561 @@ class ParseStruct:
     def isValid(self):
         '''Returns True if the object is equal to the result of re-parsing its own rendering.
         This should normally be the case.'''
-        return self == self.__getPattern().parseString(self.__str__())[0]
+        return self == self._parseString(self.__str__(), parseAll=False)[0]
     
     def hasParentPointers(self):
-        for item in [i for i in self.getItems() if isinstance(i, ParseStruct)]:
-            if not item.getParent() == self or not item.hasParentPointers():
-                return False
+        stack = [self]
+        while stack:
+            e = stack.pop()
+            for item in [i for i in e.getItems() if isinstance(i, ParseStruct)]:
+                # identity is the normal case, and much cheaper to check than equality
+                if not (item.getParent() is e or item.getParent() == e):
+                    return False
+                stack.append(item)
         return True
     
+# Memoization and budgets (see MemoCache and ParseBudget below) only apply to the patterns of the grammars of Parser objects. pyparsing matches a
+# pattern at a location with its _parse() method. The first time a pattern of a ParseStruct class is parsed with a memo cache or a budget, it and
+# the patterns it consists of get a tracked class (see _trackPatterns()): a subclass of their pyparsing class, with the same name, whose _parse()
+# finds the memo cache and the budget that are active in the current thread, if any, in _activeParse.active, a (memo cache or None, budget or None)
+# pair. Patterns of other grammars, and parses in other threads, are not affected by them.
+class _ActiveParse(threading.local):
+    active = None
+
+_activeParse = _ActiveParse()
+_trackedClasses = {}
+_trackLock = threading.Lock()
+
+def _trackedClass(cls):
+    '''Returns the tracked class for pyparsing class cls, made at first use.'''
+    tracked = _trackedClasses.get(cls)
+    if tracked is not None:
+        return tracked
+    
+    def _parse(self, instring, loc, do_actions=True, callPreParse=True):
+        active = _activeParse.active
+        if active is None:
+            return cls._parse(self, instring, loc, do_actions, callPreParse)
+        memo, budget = active
+        # only the patterns with parse actions (e.g. those that build elements) are memoized, the others take about as long to match again
+        parse = memo.parse if memo is not None and self.parseAction else cls._parse
+        if budget is None:
+            return parse(self, instring, loc, do_actions, callPreParse)
+        budget.step()
+        try:
+            return parse(self, instring, loc, do_actions, callPreParse)
+        finally:
+            budget.depth -= 1
+    
+    tracked = type(cls.__name__, (cls,), {'_parse': _parse, '_untracked': cls, '__module__': cls.__module__, '__qualname__': cls.__qualname__})
+    return _trackedClasses.setdefault(cls, tracked)
+
+def _trackPatterns(pattern):
+    '''Gives pattern and all patterns it consists of their tracked class, unless pattern has one already. Patterns added to the grammar later
+    (e.g. to a Forward that is already tracked) are not tracked.'''
+    if '_untracked' in type(pattern).__dict__:
+        return
+    with _trackLock:
+        if '_untracked' in type(pattern).__dict__:
+            return
+        pattern.streamline()
+        stack = [pattern]
+        seen = set()
+        while stack:
+            e = stack.pop()
+            if id(e) in seen:
+                continue
+            seen.add(id(e))
+            cls = type(e)
+            # And relies on the exact class of its error stop markers, which are not matched anyway
+            if '_untracked' not in cls.__dict__ and cls is not And._ErrorStop:
+                e.__class__ = _trackedClass(cls)
+            if isinstance(e, ParseExpression):
+                stack.extend(e.exprs)
+            elif isinstance(e, ParseElementEnhance) and e.expr is not None:
+                stack.append(e.expr)
+            stack.extend(e.ignoreExprs)
+
+def patternClass(pattern):
+    '''Returns the pyparsing class of pattern, which is the base class of its tracked class if it has one (see above).'''
+    cls = type(pattern)
+    return cls.__dict__.get('_untracked', cls)
+
+class MemoCache:
+    '''Bounded memo table for packrat parsing. An instance is attached to a Parser object when memoization is enabled for
+    that parser, and is active only for the duration of a parse by one of its ParseStruct subclasses, and only in the thread of that parse.
+    While active, the outcome of an attempt to match a pattern with a parse action (such as the pattern of a ParseStruct class) at a given location
+    is stored, so that backtracking into the same subexpression at the same location does not parse it again. When more than size entries are stored, the least recently used entry is evicted.
+    The cache is a context manager. Entries live until the outermost activation is exited, so that a caller can let several parses of the same
+    string share them by activating the cache around those parses (parseQuery in the SPARQL parser does this). An activation holds the lock of the
+    cache, so that parses in different threads that use the same cache take turns.
+    The hit, miss and eviction counters are cumulative over parses, until resetStats() is called.'''
+    
+    def __init__(self, size=10000):
+        assert size > 0, 'MemoCache size must be positive, got {}'.format(size)
+        self.size = size
+        self.not_in_cache = object()
+        self.__entries = OrderedDict()
+        self.__saved = []
+        self.__lock = threading.RLock()
+        self.resetStats()
+    
+    def __len__(self):
+        return len(self.__entries)
+    
+    def __enter__(self):
+        '''Activates the cache for the parses in the current thread. The previous setting is restored on exit.'''
+        self.__lock.acquire()
+        active = _activeParse.active
+        self.__saved.append(active)
+        _activeParse.active = (self, active[1] if active else None)
+        return self
+    
+    def __exit__(self, *exc_info):
+        _activeParse.active = self.__saved.pop()
+        if not self.__saved:
+            self.__entries.clear()
+        self.__lock.release()
+        return False
+    
+    def parse(self, element, instring, loc, do_actions=True, callPreParse=True):
+        '''Matches element (a pattern with a tracked class, see above) at loc as pyparsing does, with the outcome taken from the cache if it is there
+        (as pyparsing's own packrat parsing does).'''
+        key = (element, instring, loc, callPreParse, do_actions)
+        value = self.get(key)
+        if value is self.not_in_cache:
+            try:
+                value = element._untracked._parse(element, instring, loc, do_actions, callPreParse)
+            except ParseBaseException as pe:
+                # a copy of the exception, without the traceback
+                self.set(key, pe.__class__(*pe.args))
+                raise
+            self.set(key, (value[0], value[1].copy(), loc))
+            return value
+        if isinstance(value, Exception):
+            raise value
+        return value[0], value[1].copy()
+    
+    def get(self, key):
+        try:
+            value = self.__entries[key]
+        except KeyError:
+            self.misses += 1
+            return self.not_in_cache
+        self.__entries.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def set(self, key, value):
+        self.__entries[key] = value
+        if len(self.__entries) > self.size:
+            self.__entries.popitem(last=False)
+            self.evictions += 1
+            
+    def clear(self):
+        '''Clears the cache, unless it is activated, see above.'''
+        with self.__lock:
+            if not self.__saved:
+                self.__entries.clear()
+        
+    def resetStats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+    def getStats(self):
+        '''Returns a dict with the hit, miss and eviction counters, the current number of entries and the cache bound.'''
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self), 'size': self.size}
+    
+class ParseBudget:
+    '''Limits for a parse, so that a pathological input (e.g. with hundreds of nested brackets) cannot keep a parser busy for long. The limits are
+    a maximum number of steps (attempts to match a pattern at some location, including failed ones), a maximum depth (of nested attempts, which
+    grows with the nesting of the input), and a maximum time in seconds. A limit that is None is not checked. A parse that exceeds a limit is
+    stopped with a BudgetExceededError.
+    
+    The budget is passed to parseQuery() or to a ParseStruct constructor, and is a context manager that is active for the duration of the parse.
+    Counting starts when the outermost activation is entered, so that a caller can let several parses share one budget by activating it around
+    them (parseQuery in the SPARQL parser does this). Steps and depth are counted per pattern of the grammar by both backends (the pyparsing backend
+    does so through the tracked classes of the patterns, see _trackPatterns() above), but as the recursive descent backend
+    tries fewer alternatives (see rdengine.py), it takes fewer steps for the same input. getStats() returns the steps taken, the largest depth reached
+    and the time spent by the last parse.
+    The clock is looked at every 64 steps, which for either backend is well under a millisecond, so a parse is stopped soon after its time limit;
+    unwinding a deeply nested parse after that takes some more time.
+    An activation only charges the parses in the thread that entered it, so that parses in other threads are not counted or stopped. A budget
+    counts one parse (or one series of parses) at a time, and must not be shared by concurrent parses in different threads.'''
+    
+    def __init__(self, maxSteps=None, maxDepth=None, maxTime=None):
+        self.maxSteps = maxSteps
+        self.maxDepth = maxDepth
+        self.maxTime = maxTime
+        self.steps = 0
+        self.depth = 0
+        self.deepest = 0
+        self.started = None
+        self.stopped = None
+        self.__deadline = None
+        self.__saved = []
+    
+    def __enter__(self):
+        '''Charges the budget for every tracked pattern that pyparsing tries to match in the current thread. The previous setting is restored on exit.'''
+        if not self.__saved:
+            self.steps = self.depth = self.deepest = 0
+            self.started = time.perf_counter()
+            self.stopped = None
+            self.__deadline = None if self.maxTime is None else self.started + self.maxTime
+        active = _activeParse.active
+        self.__saved.append(active)
+        _activeParse.active = (active[0] if active else None, self)
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        _activeParse.active = self.__saved.pop()
+        if not self.__saved:
+            self.stopped = time.perf_counter()
+        if exc_type is RecursionError and not self.__saved:
+            raise BudgetExceededError('Parse exceeded the maximum depth of the Python stack, at depth {}'.format(self.deepest)) from exc_value
+        return False
+    
+    def step(self):
+        '''Charges the budget for an attempt to match a pattern, one level deeper than the current one. The caller decrements depth afterwards.
+        Raises a BudgetExceededError if a limit is exceeded.'''
+        self.steps += 1
+        if self.maxSteps is not None and self.steps > self.maxSteps:
+            raise BudgetExceededError('Parse exceeded the maximum of {} steps'.format(self.maxSteps))
+        # looking at the clock takes longer than a step
+        if self.__deadline is not None and not self.steps & 0x3f and time.perf_counter() > self.__deadline:
+            raise BudgetExceededError('Parse exceeded the maximum time of {} seconds'.format(self.maxTime))
+        if self.depth == self.deepest:
+            if self.maxDepth is not None and self.depth == self.maxDepth:
+                raise BudgetExceededError('Parse exceeded the maximum depth of {}'.format(self.maxDepth))
+            self.deepest += 1
+        self.depth += 1
+    
+    def getStats(self):
+        '''Returns a dict with the steps, the largest depth and the time in seconds of the last (or current) parse, and the limits.'''
+        if self.started is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self.stopped if self.stopped is not None else time.perf_counter()) - self.started
+        return {'steps': self.steps, 'depth': self.deepest, 'time': elapsed, 'maxSteps': self.maxSteps, 'maxDepth': self.maxDepth, 'maxTime': self.maxTime}
+    
+class ParseCache:
+    '''Bounded cache for parse results, e.g. for parse requests that are repeated literally. It maps a key (typically the string that was parsed,
+    together with anything else that determines the result) to a parsed tree, and is bounded both by the number of entries and by their approximate
+    size in bytes. When either bound is exceeded, least recently used entries are evicted. A tree that by itself exceeds the byte bound is not stored.
+    
+    The cached trees are masters that are never handed out: set() stores a copy of the tree, and get() returns a fresh copy of the master (see
+    ParseStruct._clone(), which is much cheaper than parsing). Callers can therefore change the trees they get, e.g. with updateWith(), without affecting
+    the cache. A FlatTree (see below) is read-only, and is stored and handed out as it is.
+    The hit, miss and eviction counters are cumulative, until resetStats() is called.'''
+    
+    def __init__(self, maxEntries=1000, maxBytes=64 * 2**20):
+        assert maxEntries > 0 and maxBytes > 0, 'ParseCache bounds must be positive, got {} and {}'.format(maxEntries, maxBytes)
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.bytes = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        self.resetStats()
+        
+    def __len__(self):
+        return len(self.__entries)
+    
+    def get(self, key):
+        '''Returns a copy of the tree stored for key, or None if there is none.'''
+        with self.__lock:
+            try:
+                master, _ = self.__entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+        return master._clone()
+    
+    def set(self, key, tree):
+        '''Stores a copy of tree for key.'''
+        master = tree._clone()
+        size = self.sizeOf(master) + sys.getsizeof(key)
+        if size > self.maxBytes:
+            return
+        with self.__lock:
+            if key in self.__entries:
+                self.bytes -= self.__entries.pop(key)[1]
+            self.__entries[key] = (master, size)
+            self.bytes += size
+            while len(self.__entries) > self.maxEntries or self.bytes > self.maxBytes:
+                self.bytes -= self.__entries.popitem(last=False)[1][1]
+                self.evictions += 1
+    
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.bytes = 0
+        
+    def resetStats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+    def getStats(self):
+        '''Returns a dict with the hit, miss and eviction counters, the hit rate, the current number of entries and their approximate size in bytes,
+        and the bounds of the cache.'''
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'hitRate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self), 'bytes': self.bytes, 'maxEntries': self.maxEntries, 'maxBytes': self.maxBytes}
+    
+    @staticmethod
+    def sizeOf(tree):
+        '''Returns the approximate size in bytes of a tree of ParseStruct objects: the objects themselves (including their slots), their attribute dicts
+        if they have one, item lists, strings and cached renderings and digests (see ParseStruct.__str__() and getDigest()). For a FlatTree, see FlatTree.getSize().'''
+        if isinstance(tree, FlatTree):
+            return tree.getSize()
+        size = 0
+        stack = [tree]
+        while stack:
+            e = stack.pop()
+            size += sys.getsizeof(e) + sys.getsizeof(e._items)
+            if e._string is not None:
+                size += sys.getsizeof(e._string)
+            if e._digest is not None:
+                size += sys.getsizeof(e._digest)
+            if hasattr(e, '__dict__'):
+                size += sys.getsizeof(e.__dict__)
+            for i in e._items:
+                if isinstance(i, ParseStruct):
+                    stack.append(i)
+                else:
+                    size += sys.getsizeof(i)
+        return size
+
+class InternTable:
+    '''Table of interned strings and prefix dicts, so that the trees parsed with it share one object for each distinct terminal string (e.g.
+    a variable name or an IRI) and each distinct set of prefixes, instead of holding a copy per tree. Keywords and punctuation are shared
+    already, as pyparsing returns the strings of its patterns for them. An instance is attached to a Parser object when interning is enabled for
+    that parser (see e.g. Parser.enableInterning() in the SPARQL parser), and can be shared by several parsers, or be used for one corpus of trees only.
+    Unlike sys.intern(), the table can be cleared, which does not affect the trees that share its objects.
+    
+    The table holds at most maxEntries objects; values that are not in the table when it is full are returned as they are. The dicts handed out
+    are shared and must not be changed in place, which is already the case for the prefix dicts of the elements of a tree.
+    The hit and miss counters, and the number of bytes saved by returning an interned object instead of an equal copy, are cumulative until
+    resetStats() is called.'''
+    
+    def __init__(self, maxEntries=2**20):
+        assert maxEntries > 0, 'InternTable maxEntries must be positive, got {}'.format(maxEntries)
+        self.maxEntries = maxEntries
+        self.bytes = 0
+        self.__strings = {}
+        self.__dicts = {}
+        self.resetStats()
+    
+    def __len__(self):
+        return len(self.__strings) + len(self.__dicts)
+    
+    def intern(self, value):
+        '''Returns the object in the table that is equal to value, after adding value if there is none. Value is a string, or a dict with
+        strings as keys and values, such as the prefixes of an element. Other values are returned as they are.'''
+        if type(value) is str:
+            table, key = self.__strings, value
+        elif type(value) is dict:
+            table, key = self.__dicts, tuple(value.items())
+        else:
+            return value
+        found = table.get(key)
+        if found is None:
+            self.misses += 1
+            if len(self) >= self.maxEntries:
+                return value
+            if table is self.__dicts:
+                value = dict((self.intern(k), self.intern(v)) for (k, v) in key)
+            found = table.setdefault(key, value)
+            self.bytes += sys.getsizeof(found)
+        else:
+            self.hits += 1
+            if found is not value:
+                self.savedBytes += sys.getsizeof(value)
+        return found
+    
+    def clear(self):
+        self.__strings.clear()
+        self.__dicts.clear()
+        self.bytes = 0
+    
+    def resetStats(self):
+        self.hits = 0
+        self.misses = 0
+        self.savedBytes = 0
+    
+    def getStats(self):
+        '''Returns a dict with the hit and miss counters, the bytes saved, the current number of strings and dicts in the table and their size in bytes,
+        and the bound of the table.'''
+        return {'hits': self.hits, 'misses': self.misses, 'savedBytes': self.savedBytes, 'strings': len(self.__strings), 'dicts': len(self.__dicts),
+                'bytes': self.bytes, 'maxEntries': self.maxEntries}
+
+class KeywordDispatch(MatchFirst):
+    '''Ordered choice between alternatives, most of which start with a keyword, as in BuiltInCall. A MatchFirst tries all its alternatives in turn,
+    so that a call to isNUMERIC pays for some fifty failed keyword matches first. A KeywordDispatch peeks at the run of keyword characters at the
+    current location, and only tries the alternatives that can start with that keyword (compared case insensitively), together with the alternatives
+    that do not start with a keyword, in their original order. The first alternative that matches wins, as in a MatchFirst, so the parse result is the same.
+    Failures are also reported as by a MatchFirst.
+
+    The argument is a MatchFirst, e.g. a | b | c, or a list of alternatives. The dispatch table is built on first use, when all Forward patterns
+    of the grammar have been defined. It can be inspected with getTable(). Setting the attribute "dispatch" to False makes the
+    pattern behave as a plain MatchFirst, for comparison.'''
+
+    dispatch = True
+
+    __keywordChars = frozenset(Keyword.DEFAULT_KEYWORD_CHARS)
+    __peek = re.compile('[{}]*'.format(re.escape(Keyword.DEFAULT_KEYWORD_CHARS))).match
+
+    def __init__(self, exprs):
+        if isinstance(exprs, ParserElement):
+            exprs = [exprs]
+
+        def flatten(e):
+            # a | b | c is MatchFirst([MatchFirst([a, b]), c]), see MatchFirst.streamline()
+            if type(e) is MatchFirst and not e.parseAction and e.resultsName is None and not e.debug:
+                return [x for sub in e.exprs for x in flatten(sub)]
+            return [e]
+
+        self.__table = None
+        super().__init__([x for e in exprs for x in flatten(e)])
+
+    def streamline(self):
+        if not self.streamlined:
+            self.__table = None
+        return super().streamline()
+
+    def append(self, other):
+        self.__table = None
+        return super().append(other)
+
+    def copy(self):
+        result = super().copy()
+        result.__table = None
+        return result
+
+    @classmethod
+    def leadingKeywords(cls, expr, _seen=None):
+        '''Returns the set of (upper case) keywords that every match of expr starts with, or None if expr can match something that does not start
+        with a keyword, or the empty string.'''
+        seen = set() if _seen is None else _seen
+        if not expr.skipWhitespace:
+            return None
+        if isinstance(expr, Keyword):
+            identChars = set(expr.identChars)
+            if expr.caseless:
+                peekChars = set(c.upper() for c in cls.__keywordChars)
+            else:
+                peekChars = cls.__keywordChars
+            if set(expr.match) <= cls.__keywordChars and peekChars <= identChars:
+                return {expr.match.upper()}
+            return None
+        elif isinstance(expr, And):
+            result = set()
+            for e in expr.exprs:
+                if isinstance(e, (Opt, ZeroOrMore)):
+                    keywords = cls.leadingKeywords(e.expr, seen)
+                    if keywords is None:
+                        return None
+                    result |= keywords
+                else:
+                    keywords = cls.leadingKeywords(e, seen)
+                    if keywords is None:
+                        return None
+                    return result | keywords
+            return None
+        elif isinstance(expr, MatchFirst):
+            result = set()
+            for e in expr.exprs:
+                keywords = cls.leadingKeywords(e, seen)
+                if keywords is None:
+                    return None
+                result |= keywords
+            return result or None
+        elif isinstance(expr, (Forward, TokenConverter, OneOrMore)):
+            if expr.expr is None or id(expr) in seen:
+                return None
+            seen.add(id(expr))
+            return cls.leadingKeywords(expr.expr, seen)
+        return None
+
+    def getTable(self):
+        '''Returns the dispatch table, as a dict from keywords to the tuple of alternatives to try, and the tuple of alternatives to try for
+        anything else.'''
+        if self.__table is None:
+            leading = [(e, self.leadingKeywords(e)) for e in self.exprs]
+            keywords = set().union(*(k for (_, k) in leading if k is not None))
+            table = dict((k, tuple(e for (e, ks) in leading if ks is None or k in ks)) for k in keywords)
+            self.__table = table, tuple(e for (e, ks) in leading if ks is None)
+        return self.__table
+
+    def parseImpl(self, instring, loc, doActions=True):
+        if not self.dispatch:
+            return super().parseImpl(instring, loc, doActions)
+        table, others = self.getTable()
+        start = self.preParse(instring, loc)
+        exprs = table.get(self.__peek(instring, start).group().upper(), others)
+        maxExcLoc = -1
+        maxException = None
+        # the rest is MatchFirst.parseImpl() for the selected alternatives; the alternatives that are skipped would have failed at start
+        for e in exprs:
+            try:
+                return e._parse(instring, loc, doActions)
+            except ParseFatalException as pfe:
+                pfe.__traceback__ = None
+                pfe.parser_element = e
+                raise
+            except ParseException as err:
+                if err.loc > maxExcLoc:
+                    maxException = err
+                    maxExcLoc = err.loc
+            except IndexError:
+                if len(instring) > maxExcLoc:
+                    maxException = ParseException(instring, len(instring), e.errmsg, self)
+                    maxExcLoc = len(instring)
+        if maxException is not None:
+            if maxExcLoc == start:
+                maxException.msg = self.errmsg or ''
+            raise maxException
+        if self.exprs:
+            raise ParseException(instring, start, self.errmsg, self)
+        raise ParseException(instring, loc, 'no defined alternatives to match', self)
+
 def parseStructFunc(class_):
     '''Returns the function that converts a ParseResults object to a ParseStruct object of class "class_", with label set to None, and
     items set to a recursive list of objects, each of which is either a string or a further ParseStruct object.
     The function returned is used to set a parseAction for a _pattern.'''
             
-    def itemList(parseresults):
+    def itemList(parseresults, table, parent):
         '''For internal use. Converts a ParseResults object to a recursive structure consisting of a list of objects,
-        which will serve as the items attribute of a ParseStruct object.'''
+        which will serve as the items attribute of a ParseStruct object, parent. The strings are interned in table, if it is not None,
+        and the parent pointers of the ParseStruct objects in the list are set to parent, so that no separate pass over the tree is needed.'''
         
         while len(parseresults) == 1 and isinstance(parseresults[0], ParseResults):
             parseresults = parseresults[0]
-        valuedict = dict((id(t), k) for (k, t) in parseresults.items())
-        assert len(valuedict) == len(list(parseresults.items())), 'internal error: len(valuedict) = {}, len(parseresults.items) = {}'.format(len(valuedict), len(list(parseresults.items)))
+        # most results have no names, and then need no dict
+        if parseresults.haskeys():
+            items = list(parseresults.items())
+            valuedict = dict((id(t), k) for (k, t) in items)
+            assert len(valuedict) == len(items), 'internal error: len(valuedict) = {}, len(parseresults.items) = {}'.format(len(valuedict), len(items))
+        else:
+            valuedict = {}
         result = []
         for t in parseresults:
             if isinstance(t, str):
-                result.append(t)
+                result.append(t if table is None else table.intern(t))
             elif isinstance(t, ParseStruct):
-                if t.__dict__['_label'] == None:
-                    t.__dict__['_label'] = valuedict.get(id(t))
+                if t._label == None:
+                    object.__setattr__(t, '_label', valuedict.get(id(t)))
+                object.__setattr__(t, '_parent', parent)
                 result.append(t)
             elif isinstance(t, list):
                 result.append(t)
             else:
                 assert isinstance(t, ParseResults), type(t)
                 assert valuedict.get(id(t)) == None, 'Error: found label ({}) for compound expression {}'.format(valuedict.get(id(t)), t.__str__())
-                result.extend(itemList(t))
+                result.extend(itemList(t, table, parent))
         return result
     
     def makeparseinfo(parseresults):
@@ -311,11 +1210,638 @@ def parseStructFunc(class_):
         assert issubclass(class_, ParseStruct)
         assert isinstance(parseresults, ParseResults)
         result = class_(None)
-        result.setItems(itemList(parseresults))
+        result.setItems(itemList(parseresults, class_._getInternTable(), result))
         return result
     
+    makeparseinfo.structClass = class_
     return makeparseinfo
 
+# Helper functions to move trees between processes
+
+def packTree(tree):
+    '''Returns a compact form of a tree of ParseStruct objects, consisting of tuples, strings and ints, that can be pickled (e.g. to send it to another
+    process), whereas ParseStruct objects themselves cannot. unpackTree() rebuilds the tree. The form is flat rather than nested, so that pickling deep
+    trees does not run into recursion limits: a tuple with the names of the classes used, a tuple with the distinct sets of further attributes
+    (e.g. prefixes), and a tuple with one (class index, label, attribute set index, items) tuple per node, where items contains
+    the strings of the node and, for child nodes, their index in the node tuple.'''
+    classes = {}
+    attributes = {}
+    nodes = []
+    order = [tree]
+    for e in order:
+        items = []
+        for i in e._items:
+            if isinstance(i, ParseStruct):
+                items.append(len(order))
+                order.append(i)
+            else:
+                items.append(i)
+        extra = dict((k, v) for (k, v) in e._getAttributes().items() if k not in ParseStruct.__slots__)
+        key = tuple((k, id(v)) for (k, v) in extra.items())
+        if key not in attributes:
+            attributes[key] = (len(attributes), extra)
+        nodes.append((classes.setdefault(e.__class__.__name__, len(classes)), e._label, attributes[key][0], tuple(items)))
+    return tuple(classes), tuple(extra for (_, extra) in sorted(attributes.values(), key=lambda a: a[0])), tuple(nodes)
+
+def unpackTree(packed, parser):
+    '''Rebuilds a tree from the result of packTree(), with the ParseStruct subclasses of the given Parser object, and sets its parent pointers.
+    If the Parser object interns strings (see InternTable above), the strings, labels and attributes of the tree are interned in its table, as the
+    unpickled ones are copies.'''
+    classNames, attributes, nodes = packed
+    classes = [getattr(parser, name) for name in classNames]
+    table = getattr(parser, 'internTable', None)
+    intern = table.intern if table is not None else lambda value: value
+    attributes = [dict((k, intern(v)) for (k, v) in a.items()) for a in attributes]
+    elements = [object.__new__(classes[c]) for (c, _, _, _) in nodes]
+    for (e, (_, label, a, items)) in zip(elements, nodes):
+        object.__setattr__(e, '_items', [elements[i] if isinstance(i, int) else intern(i) for i in items])
+        object.__setattr__(e, '_label', intern(label))
+        object.__setattr__(e, '_parent', None)
+        object.__setattr__(e, '_string', None)
+        object.__setattr__(e, '_digest', None)
+        object.__setattr__(e, '_labelIndex', None)
+        object.__setattr__(e, '_typeIndex', None)
+        e._setAttributes(attributes[a])
+    for e in elements:
+        for i in e._items:
+            if isinstance(i, ParseStruct):
+                object.__setattr__(i, '_parent', e)
+    return elements[0]
+
+# Flat, array based encoding of trees
+
+class FlatTree:
+    '''Read-only encoding of a tree of ParseStruct objects in parallel arrays, instead of one object per element, e.g. to keep many parsed queries
+    in memory, or to send them between processes. Each element of the tree, and each string in the items of an element, is an entry.
+    The entries are numbered in preorder, so that entry 0 is the top element and the entries of a subtree are consecutive. For entry i:
+    
+    - classIds[i] is the index of the class of the element in classes, or -1 for a string;
+    - values[i] is the index of the label of the element in labels (labels[0] is None), or the index of the string in strings, or -1 for a string
+      that is the same as its span in text: such span leaves are not stored, but sliced from text when they are needed (see getString());
+    - parents[i], firstChildren[i] and nextSiblings[i] are the entries of its parent, its first item and the next item of its parent, or -1;
+    - starts[i] and ends[i] are its span in text, or -1 if no spans were given;
+    - attributeIds[i] is the index of the further attributes of the element (e.g. its prefixes) in attributes, or -1 for a string.
+    
+    The tree is built from a ParseStruct tree in one pass, after which that tree is no longer needed. The spans, if given, map the id of an element
+    to its (start, end) span in text, and an (id of an element, position in its items) pair to the span of a string. Elements are navigated through
+    FlatElement views, which are made only for the entries that are visited; getRoot() returns the view of the top element.'''
+    
+    def __init__(self, tree, text=None, spans=None):
+        self.text = text
+        self.classes = []
+        self.labels = [None]
+        self.strings = []
+        self.attributes = []
+        classIndex = {}
+        labelIndex = {None: 0}
+        stringIndex = {}
+        attributeIndex = {}
+        # per class, its index, the names of its further slots, and a function that returns their values as a tuple (see ParseStruct._clone())
+        extras = {}
+        spans = spans or {}
+        # the columns are built as lists, and converted to arrays at the end
+        classIds, values, parents, firstChildren, nextSiblings, starts, ends, attributeIds = columns = [[] for _ in range(8)]
+        
+        def addElement(e, parent):
+            cls = e.__class__
+            try:
+                classId, names, getter = extras[cls]
+            except KeyError:
+                classIndex[cls] = classId = len(self.classes)
+                self.classes.append(cls)
+                names = tuple(name for name in cls._getSlotNames() if name not in ParseStruct.__slots__)
+                getter = attrgetter('_label', *names) if names else None
+                classId, names, getter = extras.setdefault(cls, (classId, names, getter))
+            if cls.__dictoffset__:
+                extra = dict((k, v) for (k, v) in e._getAttributes().items() if k not in ParseStruct.__slots__)
+                key = tuple((k, id(v)) for (k, v) in extra.items())
+            else:
+                extra = getter(e)[1:] if getter else ()
+                key = (names, tuple(map(id, extra)))
+            if key not in attributeIndex:
+                attributeIndex[key] = len(self.attributes)
+                self.attributes.append(extra if cls.__dictoffset__ else dict(zip(names, extra)))
+            label = e._label
+            if label not in labelIndex:
+                labelIndex[label] = len(self.labels)
+                self.labels.append(label)
+            span = spans.get(id(e))
+            classIds.append(classId)
+            values.append(labelIndex[label])
+            attributeIds.append(attributeIndex[key])
+            return span
+        
+        span = addElement(tree, -1)
+        for (column, value) in ((parents, -1), (firstChildren, -1), (nextSiblings, -1)):
+            column.append(value)
+        starts.append(span[0] if span else -1)
+        ends.append(span[1] if span else -1)
+        # frames of [entry of an element, iterator over its (position, item) pairs, id of the element, entry of the last item added]
+        stack = [[0, enumerate(tree._items), id(tree), -1]]
+        while stack:
+            frame = stack[-1]
+            for (k, item) in frame[1]:
+                i = len(classIds)
+                if isinstance(item, str):
+                    span = spans.get((frame[2], k))
+                    if span and text is not None and span[1] - span[0] == len(item) and text.startswith(item, span[0]):
+                        values.append(-1)
+                    else:
+                        if item not in stringIndex:
+                            stringIndex[item] = len(self.strings)
+                            self.strings.append(item)
+                        values.append(stringIndex[item])
+                    classIds.append(-1)
+                    attributeIds.append(-1)
+                else:
+                    assert isinstance(item, ParseStruct), 'FlatTree: found value {} of type {} instead of ParseStruct instance'.format(item, type(item))
+                    span = addElement(item, frame[0])
+                parents.append(frame[0])
+                firstChildren.append(-1)
+                nextSiblings.append(-1)
+                starts.append(span[0] if span else -1)
+                ends.append(span[1] if span else -1)
+                if frame[3] < 0:
+                    firstChildren[frame[0]] = i
+                else:
+                    nextSiblings[frame[3]] = i
+                frame[3] = i
+                if not isinstance(item, str):
+                    stack.append([i, enumerate(item._items), id(item), -1])
+                    break
+            else:
+                stack.pop()
+        # indexes and offsets mostly fit in two bytes
+        for (name, column) in zip(('classIds', 'values', 'parents', 'firstChildren', 'nextSiblings', 'starts', 'ends', 'attributeIds'), columns):
+            setattr(self, name, array('h' if max(column) < 2**15 else 'i', column))
+        self.__classIndex = classIndex
+    
+    
+    def __len__(self):
+        return len(self.classIds)
+    
+    def getRoot(self):
+        '''Returns the view of the top element.'''
+        return FlatElement(self, 0)
+    
+    def getString(self, i):
+        '''Returns the string of entry i, which must be a string.'''
+        value = self.values[i]
+        return self.strings[value] if value >= 0 else self.text[self.starts[i]:self.ends[i]]
+    
+    def getClassId(self, cls):
+        '''Returns the index of cls in classes, or None if the tree has no elements of that class.'''
+        return self.__classIndex.get(cls)
+    
+    def getSize(self):
+        '''Returns the approximate size in bytes of the tree: its arrays, the strings, labels and text it holds, and the lists that hold them.
+        The attributes (e.g. prefix dicts) are not included, as they are shared with other trees.'''
+        size = sys.getsizeof(self.text) if self.text is not None else 0
+        for a in (self.classIds, self.values, self.parents, self.firstChildren, self.nextSiblings, self.starts, self.ends, self.attributeIds):
+            size += sys.getsizeof(a)
+        for table in (self.strings, self.labels):
+            size += sys.getsizeof(table) + sum(sys.getsizeof(s) for s in table if s is not None)
+        return size + sys.getsizeof(self.classes) + sys.getsizeof(self.attributes)
+    
+    def _clone(self):
+        # read-only, so a ParseCache can hand out the tree itself
+        return self
+    
+    def pack(self):
+        '''Returns a picklable form of the tree, with the names of its classes instead of the classes themselves (see packTree()).
+        FlatTree.unpack() rebuilds the tree.'''
+        return (tuple(cls.__name__ for cls in self.classes), tuple(self.labels), tuple(self.strings), tuple(self.attributes), self.text,
+                (self.classIds, self.values, self.parents, self.firstChildren, self.nextSiblings, self.starts, self.ends, self.attributeIds))
+    
+    @classmethod
+    def unpack(cls, packed, parser):
+        '''Rebuilds a tree from the result of pack(), with the ParseStruct subclasses of the given Parser object. As in unpackTree(), the tables
+        of the tree are interned if the Parser object interns strings.'''
+        classNames, labels, strings, attributes, text, arrays = packed
+        tree = object.__new__(cls)
+        tree.classes = [getattr(parser, name) for name in classNames]
+        table = getattr(parser, 'internTable', None)
+        if table is not None:
+            labels = [table.intern(label) for label in labels]
+            strings = [table.intern(string) for string in strings]
+            attributes = [dict((k, table.intern(v)) for (k, v) in a.items()) for a in attributes]
+        tree.labels, tree.strings, tree.attributes, tree.text = list(labels), list(strings), list(attributes), text
+        (tree.classIds, tree.values, tree.parents, tree.firstChildren, tree.nextSiblings, tree.starts, tree.ends, tree.attributeIds) = arrays
+        tree.__classIndex = dict((c, i) for (i, c) in enumerate(tree.classes))
+        return tree
+
+class FlatElement:
+    '''View of an element of a FlatTree, with the read-only methods of ParseStruct: getLabel(), getItems(), getChildren(), getParent(),
+    getAncestors(), searchElements(), dump() etc., and the same dot access to the subelements by their label. Views are made when they are
+    returned, e.g. getChildren() makes a view per child, and hold no state other than their tree and entry. getType() returns the ParseStruct
+    subclass of the element, and toParseStruct() a ParseStruct tree for the element and its subtree. A view compares equal to a view or a
+    ParseStruct object with the same class and string.'''
+    
+    __slots__ = ('_tree', '_index')
+    
+    def __init__(self, tree, index):
+        assert tree.classIds[index] >= 0, 'FlatElement: entry {} is a string'.format(index)
+        object.__setattr__(self, '_tree', tree)
+        object.__setattr__(self, '_index', index)
+        
+    def __setattr__(self, label, value):
+        raise AttributeError('FlatTree elements are read-only. Use toParseStruct() to get an element that can be changed.')
+    
+    def __getattr__(self, att):
+        '''Retrieves the unique, direct subelement having a label equal to the argument, as ParseStruct.__getattr__() does.'''
+        if att.startswith('__') or att in FlatElement.__slots__:
+            raise AttributeError(att)
+        values = self.getValuesForLabel(att)
+        if len(values) == 1:
+            return values[0]
+        if not values:
+            raise AttributeError('No attribute, or unique label found for argument "{}".'.format(att))
+    
+    def __eq__(self, other):
+        if isinstance(other, FlatElement):
+            return self.getType() == other.getType() and str(self) == str(other)
+        return isinstance(other, ParseStruct) and self.getType() == other.__class__ and str(self) == str(other)
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __repr__(self):
+        return self.getType().__name__ + '("' + str(self) + '")'
+    
+    def __str__(self):
+        '''Returns the same string as the ParseStruct element would.'''
+        tree = self._tree
+        classIds = tree.classIds
+        strings = [tree.getString(i) for i in range(self._index, self.__end()) if classIds[i] < 0]
+        return ' '.join([s for s in strings if s != ''])
+    
+    def __end(self):
+        '''Returns the entry after the subtree of the element.'''
+        tree = self._tree
+        i = self._index
+        while i >= 0 and tree.nextSiblings[i] < 0:
+            i = tree.parents[i]
+        return tree.nextSiblings[i] if i >= 0 else len(tree)
+    
+    def __entries(self):
+        '''Yields the entries of the items of the element.'''
+        tree = self._tree
+        i = tree.firstChildren[self._index]
+        while i >= 0:
+            yield i
+            i = tree.nextSiblings[i]
+    
+    def __view(self, i):
+        tree = self._tree
+        return FlatElement(tree, i) if tree.classIds[i] >= 0 else tree.getString(i)
+    
+    def getTree(self):
+        return self._tree
+    
+    def getIndex(self):
+        '''Returns the entry of the element in its tree.'''
+        return self._index
+    
+    def getType(self):
+        '''Returns the ParseStruct subclass of the element.'''
+        return self._tree.classes[self._tree.classIds[self._index]]
+    
+    def getSpan(self):
+        '''Returns the (start, end) span of the element in the text of its tree, or None if it is not known.'''
+        tree = self._tree
+        start = tree.starts[self._index]
+        return (start, tree.ends[self._index]) if start >= 0 else None
+    
+    def getSourceText(self):
+        '''Returns the part of the text of its tree that the element spans, in a single slice, or None if its span is not known. Unlike str(),
+        this keeps the whitespace between the strings, and the case of keywords, as they are in the text.'''
+        span = self.getSpan()
+        return self._tree.text[span[0]:span[1]] if span else None
+    
+    def getAttributes(self):
+        '''Returns a dict with the further attributes of the element, such as _prefixes and _baseiri for SPARQL elements.'''
+        return self._tree.attributes[self._tree.attributeIds[self._index]]
+    
+    def getLabel(self):
+        return self._tree.labels[self._tree.values[self._index]]
+    
+    def getItems(self):
+        return [self.__view(i) for i in self.__entries()]
+    
+    def hasLabel(self, k):
+        return k in self.getLabels()
+    
+    def getLabels(self):
+        return [e.getLabel() for e in self.getChildren() if e.getLabel()]
+    
+    def getValuesForLabel(self, k):
+        return [e for e in self.getChildren() if e.getLabel() == k]
+    
+    def getChildren(self):
+        classIds = self._tree.classIds
+        return [FlatElement(self._tree, i) for i in self.__entries() if classIds[i] >= 0]
+    
+    def getParent(self):
+        parent = self._tree.parents[self._index]
+        return FlatElement(self._tree, parent) if parent >= 0 else None
+    
+    def getAncestors(self):
+        tree = self._tree
+        result = []
+        i = tree.parents[self._index]
+        while i >= 0:
+            result.append(FlatElement(tree, i))
+            i = tree.parents[i]
+        return result
+    
+    def isBranch(self):
+        return len(list(self.__entries())) > 1
+    
+    def isAtom(self):
+        entries = list(self.__entries())
+        return len(entries) == 1 and self._tree.classIds[entries[0]] < 0
+    
+    def descend(self):
+        result = self
+        while not result.isAtom() and not result.isBranch():
+            result = result.getItems()[0]
+        return result
+    
+    def searchElements(self, *, label=None, element_type=None, value=None, labeledOnly=False):
+        '''Returns the same elements as ParseStruct.searchElements() would, as views. The class and label of the entries are compared in the arrays
+        of the tree, so that views are only made for the elements found; value is parsed once per class rather than once per element.'''
+        tree = self._tree
+        classIds, values = tree.classIds, tree.values
+        classId = None
+        if element_type:
+            classId = tree.getClassId(element_type)
+            if classId is None:
+                return []
+        labelId = None
+        if label:
+            if label not in tree.labels:
+                return []
+            labelId = tree.labels.index(label)
+        parsed = {}
+        result = []
+        # like ParseStruct.searchElements(), which considers the element itself twice
+        entries = range(self._index, self.__end())
+        for i in [self._index] + [i for i in entries if classIds[i] >= 0]:
+            if labeledOnly and not values[i]:
+                continue
+            if labelId is not None and values[i] != labelId:
+                continue
+            if classId is not None and classIds[i] != classId:
+                continue
+            e = FlatElement(tree, i)
+            if value:
+                c = classIds[i]
+                if c not in parsed:
+                    try:
+                        parsed[c] = str(tree.classes[c]._parseString(value, parseAll=False)[0])
+                    except ParseException:
+                        parsed[c] = None
+                if parsed[c] is None or parsed[c] != str(e):
+                    continue
+            result.append(e)
+        return result
+    
+    def select(self, selector):
+        '''Returns the same elements as ParseStruct.select() would, as views.'''
+        return Selector.compile(selector).select(self)
+    
+    def iterSelect(self, selector):
+        '''Generator version of select().'''
+        return Selector.compile(selector).iterSelect(self)
+    
+    def dump(self, indent='', step='|  '):
+        '''Returns the same dump as ParseStruct.dump() would.'''
+        result = []
+        stack = [(self, indent)]
+        while stack:
+            i, indent = stack.pop()
+            if isinstance(i, str):
+                result.append(indent + i + '\n')
+            else:
+                result.append(indent + ('> '+ i.getLabel() + ':\n' + indent if i.getLabel() else '') + '[' + i.getType().__name__ + '] ' + '/' + str(i) + '/' + '\n')
+                stack.extend((t, indent + step) for t in reversed(i.getItems()))
+        return ''.join(result)
+    
+    def toParseStruct(self):
+        '''Returns a tree of ParseStruct objects for the element and its subtree, with parent pointers, labels and further attributes.
+        The top element has no parent.'''
+        tree = self._tree
+        elements = {}
+        for i in range(self._index, self.__end()):
+            c = tree.classIds[i]
+            if c < 0:
+                item = tree.getString(i)
+            else:
+                item = object.__new__(tree.classes[c])
+                object.__setattr__(item, '_items', [])
+                object.__setattr__(item, '_label', tree.labels[tree.values[i]])
+                object.__setattr__(item, '_parent', elements.get(tree.parents[i]))
+                object.__setattr__(item, '_string', None)
+                object.__setattr__(item, '_digest', None)
+                object.__setattr__(item, '_labelIndex', None)
+                object.__setattr__(item, '_typeIndex', None)
+                item._setAttributes(tree.attributes[tree.attributeIds[i]])
+                elements[i] = item
+            if i != self._index:
+                elements[tree.parents[i]]._items.append(item)
+        return elements[self._index]
+
+# Selector language
+
+class Selector:
+    '''A compiled selector: a path expression, similar to an XPath location path, that selects elements from a tree of ParseStruct (or FlatElement)
+    objects by class, label and rendering. A selector is a sequence of steps, separated by "/" (the next step matches a child of the element
+    matched by the previous step) or "//" (a descendant, at any depth). A step is the name of a ParseStruct subclass, or "*" for any class, followed
+    by zero or more predicates in square brackets, which must all hold. A selector is evaluated relative to an element, the context element. If it
+    starts with "/", the first step matches the context element itself, with "//" the context element or any element below it, with ".//" any element
+    below it, and otherwise (no prefix) a child of it.
+    
+    In a predicate, "." stands for the rendering of the element (see ParseStruct.__str__()) and "@label" for its label. Predicates are:
+    - operand = 'string' and operand != 'string', with operand "." or "@label" and the string in single or double quotes (with \\ as escape);
+    - contains(operand, 'string'), starts-with(operand, 'string') and ends-with(operand, 'string');
+    - @label: the element has a label;
+    - not(predicate);
+    - a selector without prefix or with prefix ".//": there is at least one element that it selects, relative to the element.
+    Examples, with the classes of SPARQLParser:
+    - "//OptionalGraphPattern//Filter//Var": every Var in a FILTER in an OPTIONAL clause;
+    - "//PrefixDecl/*[@label='namespace']": the namespace of every PREFIX declaration;
+    - "//Filter[.//Var[.='?x']]": every FILTER that uses variable ?x;
+    - "//GroupGraphPattern[not(.//ServiceGraphPattern)]": every group without a SERVICE clause.
+    The selector is parsed once, when the Selector is made (a ParsertoolsException is raised for invalid syntax), into a matcher per step. iterSelect()
+    then finds all selected elements in a single walk of the tree, in which it keeps for each element the steps that can still match it, and skips
+    the elements below an element for which there are none. See also ParseStruct.select() and iterSelect(), which take a selector string and
+    compile it on first use.'''
+    
+    # compiled selectors by selector string, see compile()
+    _compiled = {}
+    _maxCompiled = 1000
+    
+    # the syntax of selectors, see __grammar()
+    _grammar = None
+    
+    def __init__(self, selector):
+        assert isinstance(selector, str), 'Selector needs a string, got {}'.format(type(selector))
+        self.selector = selector
+        if Selector._grammar is None:
+            Selector._grammar = Selector.__grammar()
+        try:
+            self.__start, self.__steps = Selector._grammar.parseString(selector, parseAll=True)[0]
+        except ParseException as e:
+            raise ParsertoolsException('Invalid selector "{}": {}'.format(selector, e))
+    
+    def __repr__(self):
+        return 'Selector({!r})'.format(self.selector)
+    
+    @classmethod
+    def compile(cls, selector):
+        '''Returns selector if it is a Selector, else the Selector for the string selector. The Selectors made for strings are kept (up to
+        _maxCompiled of them), so that a selector string is parsed only once.'''
+        if isinstance(selector, Selector):
+            return selector
+        compiled = cls._compiled.get(selector)
+        if compiled is None:
+            compiled = Selector(selector)
+            if len(cls._compiled) >= cls._maxCompiled:
+                cls._compiled.clear()
+            cls._compiled[selector] = compiled
+        return compiled
+    
+    @staticmethod
+    def __grammar():
+        '''Returns the pyparsing pattern for selectors. Its parse actions build the matchers: a predicate becomes a function of an element, a step a
+        (class name or None, test) pair, with test the function of an element for its predicates or None, and the selector a (start, steps) pair,
+        with steps a list of (descendant, class name or None, test) tuples.'''
+        
+        def operand(token):
+            return (lambda e: str(e)) if token == '.' else (lambda e: e.getLabel())
+        
+        def comparison(tokens):
+            get, op, s = operand(tokens[0]), tokens[1], tokens[2]
+            if op == '=':
+                return lambda e: get(e) == s
+            return lambda e: get(e) != s
+        
+        def function(tokens):
+            name, get, s = tokens[0], operand(tokens[1]), tokens[2]
+            if name == 'contains':
+                return lambda e: s in (get(e) or '')
+            if name == 'starts-with':
+                return lambda e: (get(e) or '').startswith(s)
+            return lambda e: (get(e) or '').endswith(s)
+        
+        def negation(tokens):
+            p = tokens[0]
+            return lambda e: not p(e)
+        
+        def nested(tokens):
+            start, steps = tokens[0]
+            return lambda e: next(Selector._iterSelect(e, start, steps), None) is not None
+        
+        def step(tokens):
+            name, predicates = tokens[0], list(tokens[1:])
+            if len(predicates) > 1:
+                test = lambda e: all(p(e) for p in predicates)
+            else:
+                test = predicates[0] if predicates else None
+            return [(None if name == '*' else name, test)]
+        
+        def path(tokens):
+            start = tokens[0] if tokens[0] in ('/', '//', './/') else ''
+            tokens = tokens[1:] if start else tokens[:]
+            steps = [(start in ('//', './/'),) + tokens[0]]
+            for i in range(1, len(tokens), 2):
+                steps.append((tokens[i] == '//',) + tokens[i + 1])
+            return [(start, steps)]
+        
+        string = QuotedString("'", esc_char='\\') | QuotedString('"', esc_char='\\')
+        operandToken = Literal('@label') | Literal('.')
+        predicate = Forward()
+        relativePath = Forward()
+        comparisonPattern = (operandToken + (Literal('!=') | Literal('=')) + string).setParseAction(comparison)
+        functionPattern = ((Literal('contains') | Literal('starts-with') | Literal('ends-with')) + Suppress('(') + operandToken + Suppress(',') + string + Suppress(')')).setParseAction(function)
+        negationPattern = (Suppress(Literal('not') + '(') + predicate + Suppress(')')).setParseAction(negation)
+        labeledPattern = Literal('@label').setParseAction(lambda: (lambda e: bool(e.getLabel())))
+        nestedPattern = relativePath.copy().setParseAction(nested)
+        predicate <<= comparisonPattern | functionPattern | negationPattern | labeledPattern | nestedPattern
+        stepPattern = ((Word(alphas + '_', alphanums + '_') | Literal('*')) + ZeroOrMore(Suppress('[') + predicate + Suppress(']'))).setParseAction(step)
+        steps = stepPattern + ZeroOrMore((Literal('//') | Literal('/')) + stepPattern)
+        relativePath <<= (Optional(Literal('.//')) + steps).setParseAction(path)
+        return (Optional(Literal('//') | Literal('/') | Literal('.//')) + steps).setParseAction(path)
+    
+    def iterSelect(self, element):
+        '''Yields the elements selected by the selector relative to element, in preorder (the order of ParseStruct.searchElements()), each once.'''
+        return Selector._iterSelect(element, self.__start, self.__steps)
+    
+    def select(self, element):
+        '''Returns a list of the elements selected by the selector relative to element, in preorder.'''
+        return list(self.iterSelect(element))
+    
+    @staticmethod
+    def _iterSelect(element, start, steps):
+        # Each element is visited with a bit mask of the steps that may match it: step k (after the first) applies to the children of an element
+        # matched by step k - 1, and, if it is a descendant step, also to all elements below those. The element is selected if the last step matches.
+        tests = [(name, test) for (_, name, test) in steps]
+        descendants = sum(1 << k for (k, (descendant, _, _)) in enumerate(steps) if descendant)
+        lastBit = 1 << (len(steps) - 1)
+        following = lastBit - 1
+        if isinstance(element, ParseStruct):
+            typeName = attrgetter('__class__.__name__')
+            children = lambda e: [i for i in e._items if isinstance(i, ParseStruct)]
+            seeds = Selector.__seeds(element, start, steps[0][1])
+        else:
+            typeName = lambda e: e.getType().__name__
+            children = lambda e: e.getChildren()
+            seeds = None
+        if seeds is not None:
+            stack = [(seed, 1) for seed in reversed(seeds)]
+        elif start in ('/', '//'):
+            stack = [(element, 1)]
+        else:
+            stack = [(child, 1) for child in reversed(children(element))]
+        while stack:
+            e, active = stack.pop()
+            matched = 0
+            k = 0
+            bits = active
+            while bits:
+                if bits & 1:
+                    name, test = tests[k]
+                    if (name is None or typeName(e) == name) and (test is None or test(e)):
+                        matched |= 1 << k
+                bits >>= 1
+                k += 1
+            if matched & lastBit:
+                yield e
+            below = (active & descendants) | ((matched & following) << 1)
+            if below:
+                stack.extend((child, below) for child in reversed(children(e)))
+    
+    @staticmethod
+    def __seeds(element, start, name):
+        '''For a selector that starts with "//" and a class name, evaluated on the top element of a tree, returns the elements of that class in
+        preorder that are not below another one, from the index of the tree by class (see ParseStruct.searchElements()). No other element can match
+        the first step, so the walk can start from these. Returns None if the walk must start from element.'''
+        if start != '//' or name is None or element._parent is not None:
+            return None
+        cls = getattr(element.__class__._parser, name, None)
+        if not (isinstance(cls, type) and issubclass(cls, ParseStruct)):
+            return None
+        seeds = []
+        found = set()
+        for e in element.searchElements(element_type=cls):
+            a = e
+            while a is not None and id(a) not in found:
+                a = a._parent
+            if a is None:
+                seeds.append(e)
+            found.add(id(e))
+        return seeds
+
 # Helper function for delimited lists where the delimiters must be included in the result
 
 def separatedList(_pattern, sep=','):
@@ -331,7 +1857,7 @@ def separatedList(_pattern, sep=','):
         templist = []
         for item in parseresults:
             if isinstance(item, ParseStruct):
-                item.__dict__['_label'] = label
+                object.__setattr__(item, '_label', label)
                 templist.append(item)
             else:
                 assert isinstance(item, str)
@@ -344,6 +1870,7 @@ def separatedList(_pattern, sep=','):
         return result
   
       
+    makeList.separator = sep
     result = delimitedList(_pattern, sep)
     result.setParseAction(makeList)
     return result
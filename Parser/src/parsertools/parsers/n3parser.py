@@ -24,11 +24,13 @@ class N3Element(ParseStruct):
     '''Optional subclass of ParseStruct for the language. Typically, this class contains attributes and methods for the language that
     go beyond context free parsing, such as pre- and post processing, checking for conditions not covered by the grammar, etc.'''
     
-    def __init__(self, expr):
+    __slots__ = ()
+    
+    def __init__(self, expr, budget=None):
         '''This constructor has an optional argument "base". This is the externally determined base iri, as per SPARQL definition par. 4.1.1.2.
         It is only applied when the constructor is called with a string as expression to be parsed. (For internal bootstrapping purposes,
         the constructor can also be called with expr equal to "None". See also the documentation for the ParseStruct constructor.)'''
-        ParseStruct.__init__(self, expr)
+        ParseStruct.__init__(self, expr, budget=budget)
         if not expr is None:
             newexpr = _applyKeywords(expr)
 #             if postCheck:
@@ -139,7 +141,7 @@ class Parser:
             assert issubclass(newclass, self.__class)
         else:
             newclass = self.class_ 
-        setattr(self, pattern.name, type(pattern.name, (newclass,), {'_pattern': pattern}))
+        setattr(self, pattern.name, type(pattern.name, (newclass,), {'__slots__': (), '_pattern': pattern}))
         pattern.setParseAction(parseStructFunc(getattr(self, pattern.name)))
 
 #
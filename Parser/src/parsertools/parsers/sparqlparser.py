@@ -4,10 +4,20 @@ Created on 28 mrt. 2016
 @author: jeroenbruijning
 '''
 from pyparsing import *
-from parsertools.base import ParseStruct, parseStructFunc, separatedList
+from parsertools.base import ParseStruct, parseStructFunc, separatedList, MemoCache, ParseCache, InternTable, KeywordDispatch, packTree, unpackTree, FlatTree
+from parsertools.rdengine import RDEngine
 from parsertools import ParsertoolsException, NoPrefixError
 import rfc3987
 import re
+import io
+import os
+import pickle
+import asyncio
+import weakref
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+from contextlib import ExitStack
 
 # Custom exception. This is optional when defining a SPARQLParser. When present, it can be used in methods of the Parser class as defined below.
 
@@ -25,21 +35,24 @@ class SPARQLElement(ParseStruct):
     '''Optional subclass of ParseStruct for the language. Typically, this class contains attributes and methods for the language that
     go beyond context free parsing, such as pre- and post processing, checking for conditions not covered by the grammar, etc.'''
     
-    def __init__(self, expr, base=None, postParseCheck=True):
+    __slots__ = ('_prefixes', '_baseiri')
+    
+    def __init__(self, expr, base=None, postParseCheck=True, budget=None):
         '''This constructor has an optional argument "base". This is the externally determined base iri, as per SPARQL definition par. 4.1.1.2.
         It is only applied when the constructor is called with a string as expression to be parsed. (For internal bootstrapping purposes,
-        the constructor can also be called with expr equal to "None". See also the documentation for the ParseStruct constructor.)'''
-        ParseStruct.__init__(self, expr)
-        self.__dict__['_prefixes'] = {}
-        self.__dict__['_baseiri'] = None
+        the constructor can also be called with expr equal to "None". See also the documentation for the ParseStruct constructor.)
+        The optional budget (see ParseBudget in base.py) limits the parse.'''
+        ParseStruct.__init__(self, expr, budget=budget)
+        object.__setattr__(self, '_prefixes', {})
+        object.__setattr__(self, '_baseiri', None)
         if not expr is None:
             self._applyPrefixesAndBase(baseiri=base)
             if postParseCheck:
                 self._checkParsedQuery()
                     
-    def _applyPrefixesAndBase(self, prefixes={}, baseiri=None):
+    def _applyPrefixesAndBase(self, prefixes=None, baseiri=None):
         '''Recursively attaches information to the element about the prefixes and base-iri valid at this point
-        in the expression, as determined by PREFIX and BASE declarations in the query.
+        in the expression, as determined by PREFIX and BASE declarations in the query. Without prefixes, none are in force (a new empty dict).
         The parameter baseiri is as determined by the environment or an enveloping parsed entity. It must be an absolute
         IRI, or None.
         The treatment of BASE declarations depends on whether the IRI provided in the declaration is an absolute IRI or not.
@@ -47,15 +60,36 @@ class SPARQLElement(ParseStruct):
         using the baseiri parameter (which may not be None in this case) to give the next base IRI in force.
         Successful termination of this method does not guarantee that IRI expansion is possible, or that expanded IRIs conform to RFC 3987.
         This is purely a syntactic (substitution) operation. Use other available tests afterwards to check whether iris can be correctly
-        expanded using base and prefixes in force at their location. The function _checkParsedQuery can be used for this.'''
+        expanded using base and prefixes in force at their location. The function _checkParsedQuery can be used for this.
+        Elements with the same prefixes in force share the same dict, which must therefore not be changed in place. If the parser interns strings
+        (see Parser.enableInterning()), the dicts and base IRIs are interned too, so that trees with the same Prologue share them.'''
+        
+        table = self._getInternTable()
+        if prefixes is None:
+            prefixes = {}
         
-        self.__dict__['_prefixes'] = prefixes
-        self.__dict__['_baseiri'] = baseiri
-        if baseiri:
-            assert rfc3987.parse(baseiri, rule='absolute_IRI')
-        prefixes = prefixes.copy()
-        for elt in self.getChildren():
+        def apply(elt, prefixes, baseiri):
+            object.__setattr__(elt, '_prefixes', prefixes)
+            object.__setattr__(elt, '_baseiri', baseiri)
+            if baseiri:
+                assert rfc3987.parse(baseiri, rule='absolute_IRI')
+            return [iter(elt.getChildren()), prefixes, baseiri, False]
+        
+        # An explicit stack of [children, prefixes, baseiri, copied] frames, one per element being processed, instead of recursion,
+        # so that deeply nested queries do not exceed the recursion limit. The elements are visited in the same order.
+        # The prefixes of a frame are only copied when a Prologue among its children adds to them.
+        stack = [apply(self, prefixes, baseiri)]
+        while stack:
+            frame = stack[-1]
+            elt = next(frame[0], None)
+            if elt is None:
+                stack.pop()
+                continue
+            prefixes, baseiri = frame[1], frame[2]
             if isinstance(elt, SPARQLParser.Prologue):
+                if not frame[3]:
+                    prefixes = frame[1] = prefixes.copy()
+                    frame[3] = True
                 for decl in elt.getChildren():
                     if isinstance(decl, SPARQLParser.PrefixDecl):
                         assert str(decl.prefix) not in prefixes, 'Prefixes: {}, prefix: {}'.format(prefixes, decl.prefix)
@@ -69,7 +103,25 @@ class SPARQLElement(ParseStruct):
                         except ValueError:
                             baseiri = rfc3987.resolve(baseiri, str(decl.baseiri)[1:-1])
                             assert rfc3987.parse(baseiri, rule='absolute_IRI')                            
-            elt._applyPrefixesAndBase(prefixes, baseiri)
+                if table is not None:
+                    # a later Prologue among the children must copy the interned dict again
+                    prefixes = frame[1] = table.intern(prefixes)
+                    frame[3] = False
+                    baseiri = table.intern(baseiri)
+                frame[2] = baseiri
+            stack.append(apply(elt, prefixes, baseiri))
+            
+    def _itemsReplaced(self):
+        '''Attaches the prefixes and base iri in force at the element to its new items, as these may come from a tree with other PREFIX and
+        BASE declarations (see updateWith()). If the element is in a Prologue, or is one, they are attached again to the elements it is in force for.'''
+        scope = self
+        while scope is not None and not isinstance(scope, SPARQLParser.Prologue):
+            scope = scope.getParent()
+        if scope is None:
+            scope = self
+        elif scope.getParent() is not None:
+            scope = scope.getParent()
+        scope._applyPrefixesAndBase(scope.getPrefixes(), scope.getBaseiri())
             
     def getPrefixes(self):
         return self._prefixes
@@ -79,18 +131,27 @@ class SPARQLElement(ParseStruct):
         
     def expandIris(self):
         '''Converts all contained iri elements to normal form, taking into account the prefixes and base in force at the location of the iri.
-        The expansions are performed in place.'''
+        The expansions are performed in place. Each distinct expansion is parsed once, for the first iri that has it, and copied from
+        that iri to the others (see updateWith()).'''
+        expanded = {}
         for elt in self.searchElements(element_type=SPARQLParser.iri):
             children = elt.getChildren()
             assert len(children) == 1, children
             child = children[0]
             newiriref = '<' + getExpansion(child) + '>'
-            elt.updateWith(newiriref)
+            if str(elt) == newiriref:
+                continue
+            if newiriref in expanded:
+                elt.updateWith(expanded[newiriref])
+            else:
+                elt.updateWith(newiriref)
+                expanded[newiriref] = elt
              
     def processEscapeSeqs(self):
-        for stringtype in [SPARQLParser.STRING_LITERAL2, SPARQLParser.STRING_LITERAL1, SPARQLParser.STRING_LITERAL_LONG1, SPARQLParser.STRING_LITERAL_LONG2]:
-            for elt in self.searchElements(element_type=stringtype):
-                elt.updateWith(stringEscape(str(elt)))
+        # all literals are looked up before any is changed, as a change drops the index that searchElements() uses
+        stringtypes = [SPARQLParser.STRING_LITERAL2, SPARQLParser.STRING_LITERAL1, SPARQLParser.STRING_LITERAL_LONG1, SPARQLParser.STRING_LITERAL_LONG2]
+        for elt in [elt for stringtype in stringtypes for elt in self.searchElements(element_type=stringtype)]:
+            elt.updateWith(stringEscape(str(elt)))
 
     def _checkExpansion(self):
         iris = self.searchElements(element_type=SPARQLParser.PrefixedName) + self.searchElements(element_type=SPARQLParser.IRIREF)
@@ -122,6 +183,11 @@ class Parser:
     
     def __init__(self, class_=ParseStruct):
         self.class_ = class_
+        self.memo = None
+        self.parseCache = None
+        self.internTable = None
+        self.engine = None
+        self.__rdengines = {}
 #     def addElement(self, pattern):
 #         setattr(self, pattern.name, type(pattern.name, (self.class_,), {'_pattern': pattern}))
 #         pattern.setParseAction(parseStructFunc(getattr(self, pattern.name)))
@@ -130,8 +196,75 @@ class Parser:
             assert issubclass(newclass, self.class_)
         else:
             newclass = self.class_ 
-        setattr(self, pattern.name, type(pattern.name, (newclass,), {'_pattern': pattern}))
+        setattr(self, pattern.name, type(pattern.name, (newclass,), {'__slots__': (), '_pattern': pattern, '_parser': self}))
         pattern.setParseAction(parseStructFunc(getattr(self, pattern.name)))
+        
+    def enableMemoization(self, cacheSize=10000):
+        '''Switches on memoized (packrat) parsing for all elements of this parser, with a fresh MemoCache holding at most cacheSize entries.
+        Whether this pays off depends on how much backtracking the expressions cause; use getMemoStats() to check the hit rate.
+        Cached entries only live for the duration of a single parse (or a single parseQuery() call).'''
+        self.memo = MemoCache(cacheSize)
+        
+    def disableMemoization(self):
+        self.memo = None
+        
+    def getMemoStats(self):
+        '''Returns the statistics of the memo cache (see MemoCache.getStats()), or None if memoization is not enabled.'''
+        return self.memo.getStats() if self.memo is not None else None
+    
+    def enableParseCache(self, maxEntries=1000, maxBytes=64 * 2**20):
+        '''Switches on caching of complete parse results by the entry point of the language (e.g. parseQuery()), with a fresh ParseCache (see base.py)
+        bounded by maxEntries entries and approximately maxBytes bytes. Each hit returns a private copy of the cached tree.
+        Use getParseCacheStats() to check the hit rate.'''
+        self.parseCache = ParseCache(maxEntries, maxBytes)
+        
+    def disableParseCache(self):
+        self.parseCache = None
+        
+    def getParseCacheStats(self):
+        '''Returns the statistics of the parse cache (see ParseCache.getStats()), or None if the cache is not enabled.'''
+        return self.parseCache.getStats() if self.parseCache is not None else None
+    
+    def enableInterning(self, table=None, maxEntries=2**20):
+        '''Switches on interning (see InternTable in base.py) of the terminal strings and prefix dicts of the trees parsed with this parser, and of
+        the trees unpacked for it (e.g. those parsed by the worker processes of parseQueries()), so that long-lived trees share them instead of each
+        holding copies. Pass a table to share it with other parsers, or to keep one table per corpus of trees; otherwise a fresh table holding at most
+        maxEntries objects is used. Use getInternStats() to check the bytes saved and the size of the table.'''
+        self.internTable = table if table is not None else InternTable(maxEntries)
+        
+    def disableInterning(self):
+        self.internTable = None
+        
+    def getInternStats(self):
+        '''Returns the statistics of the intern table (see InternTable.getStats()), or None if interning is not enabled.'''
+        return self.internTable.getStats() if self.internTable is not None else None
+    
+    def setBackend(self, backend):
+        '''Selects the backend used to parse: "pyparsing" (the default) interprets the pyparsing patterns directly, "rd" uses a recursive descent
+        parser generated from the same patterns (see rdengine.py), and "stack" a variant of that parser that keeps its state on an explicit stack
+        instead of the Python stack. All produce the same ParseStruct trees. The pyparsing and rd backends exceed the recursion limit of Python for
+        deeply nested input (some twenty levels of brackets in a SPARQL expression for pyparsing), and then parse again with the stack variant, which
+        has no such limit but is slower for ordinary input. The rd and stack parsers are generated the first time they are needed, so this must be done
+        after all elements have been added. Memoization only applies to the pyparsing backend.'''
+        if backend == 'pyparsing':
+            self.engine = None
+        elif backend in ('rd', 'stack'):
+            self.engine = self.getEngine(backend)
+        else:
+            raise ParsertoolsException('Unknown backend "{}", expected "pyparsing", "rd" or "stack"'.format(backend))
+        
+    def getEngine(self, backend):
+        '''Returns the RDEngine (see rdengine.py) for backend "rd" or "stack", generated at first use, without selecting it. The pyparsing backend uses
+        the stack engine for deeply nested input; generating it takes a few tenths of a second, which counts against the time limit of a budget (see
+        ParseBudget in base.py) if it happens during a parse, so a caller that sets tight time limits can call getEngine("stack") in advance.'''
+        if backend not in self.__rdengines:
+            self.__rdengines[backend] = RDEngine(self, stackless=backend == 'stack')
+        return self.__rdengines[backend]
+        
+    def getBackend(self):
+        if self.engine is None:
+            return 'pyparsing'
+        return 'stack' if self.engine.stackless else 'rd'
 #
 # Create the SPARQLParser object, optionally with a custom ParseStruct subclass
 #
@@ -142,25 +275,415 @@ SPARQLParser = Parser(SPARQLElement)
 # Main function to call. This is a convenience function, adapted to the SPARQL definition.
 #
 
-def parseQuery(querystring, base=None):
-    '''Entry point to parse any SPARQL query'''
+def parseQuery(querystring, base=None, budget=None, flat=False):
+    '''Entry point to parse any SPARQL query. If memoization is enabled on SPARQLParser (see Parser.enableMemoization()), it is used here as well.
+    If the parse cache is enabled (see Parser.enableParseCache()), the result for the same querystring and base is taken from the cache if it is there,
+    which skips all of the steps below. Exceptions are not cached.
+    With a budget (see ParseBudget in base.py), a BudgetExceededError is raised as soon as parsing exceeds one of its limits. The Prologue
+    and the rest of the query are parsed under the same budget.
+    With flat=True, the result is a read-only FlatTree (see base.py) instead, which takes much less memory. Its text is the query string as prepared
+    for parsing (see prepareQuery()), and the spans of its elements and strings are their positions in that text.'''
+    
+    cache = SPARQLParser.parseCache
+    if cache is not None:
+        key = (querystring if isinstance(querystring, str) else '\n'.join(querystring), base, flat)
+        result = cache.get(key)
+        if result is not None:
+            return result
     
     s = prepareQuery(querystring)
     
-    # In SPARQL, there are two entry points to the grammar: QueryUnit and UpdateUnit. These are tried in order.
+    # In SPARQL, there are two entry points to the grammar: QueryUnit and UpdateUnit. Both start with a Prologue, which is parsed only once.
+    # The keyword after the Prologue decides which of the two can match, and only that one is used to parse the rest of the string.
     
-    try:
-        result = SPARQLParser.QueryUnit(s, base=base)
-    except ParseException:
+    with ExitStack() as stack:
+        if SPARQLParser.memo is not None:
+            stack.enter_context(SPARQLParser.memo)
+        if budget is not None:
+            stack.enter_context(budget)
         try:
-            result = SPARQLParser.UpdateUnit(s, base=base)
+            prologue, rest = SPARQLParser.Prologue._parsePrefix(s, budget=budget)
+            keyword = re.match('[ \t\r\n]*([A-Za-z]*)', rest).group(1).upper()
+            unit = SPARQLParser.QueryUnit if keyword in queryKeywords else SPARQLParser.UpdateUnit
+            result = unit._parseString(rest, budget=budget)[0]
         except ParseException:
             raise SPARQLParseException('Query {} cannot be parsed'.format(querystring))
-        
+    
+    # The rest starts with an empty Prologue, to be replaced by the one parsed above. Then the same steps follow as in the SPARQLElement constructor.
+    
+    top = result.getChildren()[0]
+    empty = top.getItems()[0]
+    assert isinstance(empty, SPARQLParser.Prologue) and not empty.getItems(), 'internal error: {}'.format(empty)
+    prologue = prologue[0]
+    object.__setattr__(prologue, '_label', empty.getLabel())
+    top.setItems([prologue] + top.getItems()[1:])
+    # the parent pointers of the other elements were set while parsing
+    object.__setattr__(prologue, '_parent', top)
+    result._applyPrefixesAndBase(baseiri=base)
+    result._checkParsedQuery()
+    
+    # the strings are located before escape sequences in them are processed, after which they no longer match the text
+    spans = _locate(result, s, strings=True) if flat else None
+    
     result.processEscapeSeqs()    
     
+    if flat:
+        result = FlatTree(result, s, spans)
+    
+    if cache is not None:
+        cache.set(key, result)
+    
     return result
 
+# The keywords that a Query (as opposed to an Update) can start with after its Prologue
+queryKeywords = frozenset(['SELECT', 'CONSTRUCT', 'DESCRIBE', 'ASK'])
+
+def reparseQuery(tree, text, offset, removed, inserted, base=None):
+    '''Incremental version of parseQuery(), e.g. for an editor that reparses a query after every change. The arguments are a tree returned by
+    parseQuery() (or by an earlier call of reparseQuery()) for the string text, and an edit of that string: at offset, removed characters
+    were replaced by the string inserted. Returns the tree for the edited string, as parseQuery() would, and raises the same exceptions.
+    
+    The elements of the tree are first located in text. Then the smallest element that strictly contains the edited part of the string is reparsed
+    with its own pattern, as in updateWith(). If that fails, the next enclosing element is tried, and so on. The rest of the tree is kept as it is,
+    and the prefixes and base are only recomputed for the reparsed element (or, if it is part of a Prologue, for the elements in the scope of that
+    Prologue). In this case the tree passed in is updated in place and returned. When the tree cannot be located in text (e.g. because it was
+    changed by expandIris(), or because text contains escape sequences), or when no element that spans at most half of text can be
+    reparsed, a new tree is returned from parseQuery().'''
+    
+    newtext = text[:offset] + inserted + text[offset + removed:]
+    spans = _locate(tree, text)
+    if spans is None:
+        return parseQuery(newtext, base=base)
+    enclosing = [e for e in tree.searchElements() if id(e) in spans and spans[id(e)][0] < offset and offset + removed < spans[id(e)][1]]
+    # the smallest element comes last, as searchElements() returns the elements in preorder
+    for element in reversed(enclosing):
+        start, end = spans[id(element)]
+        # reparsing (or failing to reparse) most of the text costs about as much as parsing all of it
+        if element is tree or 2 * (end - start) > len(text):
+            break
+        try:
+            other = element._parseString(prepareQuery(newtext[start:end + len(inserted) - removed]))[0]
+        except ParseException:
+            continue
+        element.setItems(other.getItems())
+        element.createParentPointers(recursive=False)
+        scope = element
+        while scope is not None and not isinstance(scope, SPARQLParser.Prologue):
+            scope = scope.getParent()
+        scope = element if scope is None else scope.getParent()
+        scope._applyPrefixesAndBase(scope.getPrefixes(), scope.getBaseiri())
+        # the checks look for whole elements, such as a PrefixedName around a reparsed PNAME_LN
+        checked = element
+        while checked.getParent() is not None and spans.get(id(checked.getParent())) == (start, end):
+            checked = checked.getParent()
+        (checked if scope is element else scope)._checkParsedQuery()
+        element.processEscapeSeqs()
+        return tree
+    return parseQuery(newtext, base=base)
+
+def _locate(tree, text, strings=False):
+    '''Returns a dict that maps the id of each element of tree to its (start, end) span in text, or None if the strings of the tree do not match
+    text in order, apart from whitespace and comments between them, and the case of keywords. Elements without strings get no span.
+    With strings=True, the dict also maps an (id of an element, position in its items) pair to the span of each string, as FlatTree expects.'''
+    spans = {}
+    pos = 0
+    # frames of [element, iterator over its (position, item) pairs, start of its first string]
+    stack = [[tree, enumerate(tree.getItems()), None]]
+    while stack:
+        frame = stack[-1]
+        for (k, item) in frame[1]:
+            if isinstance(item, str):
+                if not item:
+                    continue
+                pos = _skipBetweenTokens(text, pos).end()
+                if text[pos:pos + len(item)].upper() == item.upper():
+                    itemstart, pos = pos, pos + len(item)
+                else:
+                    # keywords combined from two words, such as DELETE WHERE, and NIL, are joined by a single space
+                    m = re.compile('[ \t\r\n]*'.join(re.escape(w) for w in item.split(' ')), re.IGNORECASE).match(text, pos) if ' ' in item else None
+                    if m is None:
+                        return None
+                    itemstart, pos = m.span()
+                if strings:
+                    spans[id(frame[0]), k] = (itemstart, pos)
+                if frame[2] is None:
+                    frame[2] = itemstart
+            else:
+                stack.append([item, enumerate(item.getItems()), None])
+                break
+        else:
+            element, _, start = stack.pop()
+            if start is not None:
+                spans[id(element)] = (start, pos)
+                if stack and stack[-1][2] is None:
+                    stack[-1][2] = start
+    return spans
+
+_skipBetweenTokens = re.compile('(?:[ \t\r\n]+|#[^\n]*)*').match
+
+def parseQueries(queries, workers=None, base=None, chunksize=100, ordered=True, budget=None, flat=False):
+    '''Parses the strings in the iterable queries with parseQuery() in a pool of worker processes, and yields an (index, result) pair per query,
+    where index is the position of the query in queries, and result is the tree that parseQuery() returns for it, or the exception that it raises.
+    An error for one query does not affect the others. With ordered=True (the default) the pairs come in input order, otherwise per chunk as soon as
+    the chunk is done.
+    
+    The queries are sent to the workers in chunks of chunksize queries, and at most two chunks per worker are outstanding at any time, so that
+    the iterable is consumed while the results are used. The workers (os.cpu_count() if workers is None) are started once per call, and use the same
+    backend as SPARQLParser in the calling process. They send the trees back in the compact form of packTree() (see base.py).
+    With a budget (see ParseBudget in base.py), each query is parsed under a copy of it, and a query that exceeds it gives a BudgetExceededError.
+    With flat=True, the results are FlatTree objects (see parseQuery()), which are much cheaper to send back and to rebuild than ParseStruct trees.'''
+    
+    workers = workers or os.cpu_count() or 1
+    chunks = _chunks(queries, chunksize)
+    pending = deque()
+    
+    def submit():
+        chunk = next(chunks, None)
+        if chunk is not None:
+            pending.append(executor.submit(_parseChunk, chunk, base, budget, flat))
+    
+    executor = ProcessPoolExecutor(workers, initializer=_initWorker, initargs=(SPARQLParser.getBackend(),))
+    try:
+        for _ in range(2 * workers):
+            submit()
+        while pending:
+            if ordered:
+                future = pending.popleft()
+            else:
+                future = next(iter(wait(pending, return_when=FIRST_COMPLETED).done))
+                pending.remove(future)
+            results = future.result()
+            submit()
+            for (i, packed, value) in results:
+                if packed:
+                    value = FlatTree.unpack(value, SPARQLParser) if flat else unpackTree(value, SPARQLParser)
+                yield i, value
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+def parseQueryLog(source, delimiter='\n', base=None, encoding='utf-8', workers=0, bufsize=2**16, budget=None, flat=False):
+    '''Parses the queries in a query log, and yields a (record id, result) pair per query, where result is the tree that parseQuery() returns for
+    the query, or the exception that it raises. The source is a path, or a file object opened in text or binary mode (binary files are decoded with
+    encoding). Records are separated by delimiter (one query per line by default), and the record id is the position of the record in the source,
+    counting from 0. Records that contain only whitespace are skipped.
+    
+    The source is read in blocks of bufsize characters, and the pairs are produced as the source is read, so that memory use does not depend on
+    the size of the log. With workers > 0, the queries are parsed in that many worker processes, see parseQueries(). Each query is parsed under
+    budget, if given, and with flat=True the results are FlatTree objects (see parseQuery()).'''
+    
+    records = ((i, record) for (i, record) in enumerate(readRecords(source, delimiter, encoding, bufsize)) if record.strip())
+    if not workers:
+        for (i, record) in records:
+            try:
+                result = parseQuery(record, base=base, budget=budget, flat=flat)
+            except Exception as e:
+                result = e
+            yield i, result
+    else:
+        ids = {}
+        
+        def queries():
+            for (n, (i, record)) in enumerate(records):
+                ids[n] = i
+                yield record
+        
+        for (n, result) in parseQueries(queries(), workers=workers, base=base, ordered=True, budget=budget, flat=flat):
+            yield ids.pop(n), result
+
+def readRecords(source, delimiter='\n', encoding='utf-8', bufsize=2**16):
+    '''Yields the records in source, a path or a file object, separated by delimiter. See parseQueryLog(). A final delimiter at the end of
+    the source does not start another record.'''
+    assert delimiter, 'Empty record delimiter'
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, encoding=encoding) as f:
+            yield from readRecords(f, delimiter, encoding, bufsize)
+        return
+    # any binary file object: buffered, raw (opened with buffering=0) or e.g. a socket file
+    if isinstance(source.read(0), bytes):
+        wrapper = io.TextIOWrapper(source, encoding=encoding)
+        try:
+            yield from readRecords(wrapper, delimiter, encoding, bufsize)
+        finally:
+            # leave the binary file open for the caller
+            wrapper.detach()
+        return
+    buffer = ''
+    while True:
+        block = source.read(bufsize)
+        if not block:
+            break
+        buffer += block
+        # only split when the new block (or a delimiter across the block boundary) contains a delimiter
+        if delimiter in buffer[-(len(block) + len(delimiter) - 1):]:
+            *records, buffer = buffer.split(delimiter)
+            yield from records
+    if buffer:
+        yield buffer
+
+class AsyncQueryParser:
+    '''Asyncio front end for parseQuery(), e.g. for a service that must not block its event loop while parsing. The parses run in an executor:
+    a thread pool (executor='thread', the default), a pool of worker processes (executor='process'), or a ThreadPoolExecutor or ProcessPoolExecutor
+    passed in by the caller. Pools created here have workers workers (1 thread, or os.cpu_count() processes, if workers is None), and are shut down by
+    shutdown(); an executor passed in is left to the caller.
+    
+    At most maxInFlight parses are submitted to the executor at any time, further calls wait their turn. For a pool created here, maxInFlight is
+    twice the number of workers by default; with an executor passed in, it must be given.
+    getStats() reports the number of parses in flight and waiting, so that a caller can shed load when the queue grows. A parse that is cancelled
+    or times out while waiting, or before a worker has picked it up, is not started. Otherwise it runs to completion in its worker (parsing cannot be
+    interrupted), and keeps its slot until then.
+    
+    Parses in threads keep the event loop free (Python threads would not parse faster than one thread), and use the caches of the calling process
+    (see Parser.enableParseCache()). Where these are shared, the parses take turns: the memo cache of SPARQLParser, if enabled, and the rd backend
+    parse one string at a time. Worker processes parse in parallel and use the backend of SPARQLParser at the time the pool is created, see parseQueries().
+    
+    An AsyncQueryParser must be used from one event loop only.'''
+    
+    def __init__(self, executor='thread', workers=None, maxInFlight=None):
+        if executor == 'thread':
+            workers = workers or 1
+            executor = ThreadPoolExecutor(workers, thread_name_prefix='parseQuery')
+            self.__owned = True
+        elif executor == 'process':
+            workers = workers or os.cpu_count() or 1
+            executor = ProcessPoolExecutor(workers, initializer=_initWorker, initargs=(SPARQLParser.getBackend(),))
+            self.__owned = True
+        else:
+            assert isinstance(executor, (ThreadPoolExecutor, ProcessPoolExecutor)), 'Unsupported executor: {}'.format(executor)
+            assert maxInFlight is not None, 'maxInFlight must be given with an executor passed in'
+            self.__owned = False
+        self.__executor = executor
+        self.__processes = isinstance(executor, ProcessPoolExecutor)
+        self.maxInFlight = maxInFlight or 2 * workers
+        assert self.maxInFlight > 0, 'maxInFlight must be positive, got {}'.format(self.maxInFlight)
+        self.__semaphore = asyncio.Semaphore(self.maxInFlight)
+        self.inFlight = 0
+        self.waiting = 0
+        self.resetStats()
+        
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        self.shutdown(wait=False)
+        return False
+    
+    def shutdown(self, wait=True):
+        '''Shuts down the executor, if it was created here. Parses that have not been started are cancelled.'''
+        if self.__owned:
+            self.__executor.shutdown(wait=wait, cancel_futures=True)
+    
+    async def parseQuery(self, querystring, base=None, timeout=None, budget=None):
+        '''Returns the tree that parseQuery(querystring, base=base, budget=budget) returns, or raises the exception that it raises. With a timeout
+        (in seconds), TimeoutError is raised if the result is not there in time, including the time spent waiting for a slot. Unlike the timeout, a
+        budget stops the parse itself, and frees its worker. Parses in threads use the budget passed in, those in processes a copy.'''
+        if timeout is None:
+            return await self.__parse(querystring, base, budget)
+        try:
+            return await asyncio.wait_for(self.__parse(querystring, base, budget), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+    
+    async def __parse(self, querystring, base, budget):
+        loop = asyncio.get_running_loop()
+        self.waiting += 1
+        try:
+            await self.__semaphore.acquire()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            self.waiting -= 1
+        try:
+            if self.__processes:
+                future = self.__executor.submit(_parseChunk, [(0, querystring)], base, budget)
+            else:
+                future = self.__executor.submit(parseQuery, querystring, base=base, budget=budget)
+        except BaseException:
+            self.__semaphore.release()
+            raise
+        self.inFlight += 1
+        def done(f):
+            try:
+                loop.call_soon_threadsafe(self.__release, f)
+            except RuntimeError:
+                pass # the event loop is closed
+        future.add_done_callback(done)
+        try:
+            result = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # cancelling the future only has effect if no worker has picked it up, otherwise the parse is counted when it is done
+            if future.cancel():
+                self.cancelled += 1
+            raise
+        if self.__processes:
+            [(_, packed, value)] = result
+            if not packed:
+                raise value
+            result = unpackTree(value, SPARQLParser)
+        return result
+    
+    def __release(self, future):
+        self.inFlight -= 1
+        self.__semaphore.release()
+        if future.cancelled():
+            pass # counted by __parse()
+        elif future.exception() is not None:
+            self.failed += 1
+        elif self.__processes and not future.result()[0][1]:
+            self.failed += 1
+        else:
+            self.completed += 1
+    
+    def resetStats(self):
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.timeouts = 0
+        
+    def getStats(self):
+        '''Returns a dict with the current number of parses in flight (submitted to the executor and not finished) and waiting for a slot, the bound on
+        parses in flight, and the cumulative counts of parses that completed, failed (raised an exception), were cancelled before they started, or
+        timed out, until resetStats() is called. A parse that times out while it waits for a slot or a worker is counted as cancelled as well.'''
+        return {'inFlight': self.inFlight, 'waiting': self.waiting, 'maxInFlight': self.maxInFlight, 'completed': self.completed,
+                'failed': self.failed, 'cancelled': self.cancelled, 'timeouts': self.timeouts}
+
+_defaultAsyncParsers = weakref.WeakKeyDictionary()
+
+async def parseQueryAsync(querystring, base=None, timeout=None, budget=None):
+    '''Parses querystring with parseQuery() in a thread, without blocking the event loop. This uses a default AsyncQueryParser() for the running
+    event loop, created at the first call. See AsyncQueryParser for the timeout, and for running parses in worker processes.'''
+    loop = asyncio.get_running_loop()
+    if loop not in _defaultAsyncParsers:
+        _defaultAsyncParsers[loop] = AsyncQueryParser()
+    return await _defaultAsyncParsers[loop].parseQuery(querystring, base=base, timeout=timeout, budget=budget)
+
+def _chunks(queries, chunksize):
+    it = enumerate(queries)
+    while True:
+        chunk = list(islice(it, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+def _initWorker(backend):
+    SPARQLParser.setBackend(backend)
+
+def _parseChunk(chunk, base, budget=None, flat=False):
+    '''Runs in a worker process of parseQueries(). Returns an (index, True, packed tree) or (index, False, exception) triple per query.'''
+    results = []
+    for (i, querystring) in chunk:
+        try:
+            tree = parseQuery(querystring, base=base, budget=budget, flat=flat)
+            results.append((i, True, tree.pack() if flat else packTree(tree)))
+        except Exception as e:
+            try:
+                pickle.dumps(e)
+            except Exception:
+                e = ParsertoolsException('{}: {}'.format(e.__class__.__name__, e))
+            results.append((i, False, e))
+    return results
+
 #
 # Utility functions for SPARQL
 #
@@ -178,10 +701,14 @@ def stripComments(text):
     '''Strips SPARQL-style comments from a multiline string'''
     if isinstance(text, list):
         text = '\n'.join(text)
+    if not any(c in text for c in '#<\'"'):
+        # Shortcut for text without comments, strings and iris: this is what Line below does with it
+        return '\n'.join(l.expandtabs().lstrip(' \t\r') for l in text.split('\n'))
     Comment = Literal('#') + SkipTo(lineEnd)
     NormalText = Regex('[^#<\'"]+')    
-    Line = ZeroOrMore(String | (IRIREF | Literal('<')) | NormalText) + Optional(Comment) + lineEnd
-    Line.ignore(Comment)
+    # Note: Line.ignore(Comment) must not be used here, since ignore() propagates into String and IRIREF, and would add a Comment to the
+    # grammar of the language on every call.
+    Line = ZeroOrMore(String | (IRIREF | Literal('<')) | NormalText) + Optional(Suppress(Comment)) + lineEnd
     Line.setParseAction(lambda tokens: ' '.join([t if isinstance(t, str) else t.__str__() for t in tokens]))
     lines = text.split('\n')
     return '\n'.join([Line.parseString(l)[0] for l in lines])
@@ -1005,7 +1532,7 @@ SPARQLParser.addElement(ExpressionList)
 #             | RegexExpression 
 #             | ExistsFunc 
 #             | NotExistsFunc 
-BuiltInCall = Group(Aggregate | 
+BuiltInCall = Group(KeywordDispatch(Aggregate | 
                 STR + LPAR + Expression('expression') + RPAR    | 
                 LANG + LPAR + Expression('expression') + RPAR    | 
                 LANGMATCHES + LPAR + Expression('language-tag') + COMMA + Expression('language-range') + RPAR    | 
@@ -1059,7 +1586,7 @@ BuiltInCall = Group(Aggregate |
                 isNUMERIC + LPAR + Expression('expression') + RPAR    | 
                 RegexExpression | 
                 ExistsFunc | 
-                NotExistsFunc ).setName('BuiltInCall')
+                NotExistsFunc )).setName('BuiltInCall')
 SPARQLParser.addElement(BuiltInCall)
 
 # [120]   BrackettedExpression      ::=   '(' Expression ')' 
@@ -1334,7 +1861,7 @@ OptionalGraphPattern = Group(OPTIONAL + GroupGraphPattern ).setName('OptionalGra
 SPARQLParser.addElement(OptionalGraphPattern)
 
 # [56]    GraphPatternNotTriples    ::=   GroupOrUnionGraphPattern | OptionalGraphPattern | MinusGraphPattern | GraphGraphPattern | ServiceGraphPattern | Filter | Bind | InlineData 
-GraphPatternNotTriples = Group(GroupOrUnionGraphPattern | OptionalGraphPattern | MinusGraphPattern | GraphGraphPattern | ServiceGraphPattern | Filter | Bind | InlineData ).setName('GraphPatternNotTriples')
+GraphPatternNotTriples = Group(KeywordDispatch(GroupOrUnionGraphPattern | OptionalGraphPattern | MinusGraphPattern | GraphGraphPattern | ServiceGraphPattern | Filter | Bind | InlineData )).setName('GraphPatternNotTriples')
 SPARQLParser.addElement(GraphPatternNotTriples)
                                            
 # [55]    TriplesBlock      ::=   TriplesSameSubjectPath ( '.' TriplesBlock? )? 
@@ -1440,7 +1967,7 @@ Load = Group(LOAD + Optional(SILENT) + iri  + Optional(INTO + GraphRef)).setName
 SPARQLParser.addElement(Load)
 
 # [30]    Update1   ::=   Load | Clear | Drop | Add | Move | Copy | Create | InsertData | DeleteData | DeleteWhere | Modify 
-Update1 = Group(Load | Clear | Drop | Add | Move | Copy | Create | InsertData | DeleteData | DeleteWhere | Modify ).setName('Update1')
+Update1 = Group(KeywordDispatch(Load | Clear | Drop | Add | Move | Copy | Create | InsertData | DeleteData | DeleteWhere | Modify )).setName('Update1')
 SPARQLParser.addElement(Update1)
 
 Prologue = Forward().setName('Prologue')
@@ -0,0 +1,707 @@
+'''
+Predictive recursive descent backend for parsers defined with parsertools.
+'''
+from pyparsing import *
+from pyparsing.core import _SingleCharLiteral
+from parsertools import ParsertoolsException
+from parsertools.base import ParseStruct, KeywordDispatch, patternClass
+import re
+import threading
+from contextlib import ExitStack
+from types import GeneratorType
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse, sre_constants
+
+
+class RDEngineException(ParsertoolsException):
+    '''Raised when a pattern graph contains a construct that the RDEngine cannot compile.'''
+    pass
+
+
+class _Group:
+    '''Stands in for the nested ParseResults object that pyparsing creates for a Group: the tokens and the results names of the group.'''
+
+    __slots__ = ('toks', 'names')
+
+    def __init__(self, toks, names):
+        self.toks = toks
+        self.names = names
+
+
+class _First:
+    '''The FIRST set of a pattern: the ascii characters a match can start with, whether it can start with a non-ascii character,
+    and whether it can match the empty string.'''
+
+    def __init__(self, chars=frozenset(), nonascii=False, nullable=False):
+        self.chars = frozenset(chars)
+        self.nonascii = nonascii
+        self.nullable = nullable
+
+    def __eq__(self, other):
+        return (self.chars, self.nonascii, self.nullable) == (other.chars, other.nonascii, other.nullable)
+
+    def union(self, other, nullable=None):
+        return _First(self.chars | other.chars, self.nonascii or other.nonascii, self.nullable or other.nullable if nullable is None else nullable)
+
+    def admits(self, c):
+        '''True if a match can start with character c (which is '' at the end of the string).'''
+        return self.nullable or c in self.chars or (c > '\x7f' and self.nonascii)
+
+_ASCII = frozenset(chr(i) for i in range(128))
+_ANY = _First(_ASCII, True, True)
+
+
+def _regexFirst(pattern):
+    '''Returns the _First of a regular expression, by inspecting its parsed form. Anything not recognized makes the result _ANY.'''
+
+    def first(subpattern):
+        result = _First(nullable=True)
+        for (op, av) in subpattern:
+            f = item(op, av)
+            result = result.union(f, nullable=f.nullable)
+            if not f.nullable:
+                break
+        return result
+
+    def item(op, av):
+        if op == sre_constants.LITERAL:
+            return charRange(av, av)
+        elif op == sre_constants.IN:
+            result = _First()
+            for (iop, iav) in av:
+                if iop == sre_constants.LITERAL:
+                    result = result.union(charRange(iav, iav))
+                elif iop == sre_constants.RANGE:
+                    result = result.union(charRange(*iav))
+                else:
+                    return _ANY
+            return result
+        elif op == sre_constants.SUBPATTERN:
+            if av[1] or av[2]:
+                return _ANY
+            return first(av[-1])
+        elif op == sre_constants.BRANCH:
+            result = _First()
+            for b in av[1]:
+                result = result.union(first(b))
+            return result
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            f = first(av[2])
+            return _First(f.chars, f.nonascii, f.nullable or av[0] == 0)
+        elif op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            return _First(nullable=True)
+        else:
+            return _ANY
+
+    def charRange(lo, hi):
+        return _First((chr(i) for i in range(lo, min(hi, 127) + 1)), hi > 127)
+
+    try:
+        parsed = sre_parse.parse(pattern)
+    except Exception:
+        return _ANY
+    if parsed.state.flags & ~(re.UNICODE):
+        return _ANY
+    return first(parsed)
+
+
+def _parseAction(fn):
+    '''Retrieves the original function from the wrapper that pyparsing puts around a parse action.'''
+    while not hasattr(fn, 'structClass') and not hasattr(fn, 'separator') and fn.__closure__:
+        cells = dict(zip(fn.__code__.co_freevars, fn.__closure__))
+        if 'func' not in cells:
+            break
+        fn = cells['func'].cell_contents
+    return fn
+
+
+class RDEngine:
+    '''Parsing backend that compiles the pattern graph of a Parser object into a predictive recursive descent parser.
+    For every pattern in the graph, Python source code is generated for a function that reproduces what pyparsing does for it: the same
+    whitespace skipping, the same ordered choice between alternatives, the same results names and the same parse actions. The resulting
+    ParseStruct trees are therefore the same as those built by pyparsing. Where pyparsing tries the alternatives of a MatchFirst one by one,
+    the generated parser looks at the next character and only tries the alternatives that can start with it (their FIRST sets). For a KeywordDispatch,
+    it first looks up the keyword at the next location in the dispatch table of the pattern.
+
+    As a recursive descent parser uses several Python frames per level of nesting in the input, deeply nested input (e.g. an expression with a
+    hundred levels of brackets) exceeds the recursion limit of Python. For such input, a second variant of the parser is generated, in which each
+    function is a generator that yields its calls to other functions instead of making them, and a loop (see _trampoline()) keeps the suspended
+    functions on an explicit stack. The input is then only limited by memory. With stackless=True, the engine always uses that variant (it is
+    slower for ordinary input); otherwise it uses the recursive variant, and parses again with the stackless variant when that raises a RecursionError.
+
+    Only the pyparsing classes and parse actions used by parsertools grammars are supported; for anything else an RDEngineException is raised
+    at construction time. The generated source is available with getSource(). An engine is normally created and selected
+    with Parser.setBackend(). The generated functions record the failure location and the budget in their namespace, so an engine parses one
+    string at a time; parses in other threads wait their turn.'''
+
+    def __init__(self, parser, stackless=False):
+        self.parser = parser
+        self.stackless = stackless
+        self.__elements = []
+        self.__index = {}
+        self.__roots = {}
+        self.__constants = {}
+        self.__dispatch = {}
+        classes = [c for c in vars(parser).values() if isinstance(c, type) and issubclass(c, ParseStruct) and c.__dict__.get('_parser') is parser]
+        for c in classes:
+            c._pattern.streamline()
+        for c in classes:
+            self.__roots[id(c._pattern)] = self.__number(c._pattern)
+        self.__first = self.__computeFirst()
+        self.__sources = {}
+        self.__codes = {}
+        self.__namespaces = {}
+        self.__lock = threading.RLock()
+        # the stackless variant is compiled here as well, so that a parse that switches to it does not wait for the compiler (within its time limit,
+        # if it has a budget); the namespaces for parses with a budget are made from the same code at first use, which takes little time
+        for variant in sorted({stackless, True}):
+            self.__code(variant)
+        self.__namespaceFor(None, stackless)
+
+    def getSource(self, stackless=None):
+        '''Returns the Python source code of the generated parser, by default of the variant that the engine uses first.'''
+        if stackless is None:
+            stackless = self.stackless
+        if stackless not in self.__sources:
+            self.__sources[stackless] = self.__generate(stackless)
+        return self.__sources[stackless]
+
+    def parseString(self, pattern, instring, parseAll=True, budget=None):
+        '''Parses instring with pattern, which must be the pattern of one of the ParseStruct subclasses of the parser, and returns the list of
+        resulting tokens (its first element is the ParseStruct object). Raises a ParseException if instring cannot be parsed, and a BudgetExceededError
+        if a budget is given (see ParseBudget in base.py) and the parse exceeds it.'''
+        if not pattern.keepTabs:
+            instring = instring.expandtabs()
+        with self.__lock:
+            toks, loc, namespace = self.__parse(pattern, instring, budget)
+            if parseAll:
+                loc = namespace['skip'](instring, loc)
+                if loc < len(instring):
+                    raise ParseException(instring, max(loc, namespace['FAIL'][0]), 'Expected end of text', pattern)
+        return toks
+
+    def parsePrefix(self, pattern, instring, budget=None):
+        '''As parseString() with parseAll=False, but returns the list of tokens together with the location in instring where the match ends.
+        Unlike parseString(), tabs in instring are not expanded here; the caller must do so, unless the pattern keeps tabs.'''
+        with self.__lock:
+            toks, loc, _ = self.__parse(pattern, instring, budget)
+        return toks, loc
+
+    def __parse(self, pattern, instring, budget):
+        '''Returns the tokens, the end location and the namespace of the variant of the parser that produced them.'''
+        with ExitStack() as stack:
+            if budget is not None:
+                stack.enter_context(budget)
+            if not self.stackless:
+                try:
+                    return self.__parsePrefix(self.__namespaceFor(budget, False), pattern, instring, budget)
+                except RecursionError:
+                    pass
+            return self.__parsePrefix(self.__namespaceFor(budget, True), pattern, instring, budget)
+
+    def __parsePrefix(self, namespace, pattern, instring, budget):
+        function = namespace['p{}'.format(self.__roots[id(pattern)])]
+        failures = namespace['FAIL']
+        failures[0] = 0
+        if budget is not None:
+            namespace['BUDGET'][0] = budget
+        result = namespace['RUN'](function, instring, 0, True)
+        if result is None:
+            raise ParseException(instring, failures[0], 'Expected {}'.format(pattern), pattern)
+        loc, toks, _ = result
+        return toks, loc, namespace
+
+    def __namespaceFor(self, budget, stackless):
+        '''Returns the namespace with the compiled functions of the recursive or stackless variant of the parser, made at first use. Parses with
+        a budget use a separate copy of each variant, in which every function charges the budget.'''
+        key = (stackless, budget is not None)
+        if key not in self.__namespaces:
+            self.__namespaces[key] = self.__compile(stackless, budget is not None)
+        return self.__namespaces[key]
+
+    #
+    # Numbering of the pattern graph
+    #
+
+    def __children(self, e):
+        if isinstance(e, ParseExpression):
+            return list(e.exprs)
+        elif isinstance(e, ParseElementEnhance):
+            if e.expr is None:
+                raise RDEngineException('Empty Forward or enhanced expression: {}'.format(e))
+            return [e.expr]
+        else:
+            return []
+
+    def __number(self, e):
+        stack = [e]
+        while stack:
+            x = stack.pop()
+            if id(x) in self.__index:
+                continue
+            self.__index[id(x)] = len(self.__elements)
+            self.__elements.append(x)
+            stack.extend(reversed(self.__children(x)))
+        return self.__index[id(e)]
+
+    def __id(self, e):
+        return self.__index[id(e)]
+
+    #
+    # FIRST sets
+    #
+
+    def __computeFirst(self):
+        '''Computes the FIRST sets of all elements, iterating to a fixpoint because of the recursion through Forward elements.'''
+        first = [_First() for _ in self.__elements]
+        terminals = {}
+        for (i, e) in enumerate(self.__elements):
+            if isinstance(e, (Empty, NotAny)):
+                terminals[i] = _First(nullable=True)
+            elif isinstance(e, Keyword):
+                if e.caseless:
+                    terminals[i] = _First({e.match[0].upper(), e.match[0].lower()}, True)
+                else:
+                    terminals[i] = _First({e.match[0]}, e.match[0] > '\x7f')
+            elif isinstance(e, Literal):
+                terminals[i] = _First({e.match[0]}, e.match[0] > '\x7f')
+            elif isinstance(e, Regex):
+                terminals[i] = _regexFirst(e.pattern)
+            elif not isinstance(e, (And, MatchFirst, ParseElementEnhance)):
+                terminals[i] = _ANY
+        changed = True
+        while changed:
+            changed = False
+            for (i, e) in enumerate(self.__elements):
+                if i in terminals:
+                    f = terminals[i]
+                elif isinstance(e, And):
+                    f = _First(nullable=True)
+                    for x in e.exprs:
+                        fx = first[self.__id(x)]
+                        f = f.union(fx, nullable=fx.nullable)
+                        if not fx.nullable:
+                            break
+                elif isinstance(e, MatchFirst):
+                    f = _First()
+                    for x in e.exprs:
+                        f = f.union(first[self.__id(x)])
+                elif isinstance(e, (Opt, ZeroOrMore)):
+                    f = first[self.__id(e.expr)].union(_First(nullable=True))
+                else:
+                    f = first[self.__id(e.expr)]
+                if f.chars & set(' \t\r\n'):
+                    f = _ANY
+                if f != first[i]:
+                    first[i] = f
+                    changed = True
+        return first
+
+    #
+    # Code generation
+    #
+
+    def __generate(self, stackless):
+        lines = ["# Generated by parsertools.rdengine. Do not edit.", ""]
+        for (i, e) in enumerate(self.__elements):
+            lines.extend(self.__function(i, e, stackless))
+            lines.append('')
+        return '\n'.join(lines)
+
+    def __function(self, i, e, stackless):
+        '''Returns the lines of the function for element e. The function takes the string, the location and a flag that is True if the
+        element must skip whitespace first (pyparsing's callPreParse), and returns (loc, tokens, names), or None if there is no match.
+        In the stackless variant, the function is a generator if it calls other functions, see __call().'''
+        if e.ignoreExprs:
+            raise RDEngineException('Ignore expressions are not supported: {}'.format(e))
+        if e.debug or e.failAction:
+            raise RDEngineException('Debug and fail actions are not supported: {}'.format(e))
+        lines = ['def p{}(s, loc, pre):'.format(i), '    # {}'.format(repr(str(e))[:100])]
+        if e.callPreparse and e.skipWhitespace:
+            if set(e.whiteChars) != set(ParserElement.DEFAULT_WHITE_CHARS):
+                raise RDEngineException('Only the default whitespace characters are supported: {}'.format(e))
+            lines.append('    if pre and loc < len(s) and s[loc] in WHITE:')
+            lines.append('        loc = WHITESPACE(s, loc).end()')
+        body, kinds = self.__body(i, e, stackless)
+        lines.extend('    ' + l for l in body)
+        lines.extend('    ' + l for l in self.__epilogue(i, e, kinds))
+        lines.append('    return loc, t, n')
+        return lines
+
+    def __nextChar(self, var='c'):
+        '''Lines that set var to the next character after whitespace, or to '' at the end of the string.'''
+        return ['q = loc',
+                'if q < len(s) and s[q] in WHITE:',
+                '    q = WHITESPACE(s, q).end()',
+                '{} = s[q:q + 1]'.format(var)]
+
+    def __admits(self, x, var='c'):
+        '''Returns a condition that is True if element x can match at the next character var, or None if that is always the case.'''
+        f = self.__first[self.__id(x)]
+        if f.nullable:
+            return None
+        self.__constants['A{}'.format(self.__id(x))] = f.chars
+        cond = '{} in A{}'.format(var, self.__id(x))
+        if f.nonascii:
+            cond = '({} or {} > "\\x7f")'.format(cond, var)
+        return cond
+
+    def __call(self, function, pre, stackless):
+        '''Returns the expression that calls function at loc and evaluates to its result. In the stackless variant, the call is yielded to
+        the loop in _trampoline(), which sends the result back.'''
+        if stackless:
+            return '(yield ({}, loc, {}))'.format(function, pre)
+        return '{}(s, loc, {})'.format(function, pre)
+
+    def __body(self, i, e, stackless):
+        '''Returns the lines that match element e at loc, leaving loc, t (token list) and n (names dict or None) set, and the kind of the
+        tokens object that pyparsing would have at that point: "results" (a ParseResults object), "list" or "str". The kind matters for
+        the way pyparsing stores a results name. If the kind differs per branch, a variable "kind" is set and "var" is returned.'''
+        c = self.__constants
+        fail = ['if loc > FAIL[0]:', '    FAIL[0] = loc', 'return None']
+        if isinstance(e, Keyword):
+            c['K{}'.format(i)] = e.match
+            c['I{}'.format(i)] = e.identChars
+            n = e.matchLen
+            if e.caseless:
+                c['U{}'.format(i)] = e.caselessmatch
+                lines = ['if not (s[loc:loc + {n}].upper() == U{i} and (loc == 0 or s[loc - 1].upper() not in I{i})'
+                         ' and (loc >= len(s) - {n} or s[loc + {n}].upper() not in I{i})):'.format(n=n, i=i)]
+            else:
+                lines = ['if not (s.startswith(K{i}, loc) and (loc == 0 or s[loc - 1] not in I{i})'
+                         ' and (loc >= len(s) - {n} or s[loc + {n}] not in I{i})):'.format(n=n, i=i)]
+            lines.extend('    ' + l for l in fail)
+            lines.extend(['loc += {}'.format(n), 't = [K{}]'.format(i), 'n = None'])
+            return lines, 'str'
+        elif patternClass(e) in (Literal, _SingleCharLiteral):
+            c['K{}'.format(i)] = e.match
+            lines = ['if not s.startswith(K{}, loc):'.format(i)]
+            lines.extend('    ' + l for l in fail)
+            lines.extend(['loc += {}'.format(e.matchLen), 't = [K{}]'.format(i), 'n = None'])
+            return lines, 'str'
+        elif isinstance(e, Regex):
+            if e.parseImpl.__func__ is not Regex.parseImpl:
+                raise RDEngineException('Only plain Regex patterns are supported: {}'.format(e))
+            c['R{}'.format(i)] = e.re.match
+            lines = ['m = R{}(s, loc)'.format(i), 'if m is None:']
+            lines.extend('    ' + l for l in fail)
+            lines.extend(['loc = m.end()', 't = [m.group()]'])
+            if e.re.groupindex:
+                lines.append('n = m.groupdict()')
+            else:
+                lines.append('n = None')
+            return lines, 'results'
+        elif patternClass(e) is Empty:
+            return ['t = []', 'n = None'], 'list'
+        elif isinstance(e, NotAny):
+            lines = ['if {} is not None:'.format(self.__call('p{}'.format(self.__id(e.expr)), True, stackless))]
+            lines.extend('    ' + l for l in fail)
+            lines.extend(['t = []', 'n = None'])
+            return lines, 'list'
+        elif isinstance(e, And):
+            if any(type(x) is And._ErrorStop for x in e.exprs):
+                raise RDEngineException('Error stops are not supported: {}'.format(e))
+            lines = ['r = {}'.format(self.__call('p{}'.format(self.__id(e.exprs[0])), False, stackless)), 'if r is None:', '    return None', 'loc, t, n = r']
+            for x in e.exprs[1:]:
+                lines.extend(['r = {}'.format(self.__call('p{}'.format(self.__id(x)), True, stackless)), 'if r is None:', '    return None', 'loc, t2, n2 = r'])
+                lines.extend(self.__add())
+            return lines, 'results'
+        elif isinstance(e, MatchFirst):
+            c['D{}'.format(i)] = None
+            c['E{}'.format(i)] = None
+            self.__dispatch[i] = e
+            lines = self.__nextChar()
+            if isinstance(e, KeywordDispatch) and e.dispatch:
+                # look up the keyword at the next location first, see KeywordDispatch
+                c['W{}'.format(i)] = None
+                lines.extend(['a = W{i}.get(WORD(s, q).group().upper())'.format(i=i),
+                              'if a is None:',
+                              '    a = D{i}.get(c, E{i})'.format(i=i)])
+            else:
+                lines.append('a = D{i}.get(c, E{i})'.format(i=i))
+            lines.extend(['for f in a:',
+                          '    r = {}'.format(self.__call('f', True, stackless)),
+                          '    if r is not None:',
+                          '        loc, t, n = r',
+                          '        break',
+                          'else:',
+                          '    return None'])
+            return lines, 'results'
+        elif isinstance(e, (ZeroOrMore, OneOrMore)):
+            if e.not_ender is not None:
+                raise RDEngineException('stopOn is not supported: {}'.format(e))
+            x = self.__id(e.expr)
+            admits = self.__admits(e.expr)
+            if isinstance(e, ZeroOrMore):
+                nomatch = ['t = []', 'n = None']
+            else:
+                nomatch = ['return None']
+            lines = []
+            if admits:
+                lines.extend(self.__nextChar())
+                lines.append('r = {} if {} else None'.format(self.__call('p{}'.format(x), True, stackless), admits))
+            else:
+                lines.append('r = {}'.format(self.__call('p{}'.format(x), True, stackless)))
+            lines.append('if r is None:')
+            lines.extend('    ' + l for l in nomatch)
+            lines.append('else:')
+            lines.append('    loc, t, n = r')
+            lines.append('    while True:')
+            loop = []
+            if admits:
+                loop.extend(self.__nextChar())
+                loop.extend(['if not {}:'.format(admits), '    break'])
+            loop.extend(['r = {}'.format(self.__call('p{}'.format(x), True, stackless)), 'if r is None:', '    break', 'loc, t2, n2 = r'])
+            loop.extend(self.__add())
+            lines.extend('        ' + l for l in loop)
+            return lines, 'results'
+        elif isinstance(e, Opt):
+            if e.defaultValue is not Opt._Opt__optionalNotMatched:
+                raise RDEngineException('Default values are not supported: {}'.format(e))
+            x = self.__id(e.expr)
+            admits = self.__admits(e.expr)
+            lines = []
+            if admits:
+                lines.extend(self.__nextChar())
+                lines.append('r = {} if {} else None'.format(self.__call('p{}'.format(x), False, stackless), admits))
+            else:
+                lines.append('r = {}'.format(self.__call('p{}'.format(x), False, stackless)))
+            lines.extend(['if r is None:', '    t = []', '    n = None', "    kind = 'list'",
+                          'else:', '    loc, t, n = r', "    kind = 'results'"])
+            return lines, 'var'
+        elif isinstance(e, (Group, Suppress, Combine, Forward, DelimitedList)) or patternClass(e) in (ParseElementEnhance, TokenConverter):
+            lines = ['r = {}'.format(self.__call('p{}'.format(self.__id(e.expr)), False, stackless)), 'if r is None:', '    return None', 'loc, t, n = r']
+            if isinstance(e, Group):
+                if e._asPythonList:
+                    raise RDEngineException('aslist groups are not supported: {}'.format(e))
+                lines.extend(['t = [GROUP(t, n)]', 'n = None'])
+                return lines, 'list'
+            elif isinstance(e, Suppress):
+                lines.extend(['t = []', 'n = None'])
+                return lines, 'list'
+            elif isinstance(e, Combine):
+                c['J{}'.format(i)] = e.joinString
+                lines.append('t = [JOIN(t, J{})]'.format(i))
+                if e.resultsName:
+                    lines.extend(['if n:', '    t = [GROUP(t, dict(n))]', '    n = None', "    kind = 'list'",
+                                  'else:', "    kind = 'results'"])
+                    return lines, 'var'
+                return lines, 'results'
+            return lines, 'results'
+        else:
+            raise RDEngineException('Unsupported pattern class {}: {}'.format(e.__class__.__name__, e))
+
+    def __add(self):
+        '''Lines that add tokens t2 and names n2 to t and n, as ParseResults.__iadd__ does.'''
+        return ['if t2 or n2:',
+                '    t += t2',
+                '    if n2:',
+                '        if n is None:',
+                '            n = {}',
+                '        n.update(n2)']
+
+    def __naming(self, name, aslist, kind):
+        '''Lines that store the results name, as the ParseResults constructor does for a tokens object of the given kind.'''
+        if kind == 'var':
+            lines = ["if kind == 'list':"]
+            lines.extend('    ' + l for l in self.__naming(name, aslist, 'list'))
+            lines.append('else:')
+            lines.extend('    ' + l for l in self.__naming(name, aslist, 'results'))
+            return lines
+        store = ['if n is None:', '    n = {}', 'n[{!r}] = v'.format(name)]
+        if kind == 'list':
+            value = 'v = t[0] if type(t[0]) is GROUP else object()' if aslist else 'v = t[0]'
+            return ['if t:'] + ['    ' + l for l in [value] + store]
+        elif kind == 'str':
+            return ['v = object()' if aslist else 'v = t[0]'] + store
+        else:
+            if aslist:
+                return ['v = object()'] + store
+            return ['if t:'] + ['    ' + l for l in ['v = t[0]'] + store]
+
+    def __epilogue(self, i, e, kind):
+        '''Lines for results names and parse actions of element e.'''
+        lines = []
+        if e.resultsName:
+            lines.extend(self.__naming(e.resultsName, e.saveAsList, kind))
+        for action in e.parseAction:
+            fn = _parseAction(action)
+            if hasattr(fn, 'structClass'):
+                self.__constants['C{}'.format(i)] = fn.structClass
+                lines.append('t = [STRUCT(C{}, t, n)]'.format(i))
+                lines.append('n = None')
+                if e.resultsName:
+                    lines.extend(['if n is None:', '    n = {}', 'n[{!r}] = t[0]'.format(e.resultsName)])
+            elif hasattr(fn, 'separator'):
+                self.__constants['S{}'.format(i)] = fn.separator
+                lines.append('t = SEPARATED(t, n, S{})'.format(i))
+                lines.append('n = None')
+                if e.resultsName:
+                    lines.extend(self.__naming(e.resultsName, e.saveAsList, 'list'))
+            else:
+                raise RDEngineException('Unsupported parse action {} on {}'.format(fn, e))
+        return lines
+
+    #
+    # Compilation
+    #
+
+    def __code(self, stackless):
+        '''Returns the compiled source of the recursive or stackless variant of the parser, compiled at first use.'''
+        if stackless not in self.__codes:
+            name = '<rdengine {}{}>'.format(self.parser.class_.__name__, ' stackless' if stackless else '')
+            self.__codes[stackless] = compile(self.getSource(stackless), name, 'exec')
+        return self.__codes[stackless]
+
+    def __compile(self, stackless, charged):
+        namespace = {'FAIL': [0],
+                     'WHITE': ParserElement.DEFAULT_WHITE_CHARS,
+                     'WHITESPACE': re.compile('[{}]*'.format(re.escape(ParserElement.DEFAULT_WHITE_CHARS))).match,
+                     'WORD': re.compile('[{}]*'.format(re.escape(Keyword.DEFAULT_KEYWORD_CHARS))).match,
+                     'GROUP': _Group,
+                     'JOIN': _join,
+                     'STRUCT': _struct,
+                     'SEPARATED': _separated}
+        namespace['skip'] = lambda s, loc: namespace['WHITESPACE'](s, loc).end()
+        namespace['RUN'] = _trampoline if stackless else _call
+        namespace.update(self.__constants)
+        exec(self.__code(stackless), namespace)
+        if charged:
+            # the functions call each other by name, so replacing them here (before the dispatch tables are made) charges every call
+            budget = namespace['BUDGET'] = [None]
+            for i in range(len(self.__elements)):
+                name = 'p{}'.format(i)
+                namespace[name] = (_chargedStackless if stackless else _charged)(namespace[name], budget)
+        for (i, e) in self.__dispatch.items():
+            alternatives = [(self.__first[self.__id(x)], namespace['p{}'.format(self.__id(x))]) for x in e.exprs]
+            table = {}
+            for ch in list(_ASCII) + ['']:
+                table[ch] = tuple(f for (first, f) in alternatives if first.admits(ch))
+            namespace['D{}'.format(i)] = table
+            namespace['E{}'.format(i)] = tuple(f for (first, f) in alternatives if first.admits('\x80'))
+            if 'W{}'.format(i) in namespace:
+                table, _ = e.getTable()
+                functions = dict((id(x), f) for (x, (_, f)) in zip(e.exprs, alternatives))
+                namespace['W{}'.format(i)] = dict((k, tuple(functions[id(x)] for x in xs if self.__first[self.__id(x)].admits(k[0]) or self.__first[self.__id(x)].admits(k[0].lower())))
+                                                  for (k, xs) in table.items())
+        return namespace
+
+
+#
+# Functions called from the generated code
+#
+
+def _stringList(toks, sep=''):
+    '''Same as ParseResults._asStringList().'''
+    out = []
+    for item in toks:
+        if out and sep:
+            out.append(sep)
+        if isinstance(item, _Group):
+            out += _stringList(item.toks)
+        else:
+            out.append(str(item))
+    return out
+
+def _join(toks, joinString):
+    return ''.join(_stringList(toks, joinString))
+
+def _itemList(toks, names, table, parent):
+    '''Same as itemList() in parseStructFunc() (see base.py), for tokens and names as produced by the generated code.'''
+    while len(toks) == 1 and isinstance(toks[0], _Group):
+        toks, names = toks[0].toks, toks[0].names
+    valuedict = dict((id(t), k) for (k, t) in names.items()) if names else {}
+    assert len(valuedict) == (len(names) if names else 0), 'internal error: len(valuedict) = {}, len(names) = {}'.format(len(valuedict), len(names))
+    result = []
+    for t in toks:
+        if isinstance(t, str):
+            result.append(t if table is None else table.intern(t))
+        elif isinstance(t, ParseStruct):
+            if t._label == None:
+                object.__setattr__(t, '_label', valuedict.get(id(t)))
+            object.__setattr__(t, '_parent', parent)
+            result.append(t)
+        elif isinstance(t, list):
+            result.append(t)
+        else:
+            assert isinstance(t, _Group), type(t)
+            assert valuedict.get(id(t)) == None, 'Error: found label ({}) for compound expression'.format(valuedict.get(id(t)))
+            result.extend(_itemList(t.toks, t.names, table, parent))
+    return result
+
+def _struct(class_, toks, names):
+    '''Same as makeparseinfo() in parseStructFunc() (see base.py).'''
+    result = class_(None)
+    result.setItems(_itemList(toks, names, class_._getInternTable(), result))
+    return result
+
+def _separated(toks, names, sep):
+    '''Same as makeList() in separatedList() (see base.py).'''
+    assert len(toks) > 0, 'internal error'
+    keys = list(names) if names else []
+    assert len(keys) <= 1, 'internal error, got more than one key: {}'.format(keys)
+    label = keys[0] if len(keys) == 1 else None
+    templist = []
+    for item in toks:
+        if isinstance(item, ParseStruct):
+            object.__setattr__(item, '_label', label)
+            templist.append(item)
+        else:
+            assert isinstance(item, str)
+            templist.append(item)
+    result = [templist[0]]
+    for p in templist[1:]:
+        result.append(sep)
+        result.append(p)
+    return result
+
+def _charged(function, budget):
+    '''Returns a function that does the same as function (a generated function, see RDEngine.__function()), after charging budget[0] for it.'''
+    def charged(s, loc, pre):
+        b = budget[0]
+        b.step()
+        try:
+            return function(s, loc, pre)
+        finally:
+            b.depth -= 1
+    return charged
+
+def _chargedStackless(function, budget):
+    '''As _charged(), for a function of the stackless variant.'''
+    def charged(s, loc, pre):
+        b = budget[0]
+        b.step()
+        try:
+            return (yield (function, loc, pre))
+        finally:
+            b.depth -= 1
+    return charged
+
+def _call(function, s, loc, pre):
+    '''Runs a function of the recursive variant of the generated parser.'''
+    return function(s, loc, pre)
+
+def _trampoline(function, s, loc, pre):
+    '''Runs a function of the stackless variant of the generated parser. A function that calls other functions is a generator that yields
+    a (function, loc, pre) triple per call, and receives the result of the call back. The suspended generators are kept on a list, so that
+    the depth of the Python stack does not grow with the nesting of the input.'''
+    result = function(s, loc, pre)
+    if type(result) is not GeneratorType:
+        return result
+    stack = [result]
+    result = None
+    while stack:
+        try:
+            function, loc, pre = stack[-1].send(result)
+        except StopIteration as e:
+            stack.pop()
+            result = e.value
+            continue
+        result = function(s, loc, pre)
+        if type(result) is GeneratorType:
+            stack.append(result)
+            result = None
+    return result
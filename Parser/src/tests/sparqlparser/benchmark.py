@@ -0,0 +1,131 @@
+'''
+Benchmarks for the SPARQL parser. Run as a script, with the src directory on the PYTHONPATH:
+
+    python tests/sparqlparser/benchmark.py
+'''
+
+import gc
+import sys
+import timeit
+import tracemalloc
+from parsertools.base import KeywordDispatch
+from parsertools.parsers.sparqlparser import SPARQLParser, parseQuery
+
+def timePerCall(func, repeat=5, number=20):
+    '''Returns the best time per call of func over repeat runs, in microseconds.'''
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number * 1e6
+
+def keywordDispatch():
+    '''Per call saving of KeywordDispatch on function calls in FILTER expressions. Each case is parsed with the dispatch tables (the default)
+    and with KeywordDispatch.dispatch set to False, which makes BuiltInCall, Update1 and GraphPatternNotTriples plain MatchFirst patterns.'''
+    calls = ['STR(?x)',
+             'isNUMERIC(?x)',
+             'SHA512(?x)',
+             'NOT EXISTS { ?x ?p ?o }']
+    filters = ['FILTER (isIRI(?s) && STRSTARTS(STR(?s), "http://") && !isBLANK(?o) && LANG(?o) = "en")',
+               'FILTER (isNUMERIC(?o) && ABS(?o) > 1 && SHA512(STR(?o)) != MD5(STR(?s)) && COALESCE(?x, TZ(NOW())) != "Z")']
+    query = 'SELECT * WHERE {{ ?s ?p ?o {} }}'.format(' '.join(filters))
+    cases = [('BuiltInCall ' + c, SPARQLParser.BuiltInCall, c) for c in calls]
+    cases += [('Constraint ' + f[len('FILTER '):][:40] + '...', SPARQLParser.Constraint, f[len('FILTER '):]) for f in filters]
+    cases.append(('parseQuery, both FILTERs', parseQuery, query))
+    print('KeywordDispatch, time per call in microseconds:')
+    print('{:60} {:>10} {:>10} {:>8}'.format('', 'dispatch', 'plain', 'saving'))
+    for (name, parse, s) in cases:
+        try:
+            KeywordDispatch.dispatch = False
+            plain = timePerCall(lambda: parse(s))
+        finally:
+            KeywordDispatch.dispatch = True
+        dispatch = timePerCall(lambda: parse(s))
+        print('{:60} {:10.0f} {:10.0f} {:7.0f}%'.format(name, dispatch, plain, 100 * (plain - dispatch) / plain))
+
+def nestingDepth(depths=(5, 10, 20, 50, 100, 200, 400)):
+    '''Scaling of parseQuery and of the tree walkers with the nesting depth of an expression, for each backend. The pyparsing and rd backends
+    recurse for every level of nesting, and fall back to the stack variant of the rd backend when the recursion limit is reached; the stack backend
+    always uses that variant. The walkers (str, dump, searchElements, createParentPointers) are timed on the tree from the stack backend.'''
+    backends = ['pyparsing', 'rd', 'stack']
+    print('Nesting depth, time per call in milliseconds:')
+    print('{:>6} {:>12} {:>12} {:>12} {:>12}'.format('depth', *(backends + ['walkers'])))
+    try:
+        for n in depths:
+            query = 'SELECT * WHERE {{ ?s ?p ?o FILTER ({}?o{}) }}'.format('(' * n, ' + 1)' * n)
+            times = []
+            for backend in backends:
+                SPARQLParser.setBackend(backend)
+                times.append('{:12.1f}'.format(timePerCall(lambda: parseQuery(query), repeat=3, number=3) / 1000))
+            tree = parseQuery(query)
+            walk = lambda: (str(tree), tree.dump(), tree.searchElements(), tree.createParentPointers())
+            times.append('{:12.1f}'.format(timePerCall(walk, repeat=3, number=3) / 1000))
+            print('{:6} {}'.format(n, ' '.join(times)))
+    finally:
+        SPARQLParser.setBackend('pyparsing')
+
+def benchmarkQuery(copies=10):
+    '''Returns a query of about 1.4 KB (for copies=10), with two prefixes and a group of triple patterns with a FILTER per copy.'''
+    return ('PREFIX ex: <http://example.org/>\nPREFIX foaf: <http://xmlns.com/foaf/0.1/>\nSELECT ?name (COUNT(?friend) AS ?n) WHERE {\n' +
+            ''.join('  ?p{0} foaf:name ?name ; ex:age ?age{0} ; foaf:knows ?friend .\n'
+                    '  OPTIONAL {{ ?friend ex:score ?s{0} FILTER (?s{0} > {0} && ?age{0} < 60) }}\n'.format(i) for i in range(copies)) +
+            '} GROUP BY ?name ORDER BY DESC(?n) LIMIT 10\n')
+
+def nodeSize(copies=10):
+    '''Memory used per node of the tree for a query of about 1.4 KB: the bytes allocated while parsing it that are still in use by the tree
+    (as traced by tracemalloc, after collecting the garbage of the parse), and the sizes of the ParseStruct objects themselves, their attribute dicts (none, as they use slots) and their item lists. The same
+    query parsed to a FlatTree (see base.py) takes the size of its arrays and tables.'''
+    query = benchmarkQuery(copies)
+    traced = []
+    for flat in (False, True):
+        parseQuery(query, flat=flat)
+        tree = None
+        gc.collect()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            tree = parseQuery(query, flat=flat)
+            gc.collect()
+            traced.append(tracemalloc.get_traced_memory()[0] - before)
+        finally:
+            tracemalloc.stop()
+    nodes = parseQuery(query).searchElements()
+    print('Node size, for a query of {} characters with {} nodes, in bytes per node:'.format(len(query), len(nodes)))
+    print('{:12} {:>10} {:>10} {:>10} {:>10}'.format('', 'traced', 'object', 'dict', 'items'))
+    print('{:12} {:10.0f} {:10.0f} {:10.0f} {:10.0f}'.format('ParseStruct', traced[0] / len(nodes),
+                                                             sum(sys.getsizeof(e) for e in nodes) / len(nodes),
+                                                             sum(sys.getsizeof(e.__dict__) for e in nodes if hasattr(e, '__dict__')) / len(nodes),
+                                                             sum(sys.getsizeof(e.getItems()) for e in nodes) / len(nodes)))
+    print('{:12} {:10.0f} {:>10} {:>10} {:>10}'.format('FlatTree', traced[1] / len(nodes), '', '', '') + ' (arrays and tables: {:.0f})'.format(tree.getSize() / len(nodes)))
+
+def interning(trees=50):
+    '''Memory retained per tree, in bytes, when trees parsed from the query of nodeSize() are kept, without and with interning of their strings and
+    prefix dicts (see InternTable in base.py).'''
+    query = benchmarkQuery()
+    retained = []
+    try:
+        for intern in (False, True):
+            if intern:
+                SPARQLParser.enableInterning()
+            parseQuery(query)
+            kept = None
+            gc.collect()
+            tracemalloc.start()
+            try:
+                before = tracemalloc.get_traced_memory()[0]
+                kept = [parseQuery(query) for _ in range(trees)]
+                gc.collect()
+                retained.append((tracemalloc.get_traced_memory()[0] - before) / trees)
+            finally:
+                tracemalloc.stop()
+        stats = SPARQLParser.getInternStats()
+    finally:
+        SPARQLParser.disableInterning()
+    print('Interning, memory retained per tree for {} trees, in bytes:'.format(trees))
+    print('{:>10} {:>10} {:>10} {:>14}'.format('plain', 'interned', 'saving', 'table bytes'))
+    print('{:10.0f} {:10.0f} {:9.1f}% {:14}'.format(retained[0], retained[1], 100 * (retained[0] - retained[1]) / retained[0], stats['bytes']))
+
+if __name__ == '__main__':
+    keywordDispatch()
+    print()
+    nestingDepth()
+    print()
+    nodeSize()
+    print()
+    interning()
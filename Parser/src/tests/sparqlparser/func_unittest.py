@@ -4,9 +4,31 @@ Created on 20 apr. 2016
 @author: jeroenbruijning
 '''
 import unittest
-
-from parsertools.parsers.sparqlparser import SPARQLParser, SPARQLParseException
-from parsertools.parsers.sparqlparser import stripComments, parseQuery, unescapeUcode
+import pickle
+import io
+import os
+import tempfile
+import asyncio
+import threading
+import time
+from unittest import mock
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from pyparsing import ParserElement, Literal, Word, OneOrMore, Group, alphas, nums
+
+from parsertools import ParsertoolsException, BudgetExceededError
+from parsertools.base import ParseStruct, KeywordDispatch, ParseBudget, InternTable, packTree, unpackTree, FlatTree, FlatElement, Selector, patternClass
+from parsertools.rdengine import RDEngine
+from parsertools.parsers.sparqlparser import Parser, SPARQLParser, SPARQLParseException
+from parsertools.parsers.sparqlparser import stripComments, parseQuery, reparseQuery, parseQueries, parseQueryLog, readRecords, AsyncQueryParser, parseQueryAsync, unescapeUcode
+
+
+@contextmanager
+def spyOnParse():
+    '''Patches ParseStruct._parseString with a mock that still parses, and records the calls with the class as first argument. Yields the mock.'''
+    spy = mock.Mock(side_effect=ParseStruct._parseString.__func__)
+    with mock.patch.object(ParseStruct, '_parseString', classmethod(spy)):
+        yield spy
 
 
 class Test(unittest.TestCase):
@@ -51,7 +73,188 @@ class Test(unittest.TestCase):
         s = '<c:check#22?> ( $var, ?var )'
         r = SPARQLParser.PrimaryExpression(s, postParseCheck=False)
         assert r.iriOrFunction.iri == SPARQLParser.iri('<c:check#22?>', postParseCheck=False)
-    
+
+    def testSlots(self):
+        r = parseQuery('PREFIX ex: <http://ex.org/> SELECT * WHERE { ?s ex:p "a" }')
+        elements = r.searchElements()
+        assert not any(hasattr(e, '__dict__') for e in elements)
+        assert SPARQLParser.PrefixedName._getSlotNames() == ('_items', '_label', '_parent', '_string', '_digest', '_labelIndex', '_typeIndex', '_prefixes', '_baseiri')
+        for att in ('_label', '_prefixes', 'other'):
+            try:
+                setattr(r, att, None)
+                assert False, att
+            except AttributeError:
+                pass
+        for att in ('other', '__other__'):
+            assert not hasattr(r, att)
+        assert str(r.searchElements(element_type=SPARQLParser.PrefixDecl)[0].namespace) == '<http://ex.org/>'
+        # the elements within the scope of a Prologue share its prefixes
+        assert len(set(id(e.getPrefixes()) for e in elements)) == 2
+        c = r._clone()
+        assert c.dump() == r.dump() and c.hasParentPointers()
+        assert all(e.getLabel() == f.getLabel() and e.getPrefixes() is f.getPrefixes() for (e, f) in zip(c.searchElements(), elements))
+
+    def testCachedStrings(self):
+        q = 'PREFIX ex: <http://ex.org/> SELECT * WHERE { ?s ex:p "a", "b" FILTER (?s > 1) }'
+        r = parseQuery(q)
+        string = str(r)
+        elements = r.searchElements()
+        assert all(e._string == str(e) for e in elements) and str(r) is string
+        literal = r.searchElements(element_type=SPARQLParser.String)[0]
+        other = r.searchElements(element_type=SPARQLParser.Constraint)[0]
+        literal.updateWith('"c"')
+        # the strings of the element and its ancestors are dropped, the others are kept
+        assert set(id(e) for e in elements if e._string is None) == set(id(e) for e in [literal] + literal.getAncestors())
+        assert other._string is not None and str(r) == string.replace('"a"', '"c"') == str(parseQuery(q.replace('"a"', '"c"')))
+        assert r == parseQuery(q.replace('"a"', '"c"')) != parseQuery(q)
+        r.expandIris()
+        assert str(r) == string.replace('"a"', '"c"').replace('ex:p', '<http://ex.org/p>')
+        c = r._clone()
+        assert str(c) is str(r)
+        for t in (unpackTree(packTree(r), SPARQLParser), FlatTree(r).getRoot().toParseStruct()):
+            assert t._string is None and t.dump() == r.dump()
+        t = reparseQuery(parseQuery(q), q, q.index('?s >'), 2, '?o')
+        assert str(t) == str(parseQuery(q.replace('?s >', '?o >')))
+
+    def testDigest(self):
+        q1 = 'SELECT * WHERE { ?s ?p ?o FILTER (?o > 1) OPTIONAL { ?s ?q ?o FILTER (?o > 1) } }'
+        q2 = 'PREFIX ex: <http://ex.org/> ASK { ?s ex:p ?o FILTER (?o > 1) FILTER (?o < 2) }'
+        filters = [f for q in (q1, q2) for f in parseQuery(q).searchElements(element_type=SPARQLParser.Filter)]
+        assert len(filters) == 4 and len(set(filters)) == 2 and len(set(f.getDigest() for f in filters)) == 2
+        assert len(filters[0].getDigest()) == 16 and hash(filters[0]) == hash(filters[1]) == hash(filters[2])
+        assert filters[0] == filters[2] and filters[0] != filters[3]
+        # labels and prefixes do not count, the class does
+        r1, r2 = parseQuery(q1), parseQuery(q1)
+        t1, t2 = r1.searchElements(element_type=SPARQLParser.TriplesBlock)[0], r2.searchElements(element_type=SPARQLParser.TriplesBlock)[0]
+        labeled = [e for e in r1.searchElements() if e.getLabel()][0]
+        assert t1 == t2 and t1._clone() == t1 and labeled == labeled._parseString(str(labeled))[0]
+        assert SPARQLParser.VarOrTerm('?s') != SPARQLParser.Var('?s') and SPARQLParser.VarOrTerm('?s') == r1.searchElements(element_type=SPARQLParser.VarOrTerm)[0]
+        # the digests of a changed element and its ancestors change, and are the same as for a tree parsed from the changed string
+        digests = dict((id(e), e.getDigest()) for e in r1.searchElements())
+        var = t1.searchElements(element_type=SPARQLParser.Var)[0]
+        var.updateWith('?x')
+        # the items of var are new elements
+        changed = set(id(e) for e in r1.searchElements() if id(e) in digests and e.getDigest() != digests[id(e)])
+        assert changed == set(id(e) for e in [var] + var.getAncestors()), changed
+        assert r1 == parseQuery(q1.replace('?s ?p', '?x ?p')) != r2 and t1 != t2
+        var.updateWith('?s')
+        assert r1 == r2 and hash(r1) == hash(r2) and t1 == t2
+        assert unpackTree(packTree(r1), SPARQLParser) == r1 == FlatTree(r1).getRoot().toParseStruct()
+
+    def testLabelIndex(self):
+        r = parseQuery('PREFIX ex: <http://ex.org/> SELECT * WHERE { ?s ex:p "a"@en }')
+        decl = r.searchElements(element_type=SPARQLParser.PrefixDecl)[0]
+        # built on first use
+        assert SPARQLParser.RDFLiteral('"a"@en')._labelIndex is None
+        assert str(decl.prefix) == 'ex:' and str(decl.namespace) == '<http://ex.org/>' and decl.hasLabel('prefix') and not decl.hasLabel(None)
+        assert decl._labelIndex is not None and decl.prefix is decl.getValuesForLabel('prefix')[0] is decl.getChildren()[1]
+        assert decl.getValuesForLabel(None) == [c for c in decl.getChildren() if c.getLabel() is None] and decl.getValuesForLabel('other') == []
+        # the lists returned are copies
+        decl.getValuesForLabel('prefix').clear()
+        assert decl.hasLabel('prefix') and list(decl.getLabels()) == ['prefix', 'namespace']
+        literal = r.searchElements(element_type=SPARQLParser.RDFLiteral)[0]
+        assert str(literal.lexical_form) == '"a"' and str(literal.langtag) == '@en'
+        literal.updateWith('"b"^^ex:t')
+        assert str(literal.lexical_form) == '"b"' and str(literal.datatype_uri) == 'ex:t' and not literal.hasLabel('langtag')
+        try:
+            literal.langtag
+            assert False
+        except AttributeError:
+            pass
+        c = decl._clone()
+        assert c.prefix is c.getChildren()[1] is not decl.prefix and c.prefix.getParent() is c
+
+    def testTypeIndex(self):
+        q = 'PREFIX ex: <http://ex.org/> SELECT * WHERE { ?s ex:p ?o OPTIONAL { ?o ex:q ex:r } }'
+        for r in (parseQuery(q), SPARQLParser.QueryUnit(q)):
+            r.searchElements(element_type=SPARQLParser.Var)
+            index = r._typeIndex
+            # searchElements() returns the top element twice
+            assert index is not None and all(e._typeIndex is None for e in r.searchElements()[2:])
+            assert [str(e) for e in r.searchElements(element_type=SPARQLParser.PrefixedName)] == ['ex:p', 'ex:q', 'ex:r']
+            assert r._typeIndex is index and r.searchElements(element_type=SPARQLParser.QueryUnit) == [r, r]
+            # searches below the top element walk their subtree
+            group = r.searchElements(element_type=SPARQLParser.OptionalGraphPattern)[0]
+            assert [str(e) for e in group.searchElements(element_type=SPARQLParser.PrefixedName)] == ['ex:q', 'ex:r']
+            assert [str(e) for e in r.searchElements(element_type=SPARQLParser.PrefixedName, labeledOnly=True)] == []
+            r.searchElements(element_type=SPARQLParser.iri)[-1].updateWith('<http://ex.org/r>')
+            assert r._typeIndex is None
+            assert [str(e) for e in r.searchElements(element_type=SPARQLParser.PrefixedName)] == ['ex:p', 'ex:q']
+            assert [str(e) for e in r.searchElements(element_type=SPARQLParser.IRIREF)] == ['<http://ex.org/>', '<http://ex.org/r>']
+            r.expandIris()
+            assert r.searchElements(element_type=SPARQLParser.PrefixedName) == [] and r._clone()._typeIndex is None
+
+    def testIterSearch(self):
+        q = 'PREFIX ex: <http://ex.org/> SELECT * WHERE { SERVICE <http://s.org/> { ?a ?b ?c } ?s ex:p ?o { SELECT ?o WHERE { ?o ?p 1 } } }'
+        r = parseQuery(q)
+        # the same elements as searchElements(), without the top element twice
+        for args in ({}, {'element_type': SPARQLParser.Var}, {'labeledOnly': True}, {'label': 'namespace'}, {'value': '?o'}):
+            found = r.searchElements(**args)
+            expected = found[1:] if len(found) > 1 and found[0] is found[1] is r else found
+            assert list(r.iterSearch(**args)) == expected and len(expected) > 0, args
+        assert [str(e) for e in r.iterSearch(element_type=SPARQLParser.Var, prune=lambda e: isinstance(e, SPARQLParser.SubSelect))] == ['?a', '?b', '?c', '?s', '?o']
+        assert [str(e) for e in r.iterSearch(element_type=SPARQLParser.SubSelect, prune=lambda e: isinstance(e, SPARQLParser.SubSelect))] == ['SELECT ?o WHERE { ?o ?p 1 }']
+        assert [str(e) for e in r.iterSearch(element_type=SPARQLParser.Var, limit=2)] == ['?a', '?b'] and list(r.iterSearch(limit=0)) == []
+        post = list(r.iterSearch(order='post'))
+        assert post[-1] is r and sorted(map(id, post)) == sorted(map(id, r.iterSearch()))
+        assert all(post.index(c) < post.index(e) for e in post for c in e.getChildren())
+        # the first match ends the walk
+        visited = []
+        service = next(r.iterSearch(element_type=SPARQLParser.ServiceGraphPattern, prune=lambda e: visited.append(e)))
+        assert str(service) == 'SERVICE <http://s.org/> { ?a ?b ?c }' and len(visited) < len(r.searchElements()) / 2
+        try:
+            list(r.iterSearch(order='in'))
+            assert False
+        except ParsertoolsException:
+            pass
+
+    def testValueSearch(self):
+        q = 'PREFIX ex: <http://ex.org/> SELECT * WHERE { ?s ex:p ?o . ?o ex:q ?s OPTIONAL { ?s ex:p ?x } FILTER (?x != ?s) }'
+        r = parseQuery(q)
+        # the value is parsed once per class of element, not once per element
+        with spyOnParse() as spy:
+            found = r.searchElements(value='?s')
+            classes = [c.args[0] for c in spy.call_args_list]
+            assert len(classes) == len(set(classes)) == len(set(e.__class__ for e in r.searchElements()))
+            spy.reset_mock()
+            assert list(r.iterSearch(value='?s')) == found
+            classes = [c.args[0] for c in spy.call_args_list]
+            assert len(classes) == len(set(classes))
+        assert found and all(str(e) in ('?s', '') for e in found)
+        assert [e.__class__ for e in found[:2]] == [SPARQLParser.VarOrTerm, SPARQLParser.Var]
+        assert [str(e) for e in r.searchElements(element_type=SPARQLParser.PrefixedName, value='ex:p')] == ['ex:p', 'ex:p']
+        assert all(str(e) == '' for e in r.searchElements(value='?z')) and r.searchElements(element_type=SPARQLParser.Var, value='ex:p') == []
+
+    def testSelector(self):
+        q = 'PREFIX ex: <http://ex.org/> SELECT * WHERE { ?s ex:p ?o OPTIONAL { ?s ex:q ?x FILTER (?x > 3 && ?o < ?x) } FILTER (?s != ?y) SERVICE <http://s.org/> { ?a ?b ?c } }'
+        r = parseQuery(q)
+        # the same elements as chained searches
+        expected = []
+        for o in r.searchElements(element_type=SPARQLParser.OptionalGraphPattern):
+            for f in o.searchElements(element_type=SPARQLParser.Filter):
+                expected += f.searchElements(element_type=SPARQLParser.Var)
+        found = r.select('//OptionalGraphPattern//Filter//Var')
+        assert [str(e) for e in found] == ['?x', '?o', '?x'] and all(e is f for (e, f) in zip(found, expected))
+        assert list(r.iterSelect(Selector('//OptionalGraphPattern//Filter//Var'))) == found
+        assert [str(e) for e in r.select('//PrefixDecl/*[@label="namespace"]')] == ['<http://ex.org/>']
+        assert [str(e) for e in r.select('//Filter[.//Var[.=\'?y\']]')] == ['FILTER ( ?s != ?y )']
+        assert [str(e) for e in r.select('//GroupGraphPattern[not(.//ServiceGraphPattern)]')] == ['{ ?s ex:q ?x FILTER ( ?x > 3 && ?o < ?x ) }', '{ ?a ?b ?c }']
+        assert [str(e) for e in r.select('//Var[starts-with(., "?o")]')] == ['?o', '?o']
+        assert r.select('/QueryUnit') == [r] and r.select('/Var') == [] and len(r.select('//*')) == len(r.searchElements()) - 1
+        assert [str(e) for e in r.select('Query/Prologue')] == ['PREFIX ex: <http://ex.org/>']
+        # from an element below the top, and on a FlatTree
+        optional = r.select('//OptionalGraphPattern')[0]
+        assert [str(e) for e in optional.select('.//Var')] == ['?s', '?x', '?x', '?o', '?x']
+        flat = parseQuery(q, flat=True).getRoot()
+        for selector in ('//OptionalGraphPattern//Filter//Var', '//*[@label]', 'Query/Prologue'):
+            assert [str(e) for e in flat.select(selector)] == [str(e) for e in r.select(selector)]
+        for selector in ('', '//', 'Var[', 'Var[.=x]', 'Var/'):
+            try:
+                Selector(selector)
+                assert False, selector
+            except ParsertoolsException:
+                pass
+
     def testUpdateWith(self):
         s = "'work' ^^<work:>"
         r = SPARQLParser.RDFLiteral(s)
@@ -76,6 +279,55 @@ SELECT ?p WHERE
         assert str(subjpath.getAncestors()) == '[iri("<http://xmlns.com/foaf/0.1/Person>"), GraphTerm("<http://xmlns.com/foaf/0.1/Person>"), VarOrTerm("<http://xmlns.com/foaf/0.1/Person>"), GraphNodePath("<http://xmlns.com/foaf/0.1/Person>"), ObjectPath("<http://xmlns.com/foaf/0.1/Person>"), ObjectListPath("<http://xmlns.com/foaf/0.1/Person>"), PropertyListPathNotEmpty("a <http://xmlns.com/foaf/0.1/Person>"), TriplesSameSubjectPath("?p a <http://xmlns.com/foaf/0.1/Person>"), TriplesBlock("?p a <http://xmlns.com/foaf/0.1/Person>"), GroupGraphPatternSub("?p a <http://xmlns.com/foaf/0.1/Person>"), GroupGraphPattern("{ ?p a <http://xmlns.com/foaf/0.1/Person> }"), WhereClause("WHERE { ?p a <http://xmlns.com/foaf/0.1/Person> }"), SelectQuery("SELECT ?p WHERE { ?p a <http://xmlns.com/foaf/0.1/Person> }"), Query("PREFIX foaf: <http://xmlns.com/foaf/0.1/> SELECT ?p WHERE { ?p a <http://xmlns.com/foaf/0.1/Person> }"), QueryUnit("PREFIX foaf: <http://xmlns.com/foaf/0.1/> SELECT ?p WHERE { ?p a <http://xmlns.com/foaf/0.1/Person> }")]'
         assert r.hasParentPointers()
         
+    def testUpdateWithElement(self):
+        q = 'PREFIX ex: <http://ex.org/> SELECT * WHERE { ?s ex:p ?o FILTER (?o != ex:q) }'
+        r = parseQuery(q)
+        source = parseQuery('SELECT * WHERE { ?a <http://ex.org/r> ?b }')
+        before = source.dump()
+        # an element of the same class is spliced in without parsing, from a copy
+        with spyOnParse() as spy:
+            target = r.searchElements(element_type=SPARQLParser.iri)[0]
+            new = source.searchElements(element_type=SPARQLParser.iri)[0]
+            target.updateWith(new)
+            assert not spy.called
+        assert str(r) == 'PREFIX ex: <http://ex.org/> SELECT * WHERE { ?s <http://ex.org/r> ?o FILTER ( ?o != ex:q ) }'
+        assert r.hasParentPointers() and target.getChildren()[0] is not new.getChildren()[0] and source.dump() == before
+        # a FlatElement, an element of another class, and a string
+        var = r.searchElements(element_type=SPARQLParser.Var)[0]
+        var.updateWith(parseQuery('SELECT ?x {}', flat=True).getRoot().select('//Var')[0])
+        var.updateWith(SPARQLParser.VarOrTerm('?y'))
+        target.updateWith('ex:t')
+        assert str(r) == 'PREFIX ex: <http://ex.org/> SELECT * WHERE { ?y ex:t ?o FILTER ( ?o != ex:q ) }' and r.hasParentPointers()
+        # with validate=True, an element that does not render to itself is refused, and the update undone
+        bad = SPARQLParser.Var('?z')
+        bad.setItems(['?z ?w'])
+        var.updateWith(bad)
+        assert str(var) == '?z ?w' and not var.isValid()
+        var.updateWith('?y')
+        try:
+            var.updateWith(bad, validate=True)
+            assert False
+        except ParsertoolsException:
+            pass
+        assert str(var) == '?y' and var.isValid() and r.hasParentPointers()
+        var.updateWith('?v', validate=True)
+        assert str(var) == '?v'
+        # the spliced items take the prefixes and base in force where they are put, not those of the tree they come from
+        r = parseQuery('BASE <http://base.org/> PREFIX ex: <http://ex.org/> SELECT * WHERE { ?s ex:p <o> }')
+        source = parseQuery('BASE <http://other.org/> PREFIX ex: <http://other.org/> SELECT * WHERE { ?s ex:q <o> }')
+        targets = r.searchElements(element_type=SPARQLParser.iri)
+        news = source.searchElements(element_type=SPARQLParser.iri)
+        targets[0].updateWith(news[0])
+        targets[1].updateWith(news[1])
+        assert all(e.getPrefixes() == {'ex:': 'http://ex.org/'} and e.getBaseiri() == 'http://base.org/' for e in targets[0].searchElements())
+        r.expandIris()
+        assert str(r) == 'BASE <http://base.org/> PREFIX ex: <http://ex.org/> SELECT * WHERE { ?s <http://ex.org/q> <http://base.org/o> }'
+        # a Prologue that is replaced is in force for the elements after it
+        r = parseQuery('PREFIX ex: <http://ex.org/> SELECT * WHERE { ?s ex:p ?o }')
+        r.searchElements(element_type=SPARQLParser.Prologue)[0].updateWith(source.searchElements(element_type=SPARQLParser.Prologue)[0])
+        r.expandIris()
+        assert str(r) == 'BASE <http://other.org/> PREFIX ex: <http://other.org/> SELECT * WHERE { ?s <http://other.org/p> ?o }'
+
     def testBranchAndAtom(self):
         s = "'work' ^^<work:>"
         r = SPARQLParser.RDFLiteral(s)
@@ -108,6 +360,10 @@ SELECT ?p WHERE
 'sdfasf# sdfsfd'
 """[1:-1]
         assert stripComments(s1) == s2
+        # stripComments must not change the grammar
+        ignores = len(SPARQLParser.String.getPattern().ignoreExprs)
+        stripComments('SELECT ?x # comment')
+        assert len(SPARQLParser.String.getPattern().ignoreExprs) == ignores
     
     def testSearchElements(self):
         
@@ -525,6 +781,9 @@ prologue:/exttra
             r_answer2 += '\n'
         
         assert answer2.strip() == r_answer2.strip()
+        # trees without a Prologue do not share their (empty) prefixes
+        r1, r2 = parseQuery('SELECT * {}'), SPARQLParser.Var('?x')
+        assert r1.getPrefixes() == r2.getPrefixes() == {} and r1.getPrefixes() is not r2.getPrefixes()
         
     def testExpandIris(self):
         s1 = '''
@@ -562,6 +821,588 @@ WHERE   { <book1>  dc:title  ?title }
     def testUnescapeUcode(self):
         s = 'abra\\U000C00AAcada\\u00AAbr\u99DDa'
         assert unescapeUcode(s) == 'abra󀂪cadaªbr駝a'
+        
+    def testMemoization(self):
+        # without a Prologue, parseQuery parses the (empty) Prologue twice at the same location, which gives a cache hit
+        s = 'DELETE { ?s ?p ?o } WHERE { ?s <http://ex.org/p> ?o FILTER (isIRI(?s) && SHA512(STR(?o)) != "a") }'
+        r1 = parseQuery(s)
+        assert SPARQLParser.getMemoStats() == None
+        SPARQLParser.enableMemoization(cacheSize=50)
+        try:
+            r2 = parseQuery(s)
+            stats = SPARQLParser.getMemoStats()
+        finally:
+            SPARQLParser.disableMemoization()
+        assert r2 == r1
+        assert r2.dump() == r1.dump()
+        assert r2.hasParentPointers()
+        assert stats['hits'] > 0, stats
+        assert stats['misses'] > 0, stats
+        assert stats['evictions'] > 0, stats
+        assert stats['entries'] == 0, stats
+        assert stats['size'] == 50
+        
+    def testMemoizationPerThread(self):
+        # the memo cache is only active in the thread of the parse that activates it: a parse in another thread neither waits for it nor is
+        # memoized in it, also with the same patterns
+        pattern = SPARQLParser.Expression.getPattern()
+        results = []
+        SPARQLParser.enableMemoization()
+        try:
+            with SPARQLParser.memo:
+                parseQuery('SELECT * WHERE { ?s ?p ?o }')
+                before = SPARQLParser.getMemoStats()
+                other = threading.Thread(target=lambda: results.append(pattern.parseString(' + '.join(['(1 * ?x)'] * 20))))
+                other.start()
+                other.join(10)
+                assert len(results) == 1 and SPARQLParser.getMemoStats() == before, SPARQLParser.getMemoStats()
+        finally:
+            SPARQLParser.disableMemoization()
+            other.join()
+        
+    def testTrackedPatterns(self):
+        # memoization and budgets only apply to the patterns of the grammar of a parser, which keep their pyparsing class and name
+        pattern = OneOrMore(Word(alphas) | Word(nums))
+        budget = ParseBudget(maxSteps=10**6)
+        SPARQLParser.enableMemoization()
+        try:
+            with SPARQLParser.memo, budget:
+                parseQuery('SELECT * WHERE { ?s ?p ?o }', budget=budget)
+                stats = SPARQLParser.getMemoStats()
+                steps = budget.getStats()['steps']
+                assert pattern.parseString('a 1 b 2 c 3').asList() == ['a', '1', 'b', '2', 'c', '3']
+                assert SPARQLParser.getMemoStats() == stats and budget.getStats()['steps'] == steps
+        finally:
+            SPARQLParser.disableMemoization()
+        assert type(pattern) is OneOrMore and ParserElement._parse is ParserElement._parseNoCache
+        var = SPARQLParser.Var.getPattern()
+        assert patternClass(var) is Group and type(var) is not Group and type(var).__name__ == 'Group'
+        assert str(var) == 'Var' and str(SPARQLParser.Var('?x')) == '?x'
+        
+    def testRDBackend(self):
+        queries = ['PREFIX ex: <http://ex.org/> DELETE { ?s ?p ?o } WHERE { ?s ex:p ?o FILTER (isIRI(?s) && SHA512(STR(?o)) != "a") }',
+                   'SELECT*{?s a?o;<http://x/p>-2,"x"^^<http://x/t>,+3.0e-1 FILTER(?o>=-3||!BOUND(?s))}ORDER BY DESC(?o)',
+                   'select distinct ?x where {graph ?g {?x <http://x/p> [ ] , ( )} OPTIONAL { ?x ?p 1 } } group by ?x VALUES ?x { 1 2 }',
+                   'BASE <http://ex.org/> LOAD SILENT <a> INTO GRAPH <b> ; CLEAR ALL']
+        assert SPARQLParser.getBackend() == 'pyparsing'
+        for s in queries:
+            r1 = parseQuery(s)
+            SPARQLParser.setBackend('rd')
+            try:
+                assert SPARQLParser.getBackend() == 'rd'
+                r2 = parseQuery(s)
+            finally:
+                SPARQLParser.setBackend('pyparsing')
+            assert r2 == r1
+            assert r2.dump() == r1.dump()
+            assert r2.hasParentPointers()
+        SPARQLParser.setBackend('rd')
+        try:
+            for s in ['SELECT ?x WHERE { ?x ?p ?o } LIMITx 1', 'SELECTX ?x WHERE { ?x ?p ?o }', 'SELECT ?x WHERE { ?x ?p ?o ']:
+                try:
+                    parseQuery(s)
+                    assert False, s
+                except SPARQLParseException:
+                    pass
+            try:
+                SPARQLParser.setBackend('yacc')
+                assert False
+            except ParsertoolsException:
+                pass
+        finally:
+            SPARQLParser.setBackend('pyparsing')
+
+    def testRDBackendThreads(self):
+        # the generated functions share their budget and failure location, so parses in different threads must not interleave
+        unions = 'SELECT * WHERE { ' + ' UNION '.join('{{ ?s ?p ?o{} }}'.format(i) for i in range(50)) + ' }'
+        SPARQLParser.setBackend('rd')
+        try:
+            budget = ParseBudget()
+            parseQuery(unions, budget=budget)
+            steps = budget.getStats()['steps']
+            counts = []
+            def parse():
+                for _ in range(10):
+                    budget = ParseBudget()
+                    parseQuery(unions, budget=budget)
+                    counts.append(budget.getStats()['steps'])
+            threads = [threading.Thread(target=parse) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert counts == [steps] * 40, counts
+        finally:
+            SPARQLParser.setBackend('pyparsing')
+
+    def testDeepNesting(self):
+        def nested(n):
+            return 'PREFIX ex: <http://ex.org/> SELECT * WHERE {{ ?s ex:p ?o FILTER ({}?o + 1{}) }}'.format('(' * n, ' * 2)' * n)
+        queries = [nested(3), 'SELECT ?x WHERE { ?x ?p [ ?q ( 1 ( 2 ( 3 ) ) ) ] } ORDER BY DESC(?x)', 'BASE <http://ex.org/> LOAD SILENT <a> INTO GRAPH <b> ; CLEAR ALL']
+        expected = [parseQuery(q).dump() for q in queries]
+        try:
+            SPARQLParser.setBackend('stack')
+            assert SPARQLParser.getBackend() == 'stack'
+            assert [parseQuery(q).dump() for q in queries] == expected
+            deep = parseQuery(nested(200))
+            SPARQLParser.setBackend('rd')
+            # the recursive parser falls back to the stack variant
+            assert parseQuery(nested(200)).dump() == deep.dump()
+        finally:
+            SPARQLParser.setBackend('pyparsing')
+        # so does the pyparsing backend, also for a single element and within a budget
+        assert parseQuery(nested(200)).dump() == deep.dump()
+        expression = deep.searchElements(element_type=SPARQLParser.Expression)[0]
+        assert SPARQLParser.Expression(str(expression)).dump() == SPARQLParser.Expression(str(expression), budget=ParseBudget(maxSteps=10**6)).dump()
+        budget = ParseBudget(maxSteps=10**6)
+        assert parseQuery(nested(200), budget=budget).dump() == deep.dump() and 0 < budget.getStats()['steps'] < 10**6
+        # the tree is deeper than the recursion limit, but can be walked as usual
+        assert str(deep).count('(') == 201 and deep.hasParentPointers() and deep._clone().dump() == deep.dump()
+        bracketed = deep.searchElements(element_type=SPARQLParser.BracketedExpression)
+        assert len(bracketed) == 201 and len(bracketed[-1].getAncestors()) > 1000
+        assert all(e.getPrefixes() == {'ex:': 'http://ex.org/'} for e in bracketed)
+
+    def testKeywordDispatch(self):
+        dispatcher = SPARQLParser.BuiltInCall.getPattern().expr
+        assert isinstance(dispatcher, KeywordDispatch)
+        table, others = dispatcher.getTable()
+        assert len(table['SHA512']) == 1 and len(table['STR']) == 1 and others == ()
+        table, others = SPARQLParser.GraphPatternNotTriples.getPattern().expr.getTable()
+        assert len(others) == 1 and len(table['FILTER']) == 2
+        table, others = SPARQLParser.Update1.getPattern().expr.getTable()
+        assert len(table['DELETE']) == 3 and len(table['WITH']) == 1
+        queries = ['SELECT * { ?s ?p ?o FILTER (isNUMERIC(?o) && sha512(STR(?s)) != "x" || NOT EXISTS { ?s ?p 1 }) OPTIONAL { ?s ?p 1 } }',
+                   'INSERT DATA { <a:b> <a:c> <a:d> } ; DELETE WHERE { ?s ?p ?o } ; WITH <a:g> DELETE { ?s ?p ?o } WHERE {}',
+                   'SELECT * { FILTER (STRX(?o)) }',
+                   'SELECT * { OPTIONAL ?x }']
+        for s in queries:
+            results = []
+            for dispatch in (True, False):
+                KeywordDispatch.dispatch = dispatch
+                try:
+                    results.append(parseQuery(s).dump())
+                except SPARQLParseException as e:
+                    results.append(str(e))
+                finally:
+                    KeywordDispatch.dispatch = True
+            assert results[0] == results[1], s
+
+    def testParseQuerySingleParse(self):
+        prologue = 'BASE <http://ex.org/> PREFIX ex: <http://ex.org/ns#> PREFIX ex2:\t<http://ex.org/ns2#> '
+        cases = [(prologue + 'SELECT * { ?s ex:p <a> }', SPARQLParser.QueryUnit),
+                 (prologue + 'ask {}', SPARQLParser.QueryUnit),
+                 (prologue + 'DELETE { ?s ex:p ?o } WHERE { ?s ex2:p ?o } ; PREFIX ex3: <http://ex.org/ns3#> INSERT DATA { ex3:a ex3:b "c" }', SPARQLParser.UpdateUnit),
+                 (prologue, SPARQLParser.UpdateUnit),
+                 ('', SPARQLParser.UpdateUnit)]
+        for (s, unit) in cases:
+            r = parseQuery(s)
+            assert type(r) == unit
+            expected = unit(s)
+            expected.processEscapeSeqs()
+            assert r.dump() == expected.dump()
+            assert r.hasParentPointers()
+            for (e, f) in zip(r.searchElements(), expected.searchElements()):
+                assert e.getLabel() == f.getLabel() and e.getPrefixes() == f.getPrefixes() and e.getBaseiri() == f.getBaseiri()
+        assert parseQuery(cases[0][0]).searchElements(element_type=SPARQLParser.Prologue)[0].getLabel() == 'prologue'
+        for s in [prologue + 'SELECTX * {}', prologue + 'PREFIX ex3 <http://ex.org/ns3#> SELECT * {}', prologue + 'SELECT * {} ; LOAD <a:b>']:
+            try:
+                parseQuery(s)
+                assert False, s
+            except SPARQLParseException:
+                pass
+
+    def testParseCache(self):
+        s = 'PREFIX ex: <http://ex.org/> SELECT ?s WHERE { ?s ex:p "a" } '
+        assert SPARQLParser.getParseCacheStats() == None
+        r1 = parseQuery(s)
+        SPARQLParser.enableParseCache(maxEntries=2)
+        try:
+            r2 = parseQuery(s)
+            r3 = parseQuery(s)
+            assert r2.dump() == r3.dump() == r1.dump()
+            assert r3 is not r2 and r3.hasParentPointers()
+            assert r3.searchElements(element_type=SPARQLParser.PrefixedName)[0].getPrefixes() == {'ex:': 'http://ex.org/'}
+            # changes to a returned tree do not reach the cache
+            r3.expandIris()
+            r4 = parseQuery(s)
+            assert r4.dump() == r1.dump() != r3.dump()
+            assert type(parseQuery(s, base='http://base.org/')) == SPARQLParser.QueryUnit
+            stats = SPARQLParser.getParseCacheStats()
+            assert (stats['hits'], stats['misses'], stats['entries']) == (2, 2, 2), stats
+            assert stats['hitRate'] == 0.5 and stats['bytes'] > 0
+            parseQuery('INSERT DATA { <a:b> <a:c> <a:d> }')
+            stats = SPARQLParser.getParseCacheStats()
+            assert stats['evictions'] == 1 and stats['entries'] == 2, stats
+            for _ in range(2):
+                try:
+                    parseQuery('SELECT ?s WHERE { ?s ex:p "a" ')
+                    assert False
+                except SPARQLParseException:
+                    pass
+            assert SPARQLParser.getParseCacheStats()['entries'] == 2
+            SPARQLParser.enableParseCache(maxBytes=1000)
+            parseQuery(s)
+            assert SPARQLParser.getParseCacheStats()['entries'] == 0
+        finally:
+            SPARQLParser.disableParseCache()
+
+    def testReparseQuery(self):
+        text = 'PREFIX ex: <http://ex.org/>\nSELECT ?s WHERE {\n\t?s ex:p "abc" . # comment\n\t?s ex:q ?o FILTER (?o > 10)\n}'
+        def state(tree):
+            return tree.dump(), [(e.getLabel(), e.getPrefixes(), e.getBaseiri()) for e in tree.searchElements()]
+        edits = [(text.index('"abc"') + 2, 1, 'xyz'), (text.index('10'), 2, '?s + 1'), (text.index('ex:q') + 3, 1, 'r'),
+                 (text.index('ex.org'), 2, 'fo'), (text.index('comment'), 7, 'new comment'), (text.index('?s WHERE'), 2, '*')]
+        for (offset, removed, inserted) in edits:
+            newtext = text[:offset] + inserted + text[offset + removed:]
+            tree = parseQuery(text)
+            r = reparseQuery(tree, text, offset, removed, inserted)
+            assert state(r) == state(parseQuery(newtext)) and r.hasParentPointers()
+        # a small edit is reparsed in place, a larger one falls back to parseQuery()
+        tree = parseQuery(text)
+        assert reparseQuery(tree, text, text.index('"abc"') + 2, 1, 'xyz') is tree
+        assert reparseQuery(tree, text, text.index('SELECT'), len('SELECT ?s'), 'ASK') is not tree
+        # the same exceptions are raised as by parseQuery()
+        for (offset, removed, inserted) in [(text.index('"abc"'), 0, '{'), (text.index('ex:q'), 2, 'ey')]:
+            newtext = text[:offset] + inserted + text[offset + removed:]
+            for f in (lambda: parseQuery(newtext), lambda: reparseQuery(parseQuery(text), text, offset, removed, inserted)):
+                try:
+                    f()
+                    assert False
+                except (ParsertoolsException, KeyError):
+                    pass
+
+    def testParseQueryAsync(self):
+        queries = ['PREFIX ex: <http://ex.org/>\nSELECT ?s WHERE {{ ?s ex:p {} }}'.format(i) for i in range(5)]
+        expected = [parseQuery(q).dump() for q in queries]
+        
+        async def run():
+            trees = await asyncio.gather(*[parseQueryAsync(q) for q in queries])
+            assert [t.dump() for t in trees] == expected and all(t.hasParentPointers() for t in trees)
+            try:
+                await parseQueryAsync('SELECT ?s WHERE')
+                assert False
+            except SPARQLParseException:
+                pass
+            # the calls beyond maxInFlight wait for a slot
+            async with AsyncQueryParser(maxInFlight=1) as p:
+                tasks = [asyncio.ensure_future(p.parseQuery(q)) for q in queries]
+                await asyncio.sleep(0)
+                stats = p.getStats()
+                assert stats['inFlight'] == 1 and stats['waiting'] == 4, stats
+                assert [t.dump() for t in await asyncio.gather(*tasks)] == expected
+                try:
+                    await p.parseQuery(queries[0], timeout=0)
+                    assert False
+                except asyncio.TimeoutError:
+                    pass
+                stats = p.getStats()
+                assert stats['completed'] == 5 and stats['timeouts'] == 1 and stats['waiting'] == 0, stats
+            async with AsyncQueryParser('process', workers=1) as p:
+                results = await asyncio.gather(p.parseQuery(queries[0]), p.parseQuery('SELECT ?s WHERE'), return_exceptions=True)
+                assert results[0].dump() == expected[0] and results[0].hasParentPointers()
+                assert isinstance(results[1], SPARQLParseException)
+            # parses in several threads at once give the same trees, with either backend and with the memo cache
+            for backend in ('pyparsing', 'rd'):
+                SPARQLParser.setBackend(backend)
+                async with AsyncQueryParser(workers=4) as p:
+                    assert p.getStats()['maxInFlight'] == 8
+                    trees = await asyncio.gather(*[p.parseQuery(q) for q in queries * 4])
+                    assert [t.dump() for t in trees] == expected * 4
+            SPARQLParser.enableMemoization()
+            try:
+                async with AsyncQueryParser(workers=4) as p:
+                    trees = await asyncio.gather(*[p.parseQuery(q) for q in queries * 4])
+                    assert [t.dump() for t in trees] == expected * 4
+            finally:
+                SPARQLParser.disableMemoization()
+            # with an executor passed in, the bound on parses in flight must be given
+            with ThreadPoolExecutor(2) as executor:
+                try:
+                    AsyncQueryParser(executor)
+                    assert False
+                except AssertionError:
+                    pass
+                p = AsyncQueryParser(executor, maxInFlight=3)
+                assert p.getStats()['maxInFlight'] == 3
+                assert (await p.parseQuery(queries[0])).dump() == expected[0]
+            # parses cancelled while they wait for a slot or for a worker are not started, and counted as cancelled
+            with ThreadPoolExecutor(1) as executor:
+                gate = threading.Event()
+                executor.submit(gate.wait)
+                p = AsyncQueryParser(executor, maxInFlight=2)
+                tasks = [asyncio.ensure_future(p.parseQuery(q)) for q in queries[:3]]
+                await asyncio.sleep(0)
+                assert p.getStats()['inFlight'] == 2 and p.getStats()['waiting'] == 1
+                tasks[1].cancel()
+                tasks[2].cancel()
+                await asyncio.sleep(0)
+                gate.set()
+                results = await asyncio.gather(*tasks, return_exceptions=True)
+                assert results[0].dump() == expected[0] and all(isinstance(r, asyncio.CancelledError) for r in results[1:])
+                stats = p.getStats()
+                assert stats['completed'] == 1 and stats['cancelled'] == 2 and stats['inFlight'] == stats['waiting'] == 0, stats
+
+        try:
+            asyncio.run(run())
+        finally:
+            SPARQLParser.setBackend('pyparsing')
+
+    def testParseBudget(self):
+        query = 'PREFIX ex: <http://ex.org/>\nSELECT * WHERE { ?s ex:p ?o FILTER ((?o + 1) * 2 > 3) }'
+        unions = 'SELECT * WHERE { ' + ' UNION '.join('{{ ?s ?p ?o{} }}'.format(i) for i in range(100)) + ' }'
+        nested = 'SELECT * WHERE {{ ?s ?p ?o FILTER ({}?o{}) }}'.format('(' * 100, ')' * 100)
+        def exceeds(f):
+            try:
+                f()
+                return False
+            except BudgetExceededError:
+                return True
+        try:
+            for backend in ('pyparsing', 'rd'):
+                SPARQLParser.setBackend(backend)
+                budget = ParseBudget(maxSteps=10**6, maxDepth=1000, maxTime=60)
+                assert parseQuery(query, budget=budget).dump() == parseQuery(query).dump()
+                stats = budget.getStats()
+                assert 0 < stats['steps'] < 10**6 and 0 < stats['depth'] < 1000 and stats['maxSteps'] == 10**6
+                assert exceeds(lambda: parseQuery(unions, budget=ParseBudget(maxSteps=1000)))
+                assert exceeds(lambda: parseQuery(unions, budget=ParseBudget(maxTime=0)))
+                assert exceeds(lambda: parseQuery(nested, budget=ParseBudget(maxDepth=100)))
+                # without a depth limit, both backends switch to the stack variant of the rd backend for input that exceeds the recursion limit
+                assert str(parseQuery(nested, budget=ParseBudget())) == str(parseQuery(nested))
+                assert exceeds(lambda: SPARQLParser.Expression('((1 + 2) * 3)', budget=ParseBudget(maxSteps=10)))
+                assert str(SPARQLParser.Expression('((1 + 2) * 3)', budget=ParseBudget(maxSteps=10**4))) == '( ( 1 + 2 ) * 3 )'
+        finally:
+            SPARQLParser.setBackend('pyparsing')
+        # the parser is usable after a parse was stopped
+        assert parseQuery(query).dump() == parseQuery(query, budget=ParseBudget(maxDepth=1000)).dump()
+
+    def testParseBudgetTime(self):
+        # the time limit applies to the parse itself, also to the first parse with a budget and to one that switches to the stack variant: the rd
+        # backend compiles its parser in advance
+        nested = '{{ ?s ?p ?o FILTER ({}?o{}) }}'
+        pattern = SPARQLParser.GroupGraphPattern.getPattern()
+        for stackless in (False, True):
+            engine = RDEngine(SPARQLParser, stackless)
+            budget = ParseBudget(maxTime=0.1)
+            engine.parseString(pattern, nested.format('(' * 60, ')' * 60), budget=budget)
+            assert budget.getStats()['time'] < 0.1
+            # a parse that exceeds the limit is stopped soon after
+            started = time.perf_counter()
+            try:
+                engine.parseString(pattern, nested.format('(' * 2000, ')' * 2000), budget=ParseBudget(maxTime=0.05))
+                assert False, 'expected a BudgetExceededError'
+            except BudgetExceededError:
+                pass
+            assert time.perf_counter() - started < 0.5
+        
+    def testParseBudgetPerThread(self):
+        # a budget only charges the parses in the thread that activates it: parses in other threads are neither counted nor stopped
+        query = 'PREFIX ex: <http://ex.org/>\nSELECT * WHERE { ?s ex:p ?o FILTER ((?o + 1) * 2 > 3) }'
+        unions = 'SELECT * WHERE { ' + ' UNION '.join('{{ ?s ?p ?o{} }}'.format(i) for i in range(20)) + ' }'
+        budget = ParseBudget(maxSteps=10**6)
+        parseQuery(query, budget=budget)
+        steps = budget.getStats()['steps']
+        done = threading.Event()
+        errors = []
+        def unbudgeted():
+            try:
+                while not done.is_set():
+                    parseQuery(unions)
+            except Exception as e:
+                errors.append(e)
+        other = threading.Thread(target=unbudgeted)
+        other.start()
+        try:
+            for _ in range(20):
+                parseQuery(query, budget=budget)
+                assert budget.getStats()['steps'] == steps, budget.getStats()
+                try:
+                    parseQuery(unions, budget=ParseBudget(maxSteps=100))
+                except BudgetExceededError:
+                    pass
+        finally:
+            done.set()
+            other.join()
+        assert errors == [], errors
+
+    def testParseQueries(self):
+        queries = ['PREFIX ex: <http://ex.org/> SELECT ?s WHERE { ?s ex:p "a" }',
+                   'SELECT ?s WHERE { ?s ?p "a" ',
+                   'BASE <http://ex.org/> INSERT DATA { <a> <b> <c> }',
+                   'ASK {}'] * 3
+        expected = []
+        for q in queries:
+            try:
+                expected.append(parseQuery(q))
+            except SPARQLParseException as e:
+                expected.append(e)
+        results = list(parseQueries(iter(queries), workers=2, chunksize=2))
+        assert [i for (i, _) in results] == list(range(len(queries)))
+        for ((_, r), e) in zip(results, expected):
+            if isinstance(e, Exception):
+                assert type(r) == type(e) and str(r) == str(e)
+            else:
+                assert type(r) == type(e) and r.dump() == e.dump() and r.hasParentPointers()
+                for (x, y) in zip(r.searchElements(), e.searchElements()):
+                    assert x.getLabel() == y.getLabel() and x.getPrefixes() == y.getPrefixes() and x.getBaseiri() == y.getBaseiri()
+        results = list(parseQueries(queries, workers=2, chunksize=5, ordered=False))
+        assert sorted(i for (i, _) in results) == list(range(len(queries)))
+        # the packed form survives pickling, and shares prefix dicts as much as the original does
+        r = expected[0]
+        r2 = unpackTree(pickle.loads(pickle.dumps(packTree(r))), SPARQLParser)
+        assert r2.dump() == r.dump() and r2.hasParentPointers() and r2.getParent() is None
+        assert len(set(id(e.getPrefixes()) for e in r2.searchElements())) == len(set(id(e.getPrefixes()) for e in r.searchElements()))
+
+    def testFlatTree(self):
+        queries = ['PREFIX ex: <http://ex.org/>\nSELECT ?s (COUNT(?o) AS ?n) WHERE { ?s ex:p "a\\tb" ; ex:q ?o FILTER (?o > 1) } GROUP BY ?s',
+                   'BASE <http://ex.org/> PREFIX ex: <p:> DELETE { ?s ex:p ?o } WHERE { ?s ex:p ?o } ; INSERT DATA { <a> <b> "c" }']
+        for q in queries:
+            tree = parseQuery(q)
+            flat = parseQuery(q, flat=True)
+            root = flat.getRoot()
+            assert isinstance(flat, FlatTree) and isinstance(root, FlatElement)
+            assert root == tree and tree == root and root.getType() is type(tree) and root.dump() == tree.dump()
+            for kw in [{}, {'labeledOnly': True}, {'element_type': SPARQLParser.Var}, {'label': 'prologue'}, {'element_type': SPARQLParser.PrefixedName, 'value': 'ex:p'}]:
+                expected = tree.searchElements(**kw)
+                found = root.searchElements(**kw)
+                assert len(found) == len(expected) and all(f == e and f.getLabel() == e.getLabel() for (f, e) in zip(found, expected)), kw
+            var = root.searchElements(element_type=SPARQLParser.Var)[-1]
+            assert [a.getType() for a in var.getAncestors()] == [type(a) for a in tree.searchElements(element_type=SPARQLParser.Var)[-1].getAncestors()]
+            assert var.getParent().getChildren()[0] == var and var.getItems() == var.getChildren() and var.descend().getItems() == [str(var)]
+            copy = root.toParseStruct()
+            assert copy.dump() == tree.dump() and copy.hasParentPointers()
+            assert all(c.getPrefixes() == e.getPrefixes() and c.getBaseiri() == e.getBaseiri() for (c, e) in zip(copy.searchElements(), tree.searchElements()))
+            unpacked = FlatTree.unpack(pickle.loads(pickle.dumps(flat.pack())), SPARQLParser)
+            assert unpacked.getRoot().dump() == tree.dump()
+            try:
+                root.other = None
+                assert False
+            except AttributeError:
+                pass
+        # the spans are positions in the prepared query string, also for strings with escape sequences
+        literal = root.searchElements(element_type=SPARQLParser.String)[0]
+        assert flat.text[slice(*literal.getSpan())] == '"c"'
+        root = parseQuery(queries[0], flat=True).getRoot()
+        literal = root.searchElements(element_type=SPARQLParser.String)[0]
+        assert str(literal) == '"a\tb"' and root.getTree().text[slice(*literal.getSpan())] == '"a\\tb"'
+        assert root.getTree().getSize() < 100 * len(root.searchElements())
+        results = list(parseQueries(queries + ['ASK {'], workers=1, flat=True))
+        assert results[0][1].getRoot().dump() == parseQuery(queries[0]).dump() and isinstance(results[2][1], SPARQLParseException)
+        SPARQLParser.enableParseCache()
+        try:
+            # a FlatTree is read-only, so the cache hands out the tree it stores
+            assert parseQuery(queries[0], flat=True) is parseQuery(queries[0], flat=True)
+            assert isinstance(parseQuery(queries[0]), SPARQLParser.QueryUnit)
+        finally:
+            SPARQLParser.disableParseCache()
+
+    def testSpanLeaves(self):
+        q = 'select ?s WHERE { ?s <p:a> "x\\ty", "z" }'
+        flat = parseQuery(q, flat=True)
+        root = flat.getRoot()
+        # only the strings that differ from the text are stored: keywords in another case, and strings with escape sequences
+        assert sorted(flat.strings) == ['"x\ty"', 'SELECT']
+        assert str(root) == str(parseQuery(q)) and root.dump() == parseQuery(q).dump()
+        assert root.getSourceText() == flat.text.strip()
+        where = root.searchElements(element_type=SPARQLParser.WhereClause)[0]
+        assert where.getSourceText() == flat.text[flat.text.index('WHERE'):].strip() and str(where) == 'WHERE { ?s <p:a> "x\ty" , "z" }'
+        assert FlatTree(parseQuery(q)).getRoot().getSourceText() is None
+
+    def testParseQueryLog(self):
+        records = ['PREFIX ex: <http://ex.org/>\nSELECT ?s WHERE { ?s ex:p "a;;b" }', 'SELECT ?s WHERE { ?s ?p "a" ', '  \n ', 'ASK {}']
+        text = ';;\n'.join(records) + ';;\n'
+        expected = [(0, parseQuery(records[0])), (1, SPARQLParseException), (3, parseQuery(records[3]))]
+        def check(results):
+            assert [i for (i, _) in results] == [i for (i, _) in expected]
+            for ((_, r), (_, e)) in zip(results, expected):
+                if e is SPARQLParseException:
+                    assert isinstance(r, SPARQLParseException)
+                else:
+                    assert r.dump() == e.dump() and r.hasParentPointers()
+        # a small bufsize puts delimiters across block boundaries
+        for bufsize in (1, 2, 5, 2**16):
+            check(list(parseQueryLog(io.StringIO(text), delimiter=';;\n', bufsize=bufsize)))
+        binary = io.BytesIO(text.encode('utf-8'))
+        check(list(parseQueryLog(binary, delimiter=';;\n', bufsize=3)))
+        assert not binary.closed
+        check(list(parseQueryLog(io.StringIO(text), delimiter=';;\n', workers=2)))
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'log.txt')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            check(list(parseQueryLog(path, delimiter=';;\n')))
+            # an unbuffered binary file
+            with open(path, 'rb', buffering=0) as f:
+                check(list(parseQueryLog(f, delimiter=';;\n')))
+                assert not f.closed
+        # the source is read as far as needed only
+        log = io.StringIO('ASK {}\n' * 1000)
+        results = parseQueryLog(log, bufsize=100)
+        assert next(results)[0] == 0 and log.tell() == 100
+        assert list(readRecords(io.StringIO('a\nb\n\nc'))) == ['a', 'b', '', 'c']
+
+    def testInterning(self):
+        q = 'PREFIX ex: <http://ex.org/> SELECT ?s WHERE { ?s ex:p 42, "a" }'
+        def strings(tree):
+            return [i for e in tree.searchElements() for i in e.getItems() if isinstance(i, str)]
+        def shared(t1, t2):
+            return all(a is b for (a, b) in zip(strings(t1), strings(t2))) and t1.searchElements()[-1].getPrefixes() is t2.searchElements()[-1].getPrefixes()
+        assert SPARQLParser.getInternStats() == None
+        assert not shared(parseQuery(q), parseQuery(q))
+        table = InternTable()
+        SPARQLParser.enableInterning(table)
+        try:
+            for backend in ('pyparsing', 'rd'):
+                SPARQLParser.setBackend(backend)
+                t1, t2 = parseQuery(q), parseQuery(q)
+                assert shared(t1, t2) and t1.dump() == t2.dump()
+            t3 = unpackTree(pickle.loads(pickle.dumps(packTree(t1))), SPARQLParser)
+            assert shared(t1, t3) and t3.dump() == t1.dump()
+            stats = SPARQLParser.getInternStats()
+            # the dicts are the prefixes of the Prologue, and the empty prefixes of the elements around it, as unpacked
+            assert stats == table.getStats() and stats['dicts'] == 2 and stats['strings'] == len(table) - 2
+            assert stats['hits'] > stats['misses'] > 0 and stats['savedBytes'] > 0 and stats['bytes'] > 0
+            # a full table returns new values as they are
+            small = InternTable(maxEntries=1)
+            s1, s2 = ''.join(['?', 'x']), ''.join(['?', 'x'])
+            assert small.intern(s1) is s1 and small.intern(s2) is s1 and small.intern('?y' * 2) == '?y?y' and len(small) == 1
+            assert small.intern(42) == 42
+            small.clear()
+            assert len(small) == 0 and small.intern(s2) is s2
+        finally:
+            SPARQLParser.setBackend('pyparsing')
+            SPARQLParser.disableInterning()
+
+    def testParentPointersFromParseActions(self):
+        walks = []
+        createParentPointers = ParseStruct.createParentPointers
+        def counted(self, recursive=True):
+            walks.append(recursive)
+            createParentPointers(self, recursive)
+        q = 'PREFIX ex: <http://ex.org/> SELECT ?s WHERE { ?s ex:p ?o FILTER (?o > (1 + 2)) }'
+        ParseStruct.createParentPointers = counted
+        try:
+            for backend in ('pyparsing', 'rd', 'stack'):
+                SPARQLParser.setBackend(backend)
+                for tree in (parseQuery(q), SPARQLParser.QueryUnit(q)):
+                    assert tree.getParent() is None and tree.hasParentPointers()
+                    assert all(c.getParent() is e for e in tree.searchElements() for c in e.getChildren())
+            # no walks over the whole tree, only over the items that the constructor takes over from the parse result
+            assert walks and not any(walks)
+        finally:
+            ParseStruct.createParentPointers = createParentPointers
+            SPARQLParser.setBackend('pyparsing')
+        # In a memoized parse, X is last built into Q, which is discarded, and then reused from the memo in A without running the parse action of A again.
+        # The parent pointers are then set again after the parse.
+        p = Parser(ParseStruct)
+        p.addElement(Literal('x').setName('X'))
+        p.addElement((p.X.getPattern() + Literal('a')).setName('A'))
+        p.addElement((p.X.getPattern() + Literal('a')).setName('Q'))
+        p.addElement(((p.A.getPattern() + 'z') | (p.Q.getPattern() + 'z') | (p.A.getPattern() + 'y')).setName('E'))
+        p.enableMemoization()
+        tree = p.E('x a y')
+        a = tree.getChildren()[0]
+        assert isinstance(a, p.A) and a.getChildren()[0].getParent() is a and tree.hasParentPointers()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,55 @@
+'''
+Equivalence harness for the recursive descent backends. Parses every query and update in the reftest corpora with each backend
+of SPARQLParser (pyparsing, rd and stack), and checks that they accept and reject the same inputs and build the same ParseStruct trees.
+'''
+
+import os
+import glob
+import time
+from pyparsing import ParseException
+from parsertools.parsers.sparqlparser import SPARQLParser
+from parsertools.parsers.sparqlparser import stripComments
+
+here = os.path.dirname(os.path.abspath(__file__))
+fnames = sorted(glob.glob(os.path.join(here, '*', '*.rq')) + glob.glob(os.path.join(here, '*', '*.ru')))
+
+def parseAll(backend):
+    SPARQLParser.setBackend(backend)
+    results = {}
+    start = time.time()
+    for fname in fnames:
+        s = stripComments(open(fname).readlines())
+        for unit in (SPARQLParser.QueryUnit, SPARQLParser.UpdateUnit):
+            try:
+                r = unit(s, postParseCheck=False)
+                results[fname, unit.__name__] = r.dump()
+            except ParseException:
+                results[fname, unit.__name__] = None
+            except Exception as e:
+                # raised after parsing, e.g. when resolving a relative BASE without an externally supplied base iri
+                results[fname, unit.__name__] = e.__class__.__name__
+    return results, time.time() - start
+
+backends = ['pyparsing', 'rd', 'stack']
+
+try:
+    results = dict((backend, parseAll(backend)) for backend in backends)
+finally:
+    SPARQLParser.setBackend('pyparsing')
+
+print('Testing {} files with {} backends'.format(len(fnames), len(backends)))
+
+expected, _ = results['pyparsing']
+for backend in backends[1:]:
+    found, _ = results[backend]
+    for key in sorted(expected):
+        if expected[key] != found[key]:
+            if found[key] is None:
+                print('\n*** {} ({}) should not raise exception with {} backend? Check\n'.format(*key, backend))
+            elif expected[key] is None:
+                print('\n*** {} ({}) should raise exception with {} backend? Check\n'.format(*key, backend))
+            else:
+                print('\n*** {} ({}) gives a different tree with {} backend? Check\n'.format(*key, backend))
+
+print(', '.join('{}: {:.2f}s'.format(backend, results[backend][1]) for backend in backends))
+print('Passed')